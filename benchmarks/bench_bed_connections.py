@@ -0,0 +1,161 @@
+##################################################
+# PiHub benchmark - simultaneous bed sensors connections
+##################################################
+# Load test of the bed protocol: opens a number of simulated ESP32 connections at the same time (22-byte greeting,
+# then uint16 samples sent in small segments, then close) and reports how many were served, how long they took and,
+# for a local server, the threads and memory used. By default a local BedServer is started in each server mode, with
+# its data in a temporary folder and without uploads; --host targets an already running PiHub instead. The threads
+# and memory include the simulated sensors, which run in a single event loop.
+#
+# Usage: python benchmarks/bench_bed_connections.py [--connections 50,200,500] [--modes threaded,asyncio]
+#                                                   [--samples 5000] [--duration 2] [--host HOST --port PORT]
+##################################################
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import argparse
+import asyncio
+import logging
+import resource
+import socketserver
+import tempfile
+import threading
+import time
+
+
+async def simulate_sensor(host: str, port: int, index: int, payload: bytes, segment_count: int,
+                          duration: float) -> bool:
+    try:
+        reader, writer = await asyncio.open_connection(host, port)
+    except OSError:
+        return False
+    try:
+        writer.write(('BENCH' + str(index).zfill(17)).encode('utf-8'))    # 22 bytes greeting
+        await writer.drain()
+        segment_size = -(-len(payload) // segment_count)
+        for offset in range(0, len(payload), segment_size):
+            await asyncio.sleep(duration / segment_count)
+            writer.write(payload[offset:offset + segment_size])
+            await writer.drain()
+        writer.write_eof()
+        # Wait for the server to close the connection once the data is stored
+        await asyncio.wait_for(reader.read(), 60)
+        return True
+    except (OSError, asyncio.TimeoutError):
+        return False
+    finally:
+        writer.close()
+
+
+async def simulate_sensors(host: str, port: int, connection_count: int, payload: bytes, segment_count: int,
+                           duration: float) -> list:
+    return await asyncio.gather(*[simulate_sensor(host, port, index, payload, segment_count, duration)
+                                  for index in range(connection_count)])
+
+
+def start_local_server(mode: str, data_path: str, max_connections: int):
+    from libs.servers.BedServer import BedServer, BedServerRequestHandler
+
+    server = BedServer(server_config={'hostname': '127.0.0.1', 'port': 0, 'data_path': data_path,
+                                      'server_base_folder': 'Bed', 'server_mode': mode,
+                                      'max_connections': max_connections, 'min_free_space_mb': 0},
+                       sftp_config={})
+    # Same setup as BedServer.run, without the synchronization and uploads
+    if mode == 'asyncio':
+        threading.Thread(target=server.run_asyncio, daemon=True).start()
+        while not server.is_running:
+            time.sleep(0.01)
+        port = server.server.sockets[0].getsockname()[1]
+    else:
+        BedServerRequestHandler.base_server = server
+        server.server = socketserver.ThreadingTCPServer(server_address=('127.0.0.1', 0),
+                                                        RequestHandlerClass=BedServerRequestHandler)
+        server.server.daemon_threads = True
+        threading.Thread(target=server.server.serve_forever, daemon=True).start()
+        server.is_running = True
+        port = server.server.server_address[1]
+    return server, port
+
+
+def count_samples(data_path: str) -> int:
+    samples_count = 0
+    for dir_path, _, file_names in os.walk(data_path):
+        for file_name in file_names:
+            with open(os.path.join(dir_path, file_name)) as f:
+                for line in f:
+                    samples_count += max(0, len(line.rstrip('\n').split('\t')) - 2)
+    return samples_count
+
+
+def resident_memory() -> int:
+    # Resident size of the process in bytes (Linux only - 0 elsewhere)
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return 0
+
+
+def run_load(host: str, port: int, connection_count: int, args) -> dict:
+    payload = bytes(range(256)) * (args.samples * 2 // 256 + 1)
+    payload = payload[:args.samples * 2]
+    peak_threads = threading.active_count()
+    start_memory = peak_memory = resident_memory()
+    done = threading.Event()
+
+    def sample_threads():
+        nonlocal peak_threads, peak_memory
+        while not done.wait(0.05):
+            peak_threads = max(peak_threads, threading.active_count())
+            peak_memory = max(peak_memory, resident_memory())
+
+    sampler = threading.Thread(target=sample_threads, daemon=True)
+    sampler.start()
+    start_time = time.perf_counter()
+    results = asyncio.run(simulate_sensors(host, port, connection_count, payload, args.segments, args.duration))
+    duration = time.perf_counter() - start_time
+    done.set()
+    sampler.join()
+    return {'served': sum(results), 'duration': duration, 'peak_threads': peak_threads,
+            'peak_memory': peak_memory - start_memory}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bed server simultaneous connections load test')
+    parser.add_argument('--connections', default='50,200,500', help='Comma separated numbers of simultaneous sensors')
+    parser.add_argument('--modes', default='threaded,asyncio', help='Server modes to test with a local server')
+    parser.add_argument('--max-connections', type=int, default=256, help='max_connections of the asyncio mode')
+    parser.add_argument('--samples', type=int, default=5000, help='Samples sent by each sensor')
+    parser.add_argument('--segments', type=int, default=20, help='Number of segments each sensor sends its data in')
+    parser.add_argument('--duration', type=float, default=2., help='Time each sensor takes to send its data (s)')
+    parser.add_argument('--host', help='Host of a running bed server (a local server is started if not set)')
+    parser.add_argument('--port', type=int, default=3000, help='Port of the running bed server')
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    connection_counts = [int(count) for count in args.connections.split(',')]
+    soft_limit, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted_limit = 3 * max(connection_counts) + 64
+    if soft_limit < wanted_limit:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(wanted_limit, hard_limit), hard_limit))
+
+    if args.host:
+        for connection_count in connection_counts:
+            result = run_load(args.host, args.port, connection_count, args)
+            print(f'{connection_count:>5} sensors: {result["served"]:>5} served in {result["duration"]:.1f}s')
+        sys.exit(0)
+
+    for mode in args.modes.split(','):
+        for connection_count in connection_counts:
+            with tempfile.TemporaryDirectory() as data_path:
+                try:
+                    server, port = start_local_server(mode, data_path, args.max_connections)
+                except ImportError as e:
+                    sys.exit('Unable to start a local BedServer (' + str(e) + ') - use --host to test a running one')
+                result = run_load('127.0.0.1', port, connection_count, args)
+                server.stop()
+                stored = count_samples(os.path.join(data_path, 'local_only'))
+                print(f'{mode:>8} - {connection_count:>5} sensors: {result["served"]:>5} served in '
+                      f'{result["duration"]:.1f}s, {stored / args.samples:.0f} stored, '
+                      f'{result["peak_threads"]} threads, peak memory +{result["peak_memory"] / 1e6:.1f} MB')
@@ -0,0 +1,102 @@
+##################################################
+# PiHub benchmark - bed sensor samples receive
+##################################################
+# Streams uint16 samples over a local TCP connection and compares the legacy receive loop (recv(2) and one write per
+# sample) with the bulk receive loop of BedServerRequestHandler (recv_into a preallocated buffer, decoding all complete
+# samples at once). Both loops must produce byte-for-byte identical text files.
+#
+# Usage: python benchmarks/bench_bed_receive.py [--samples 200000] [--chunk 1460]
+##################################################
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from libs.utils.BedDataFile import BedTextFile
+from libs.utils.BedSamples import BedSamples
+
+from datetime import datetime
+
+import argparse
+import random
+import socket
+import tempfile
+import threading
+import time
+
+timestamp = datetime(2024, 1, 1, 12, 0, 0)   # Start of the received block
+
+
+def send_samples(server: socket.socket, payload: bytes, chunk_size: int):
+    connection, _ = server.accept()
+    with connection:
+        for offset in range(0, len(payload), chunk_size):
+            connection.sendall(payload[offset:offset + chunk_size])
+
+
+def receive_legacy(request: socket.socket, filename: str):
+    # Loop of the baseline BedServerRequestHandler.handle
+    with open(filename, 'a') as file:
+        file.write(str(timestamp) + "\t")
+        while True:
+            d1minidata = request.recv(2)
+            if len(d1minidata) == 0:
+                break
+            x = int.from_bytes(d1minidata, byteorder='little', signed=False)
+            file.write(str(x) + "\t")
+        file.write("\n")
+
+
+def receive_bulk(request: socket.socket, filename: str):
+    # Loop of BedServerRequestHandler.receive_samples
+    file = BedTextFile(filename)
+    file.start_block(timestamp)
+    buffer = bytearray(64 * 1024)
+    view = memoryview(buffer)
+    pending = 0
+    while True:
+        count = request.recv_into(view[pending:])
+        if count == 0:
+            break
+        count += pending
+        pending = count % BedSamples.sample_size
+        file.write_samples(view[:count - pending])
+        if pending:
+            view[:pending] = view[count - pending:count]
+    if pending:
+        file.write_samples(bytes([buffer[0], 0]))
+    file.close()
+
+
+def run(receive, payload: bytes, chunk_size: int, filename: str) -> float:
+    server = socket.create_server(('127.0.0.1', 0))
+    sender = threading.Thread(target=send_samples, args=(server, payload, chunk_size))
+    sender.start()
+    start_time = time.perf_counter()
+    with socket.create_connection(server.getsockname()) as request:
+        receive(request, filename)
+    duration = time.perf_counter() - start_time
+    sender.join()
+    server.close()
+    return duration
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bed sensor samples receive benchmark')
+    parser.add_argument('--samples', type=int, default=200000, help='Samples sent by the simulated sensor')
+    parser.add_argument('--chunk', type=int, default=1460, help='Size of the segments sent by the sensor')
+    args = parser.parse_args()
+
+    payload = bytes(random.getrandbits(8) for _ in range(args.samples * BedSamples.sample_size))
+    with tempfile.TemporaryDirectory() as temp_dir:
+        results = {}
+        for name, receive in [('legacy', receive_legacy), ('bulk', receive_bulk)]:
+            filename = os.path.join(temp_dir, name + '.txt')
+            results[name] = run(receive, payload, args.chunk, filename)
+            print(f'{name:>8}: {results[name]:.3f}s - {args.samples / results[name]:,.0f} samples/s')
+
+        with open(os.path.join(temp_dir, 'legacy.txt'), 'rb') as legacy_file, \
+                open(os.path.join(temp_dir, 'bulk.txt'), 'rb') as bulk_file:
+            identical = legacy_file.read() == bulk_file.read()
+        print(f' speedup: {results["legacy"] / results["bulk"]:.1f}x - identical output: {identical}')
+        if not identical:
+            sys.exit(1)
@@ -0,0 +1,68 @@
+##################################################
+# PiHub benchmark - session events posting
+##################################################
+# Posts the events of a watch log (each event repeated --repeat times in a row, as the watches log some states) to a
+# local OpenTera stub (see opentera_stub.py), with the former loop (one event at a time, stopped after 100 events) and
+# with post_session_events (repeated events coalesced, event_post_workers events at a time), and reports the duration
+# and the number of events posted. Requires opentera_libraries (the stub only replaces the communication with the
+# server).
+#
+# Usage: python benchmarks/bench_opentera_events.py [--events 1000] [--repeat 3] [--rtt 0.05] [--workers 1,8,16]
+##################################################
+from opentera_stub import StubServer, create_opentera_server, watch_logs
+
+from libs.servers.WatchServerOpenTera import WatchServerOpenTera
+
+import opentera_libraries.device.DeviceAPI as DeviceAPI
+
+import argparse
+import logging
+import tempfile
+import time
+
+
+def legacy_post_events(device_com, id_session: int, events: list) -> int:
+    # Loop of the baseline transfer_device_data - returns the number of events posted
+    posted_count = 0
+    for index, event in enumerate(events):
+        if index >= 100:
+            break   # Events after the 100th were dropped
+        event['id_session'] = id_session
+        event['id_session_event'] = 0
+        response = device_com.do_post(DeviceAPI.ENDPOINT_DEVICE_SESSION_EVENTS, {'session_event': event})
+        posted_count += response.status_code == 200
+    return posted_count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Session events posting benchmark')
+    parser.add_argument('--events', type=int, default=1000, help='Number of distinct events in the log')
+    parser.add_argument('--repeat', type=int, default=3, help='Times each event is logged in a row')
+    parser.add_argument('--rtt', type=float, default=0.05, help='Round-trip time to the OpenTera server (s)')
+    parser.add_argument('--workers', default='1,8,16', help='Comma separated numbers of event posting workers')
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    logs = watch_logs(args.events, args.repeat)
+    print(f'{len(logs)} logged events ({args.events} distinct) - RTT {args.rtt * 1000:.0f} ms')
+    with tempfile.TemporaryDirectory() as data_path:
+        stub = StubServer(rtt=args.rtt)
+        server = create_opentera_server(data_path, stub)
+        device_com = server.opentera_clients.client('BenchWatch', 'token')
+
+        start_time = time.perf_counter()
+        posted_count = legacy_post_events(device_com, 1, WatchServerOpenTera.watch_logs_to_events(logs))
+        print(f'{"legacy":>11}: {time.perf_counter() - start_time:6.2f}s, {posted_count}/{len(logs)} events posted')
+
+        for worker_count in [int(workers) for workers in args.workers.split(',')]:
+            server.event_post_workers = worker_count
+            start_time = time.perf_counter()
+            events = WatchServerOpenTera.coalesce_events(WatchServerOpenTera.watch_logs_to_events(logs))
+            # Each run posts a new dataset, as the events already posted for a dataset are skipped
+            posted_before = stub.requests.get('event', 0)
+            success = server.post_session_events(device_com, 'BenchWatch', 'dataset_' + str(worker_count), 1,
+                                                 events)
+            posted_count = stub.requests.get('event', 0) - posted_before
+            print(f'{worker_count:>3} workers: {time.perf_counter() - start_time:6.2f}s, {posted_count} events posted '
+                  f'for {len(logs)} logged' + ('' if success else ' (errors)'))
+        server.transfer_journal.close()
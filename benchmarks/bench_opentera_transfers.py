@@ -0,0 +1,57 @@
+##################################################
+# PiHub benchmark - parallel OpenTera device transfers
+##################################################
+# Queues the transfer of the datasets of several devices to a local OpenTera stub (see opentera_stub.py) and reports
+# the time to transfer them all and the average wait of a device, for different numbers of transfer workers. With a
+# single worker, devices are transferred one after the other, like with the former global transfer lock.
+# Requires opentera_libraries (the stub only replaces the communication with the server).
+#
+# Usage: python benchmarks/bench_opentera_transfers.py [--devices 8] [--datasets 2] [--files 4] [--size 262144]
+#                                                      [--rtt 0.05] [--upload-mbps 20] [--workers 1,2,4,8]
+##################################################
+from opentera_stub import StubServer, create_opentera_server, write_dataset, wait_transfers
+
+import argparse
+import logging
+import tempfile
+import time
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Parallel OpenTera device transfers benchmark')
+    parser.add_argument('--devices', type=int, default=8, help='Number of devices with data to transfer')
+    parser.add_argument('--datasets', type=int, default=2, help='Datasets of each device')
+    parser.add_argument('--files', type=int, default=4, help='Data files in each dataset')
+    parser.add_argument('--size', type=int, default=256 * 1024, help='Size of each data file (bytes)')
+    parser.add_argument('--events', type=int, default=20, help='Events logged in each dataset')
+    parser.add_argument('--rtt', type=float, default=0.05, help='Round-trip time to the OpenTera server (s)')
+    parser.add_argument('--upload-mbps', type=float, default=20, help='Throughput of the uplink (Mbit/s)')
+    parser.add_argument('--workers', default='1,2,4,8', help='Comma separated numbers of transfer workers')
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    print(f'{args.devices} devices, {args.datasets} datasets of {args.files} files of {args.size / 1024:.0f} KB and '
+          f'{args.events} events each - RTT {args.rtt * 1000:.0f} ms, uplink {args.upload_mbps:.0f} Mbit/s')
+    for worker_count in [int(workers) for workers in args.workers.split(',')]:
+        with tempfile.TemporaryDirectory() as data_path:
+            stub = StubServer(rtt=args.rtt, upload_mbps=args.upload_mbps)
+            server = create_opentera_server(data_path, stub, transfer_workers=worker_count)
+            devices = ['BenchWatch_' + str(index) for index in range(args.devices)]
+            for device_name in devices:
+                server.update_device_token(device_name, 'token_' + device_name)
+                for dataset in range(args.datasets):
+                    write_dataset(server.data_path, device_name, 'dataset_' + str(dataset), args.files, args.size,
+                                  args.events)
+
+            queue = server.transfer_queue
+            queue.start()
+            start_time = time.perf_counter()
+            for device_name in devices:
+                queue.submit(device_name, device_name)
+            completed = wait_transfers(server, len(devices))
+            duration = time.perf_counter() - start_time
+            server.stop()
+            requests = ', '.join(str(count) + ' ' + kind for kind, count in sorted(stub.requests.items()))
+            print(f'{worker_count:>2} workers: {duration:6.2f}s, average device wait {queue.average_latency:5.2f}s '
+                  f'({requests})' + ('' if completed else ' - timed out') +
+                  (f', {queue.failed_count} failed' if queue.failed_count else ''))
@@ -0,0 +1,208 @@
+##################################################
+# PiHub benchmark - SFTP files upload
+##################################################
+# Sends a dataset of small files with SFTPUploader.sftp_send to a local paramiko SFTP server (stand-in for the data
+# server, storing files in a temporary folder), with different numbers of parallel transfers. Each request of the
+# stand-in waits --latency ms before being answered, to simulate the round-trip time of the Pi cellular link.
+#
+# Usage: python benchmarks/bench_sftp_send.py [--files 200] [--size 16384] [--latency 50] [--parallel 1,2,4,8]
+##################################################
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from libs.uploaders.SFTPConnectionPool import SFTPConnectionPool
+from libs.uploaders.SFTPUploader import SFTPUploader
+
+import argparse
+import logging
+import paramiko
+import posixpath
+import socket
+import tempfile
+import threading
+import time
+
+
+class StandInServer(paramiko.ServerInterface):
+    # Accepts any user and password
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+
+class StandInHandle(paramiko.SFTPHandle):
+
+    def stat(self):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def chattr(self, attr):
+        return StandInSFTPServer.set_attributes(self.filename, attr)
+
+
+class StandInSFTPServer(paramiko.SFTPServerInterface):
+    # Serves the files of root_folder - every request (except reads and writes, which are pipelined by the client)
+    # is delayed by latency seconds
+    root_folder = None
+    latency = 0.
+    request_count = 0
+
+    @staticmethod
+    def local_path(path: str) -> str:
+        return os.path.join(StandInSFTPServer.root_folder, posixpath.normpath('/' + path).lstrip('/'))
+
+    @staticmethod
+    def wait():
+        StandInSFTPServer.request_count += 1
+        time.sleep(StandInSFTPServer.latency)
+
+    @staticmethod
+    def set_attributes(path: str, attr):
+        try:
+            paramiko.SFTPServer.set_file_attr(path, attr)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def list_folder(self, path):
+        self.wait()
+        local_path = self.local_path(path)
+        try:
+            entries = []
+            for file_name in os.listdir(local_path):
+                attr = paramiko.SFTPAttributes.from_stat(os.lstat(os.path.join(local_path, file_name)))
+                attr.filename = file_name
+                entries.append(attr)
+            return entries
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        self.wait()
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self.local_path(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def lstat(self, path):
+        self.wait()
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.lstat(self.local_path(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def open(self, path, flags, attr):
+        self.wait()
+        local_path = self.local_path(path)
+        try:
+            fd = os.open(local_path, flags | getattr(os, 'O_BINARY', 0), 0o644)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+        handle = StandInHandle(flags)
+        handle.filename = local_path
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def remove(self, path):
+        self.wait()
+        try:
+            os.remove(self.local_path(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        self.wait()
+        try:
+            os.rename(self.local_path(oldpath), self.local_path(newpath))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def mkdir(self, path, attr):
+        self.wait()
+        try:
+            os.mkdir(self.local_path(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def chattr(self, path, attr):
+        self.wait()
+        return self.set_attributes(self.local_path(path), attr)
+
+
+def serve(listener: socket.socket, host_key: paramiko.PKey):
+    while True:
+        try:
+            connection, _ = listener.accept()
+        except OSError:
+            return
+        transport = paramiko.Transport(connection)
+        transport.add_server_key(host_key)
+        transport.set_subsystem_handler('sftp', paramiko.SFTPServer, StandInSFTPServer)
+        transport.start_server(server=StandInServer())
+
+
+def create_dataset(folder: str, file_count: int, file_size: int) -> list:
+    files = []
+    for index in range(file_count):
+        filename = os.path.join(folder, 'watch_' + str(index).zfill(4) + '.data')
+        with open(filename, 'wb') as f:
+            f.write(os.urandom(file_size))
+        files.append(filename)
+    return files
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='SFTP dataset upload benchmark')
+    parser.add_argument('--files', type=int, default=200, help='Number of files in the dataset')
+    parser.add_argument('--size', type=int, default=16384, help='Size of each file (bytes)')
+    parser.add_argument('--latency', type=float, default=50, help='Delay before each answer of the server (ms)')
+    parser.add_argument('--parallel', default='1,2,4,8', help='Comma separated numbers of parallel transfers')
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    StandInSFTPServer.latency = args.latency / 1000
+    listener = socket.create_server(('127.0.0.1', 0))
+    threading.Thread(target=serve, args=(listener, paramiko.RSAKey.generate(2048)), daemon=True).start()
+
+    with tempfile.TemporaryDirectory() as local_folder:
+        files = create_dataset(local_folder, args.files, args.size)
+        print(f'{args.files} files of {args.size / 1024:.0f} KB, {args.latency:.0f} ms server latency')
+        for parallel_transfers in [int(count) for count in args.parallel.split(',')]:
+            with tempfile.TemporaryDirectory() as server_folder:
+                StandInSFTPServer.root_folder = server_folder
+                StandInSFTPServer.request_count = 0
+                sftp_config = {'hostname': '127.0.0.1', 'port': listener.getsockname()[1], 'username': 'pihub',
+                               'password': 'pihub', 'parallel_transfers': parallel_transfers}
+                transferred_files = []
+                start_time = time.perf_counter()
+                success = SFTPUploader.sftp_send(sftp_config, ['/Watch/dataset'] * len(files), files,
+                                                 file_transferred_callback=transferred_files.append,
+                                                 check_internet=False)
+                duration = time.perf_counter() - start_time
+                SFTPConnectionPool.close_all()
+                received_count = len(os.listdir(os.path.join(server_folder, 'Watch', 'dataset')))
+                print(f'{parallel_transfers:>3} parallel: {duration:6.2f}s - {args.files / duration:6.1f} files/s, '
+                      f'{args.files * args.size / duration / 1e6:5.2f} MB/s, {StandInSFTPServer.request_count} '
+                      f'requests, {len(transferred_files)} callbacks, {received_count} received' +
+                      ('' if success else ' (FAILED)'))
+    listener.close()
@@ -0,0 +1,98 @@
+##################################################
+# PiHub benchmark - compressed uploads decoding
+##################################################
+# Decodes synthetic watch files (binary sensor data and a text log) with StreamDecoder, for each supported content
+# encoding, and reports the compression ratio, the decoding throughput and CPU time, and the resulting time to
+# receive the file over a link of --link-mbps (transfer of the encoded data plus its decoding). Run it on the Pi to
+# get the decoding cost of its CPU.
+#
+# Usage: python benchmarks/bench_stream_decoder.py [--size 20] [--link-mbps 20] [--buffer-size 262144]
+##################################################
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from libs.utils.StreamDecoder import StreamDecoder, zstandard
+
+import argparse
+import gzip
+import io
+import math
+import random
+import struct
+import time
+
+
+def sensor_data(size: int) -> bytes:
+    # Accelerometer-like samples: timestamp and 3 axes, as float32
+    sample = struct.Struct('<dfff')
+    samples = []
+    for index in range(size // sample.size):
+        t = index / 50.
+        samples.append(sample.pack(1700000000. + t, round(math.sin(t), 3), round(math.cos(t * 0.7), 3),
+                                   round(-1 + random.gauss(0, 0.01), 3)))
+    return b''.join(samples)
+
+
+def log_text(size: int) -> bytes:
+    events = ['Battery level: ', 'Heart rate: ', 'Steps: ', 'Sensor started', 'Sensor stopped', 'Sync request']
+    lines = []
+    length = 0
+    index = 0
+    while length < size:
+        event = events[index % len(events)]
+        line = f'{1700000000 + index * 0.5:.3f}\t{event}' + (str(random.randint(50, 120)) if event[-1] == ' ' else '')
+        lines.append(line)
+        length += len(line) + 1
+        index += 1
+    return ('\n'.join(lines) + '\n').encode()
+
+
+def encode(data: bytes, encoding: str) -> bytes:
+    if encoding == 'gzip':
+        return gzip.compress(data, compresslevel=6)
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    return data
+
+
+def decode(encoded: bytes, encoding: str, buffer_size: int) -> tuple:
+    # Returns (decoded size, duration, CPU time)
+    stream = io.BufferedReader(io.BytesIO(encoded))
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    start_time, start_cpu = time.perf_counter(), time.process_time()
+    source = StreamDecoder(stream, len(encoded), encoding)
+    decoded_size = 0
+    while True:
+        count = source.readinto(view)
+        if not count:
+            break
+        decoded_size += count
+    return decoded_size, time.perf_counter() - start_time, time.process_time() - start_cpu
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compressed uploads decoding benchmark')
+    parser.add_argument('--size', type=float, default=20, help='Size of each decoded file (MB)')
+    parser.add_argument('--link-mbps', type=float, default=20, help='Throughput of the watch link (Mbit/s)')
+    parser.add_argument('--buffer-size', type=int, default=256 * 1024, help='Receive buffer size')
+    args = parser.parse_args()
+
+    random.seed(1)
+    size = int(args.size * 1e6)
+    encodings = StreamDecoder.supported_encodings()
+    if not zstandard:
+        print('zstandard not installed - zstd not tested')
+    for file_name, data in [('watch_Accelerometer.data', sensor_data(size)), ('watch_logs.txt', log_text(size))]:
+        print(f'{file_name} ({len(data) / 1e6:.1f} MB)')
+        for encoding in encodings:
+            encoded = encode(data, encoding)
+            decoded_size, duration, cpu_time = decode(encoded, encoding, args.buffer_size)
+            if decoded_size != len(data):
+                print(f'  {encoding:>8}: decoded {decoded_size} bytes, {len(data)} expected')
+                continue
+            receive_time = len(encoded) * 8 / (args.link_mbps * 1e6) + duration
+            print(f'  {encoding:>8}: ratio {len(data) / len(encoded):5.2f}, decoded at '
+                  f'{len(data) / duration / 1e6:7.1f} MB/s (CPU {cpu_time:.2f}s), received in {receive_time:6.2f}s at '
+                  f'{args.link_mbps:.0f} Mbit/s')
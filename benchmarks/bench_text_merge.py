@@ -0,0 +1,98 @@
+##################################################
+# PiHub benchmark - text files merge
+##################################################
+# Merges synthetic day files (a server copy and a local copy sharing part of their lines, logged at different times)
+# with the legacy in-memory merge of sftp_merge_and_send and with the streaming TextFileMerge, and reports their time
+# and peak memory. The legacy merge is quadratic, so it is only run up to --legacy-max-lines; both merges must produce
+# the same file.
+#
+# Usage: python benchmarks/bench_text_merge.py [--lines 10000,100000,1000000] [--legacy-max-lines 10000]
+##################################################
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from libs.utils.TextFileMerge import TextFileMerge
+
+import argparse
+import filecmp
+import tempfile
+import time
+import tracemalloc
+
+
+def write_day_files(base_file: str, new_file: str, line_count: int, overlap: float):
+    # The new file starts with the last lines of the base file, logged again later (every other line)
+    base_count = int(line_count * (1 + overlap) / 2)
+    first_new = line_count - base_count
+    with open(base_file, 'w') as f:
+        for index in range(base_count):
+            f.write(day_line(index, 0))
+    with open(new_file, 'w') as f:
+        for index in range(first_new, line_count):
+            f.write(day_line(index, 1 if index % 2 else 0))
+
+
+def day_line(index: int, delay: int) -> str:
+    return (f'2024-01-0{1 + delay} {index // 3600 % 24:02d}:{index // 60 % 60:02d}:{index % 60:02d}.'
+            f'{index % 1000000:06d}\t/mnt/app/data/sensor_{index % 16:02d}/{index:08d}.dat\t'
+            f'{index * 7919 % 65536:05d}\n')
+
+
+def merge_legacy(base_file: str, new_file: str, merged_file: str):
+    # Merge of the baseline SFTPUploader.sftp_merge_and_send
+    m_point = "/mnt/app"
+    lines = lambda f: [line for line in open(f).read().splitlines()]
+    lines1 = lines(base_file)
+    lines2 = lines(new_file)
+    checks = [line.split(m_point)[-1] for line in lines1]
+    for item in sum([[line for line in lines2 if c in line] for c in checks], []):
+        lines2.remove(item)
+    file_merged = open(merged_file, "a+")
+    for item in lines1 + lines2:
+        file_merged.write(item + "\n")
+    file_merged.close()
+
+
+def measure(merge, base_file: str, new_file: str, merged_file: str, trace_memory: bool) -> tuple:
+    if trace_memory:
+        tracemalloc.start()
+    start_time = time.perf_counter()
+    merge(base_file, new_file, merged_file)
+    duration = time.perf_counter() - start_time
+    peak_memory = 0
+    if trace_memory:
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return duration, peak_memory
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Text day files merge benchmark')
+    parser.add_argument('--lines', default='10000,100000,1000000', help='Comma separated total numbers of lines')
+    parser.add_argument('--overlap', type=float, default=0.5, help='Part of the lines found in both files')
+    parser.add_argument('--legacy-max-lines', type=int, default=10000,
+                        help='Largest files merged with the legacy merge')
+    parser.add_argument('--no-memory', action='store_true', help="Don't trace the peak memory (faster)")
+    args = parser.parse_args()
+
+    for line_count in [int(count) for count in args.lines.split(',')]:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            base_file = os.path.join(temp_dir, 'server.txt')
+            new_file = os.path.join(temp_dir, 'local.txt')
+            write_day_files(base_file, new_file, line_count, args.overlap)
+            size = os.path.getsize(base_file) + os.path.getsize(new_file)
+            print(f'{line_count:,} lines ({size / 1e6:.1f} MB)')
+
+            streaming_file = os.path.join(temp_dir, 'streaming.txt')
+            duration, peak_memory = measure(TextFileMerge.merge, base_file, new_file, streaming_file,
+                                            not args.no_memory)
+            print(f'  streaming: {duration:8.2f}s' + (f', peak {peak_memory / 1e6:7.1f} MB' if peak_memory else ''))
+
+            if line_count > args.legacy_max_lines:
+                print('     legacy: skipped (see --legacy-max-lines)')
+                continue
+            legacy_file = os.path.join(temp_dir, 'legacy.txt')
+            duration, peak_memory = measure(merge_legacy, base_file, new_file, legacy_file, not args.no_memory)
+            print(f'     legacy: {duration:8.2f}s' + (f', peak {peak_memory / 1e6:7.1f} MB' if peak_memory else '') +
+                  ' - same output: ' + str(filecmp.cmp(legacy_file, streaming_file, shallow=False)))
@@ -0,0 +1,50 @@
+##################################################
+# PiHub benchmark - received files durability
+##################################################
+# Uploads datasets of small files to a local watch server with each durability level ("none", "file" and "full", the
+# latter with batched and with immediate directories synchronizations) and reports the files received per second and
+# the directories synchronizations done. Use --data-path to test on the storage PiHub actually writes to (temporary
+# folders are often on a RAM file system, where synchronizations are free).
+#
+# Usage: python benchmarks/bench_watch_durability.py [--datasets 5] [--files 40] [--size 16384] [--data-path PATH]
+##################################################
+from watch_server import start_watch_server, stop_watch_server, WatchClient
+
+import argparse
+import logging
+import os
+import tempfile
+import time
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Received files durability benchmark')
+    parser.add_argument('--datasets', type=int, default=5, help='Number of datasets (folders) uploaded')
+    parser.add_argument('--files', type=int, default=40, help='Files in each dataset')
+    parser.add_argument('--size', type=int, default=16384, help='Size of each file (bytes)')
+    parser.add_argument('--data-path', help='Folder the data is received in (a temporary folder if not set)')
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    data = os.urandom(args.size)
+    print(f'{args.datasets} datasets of {args.files} files of {args.size / 1024:.0f} KB')
+    for name, durability, sync_delay in [('none', 'none', 1.), ('file', 'file', 1.), ('full', 'full', 1.),
+                                         ('full, no batching', 'full', 0.)]:
+        with tempfile.TemporaryDirectory(dir=args.data_path) as data_path:
+            server, port = start_watch_server(data_path, durability=durability, directory_sync_delay=sync_delay)
+            client = WatchClient(port)
+            errors = 0
+            start_time = time.perf_counter()
+            for dataset in range(args.datasets):
+                errors += client.connect() != 202
+                for index in range(args.files):
+                    errors += client.upload('/dataset_' + str(dataset), 'file_' + str(index) + '.data', data,
+                                            len(data)) != 200
+                # Pending directories synchronizations are done when the watch disconnects
+                errors += client.disconnect() != 202
+            duration = time.perf_counter() - start_time
+            client.close()
+            syncer = server.directory_syncer
+            stop_watch_server(server)
+            print(f'{name:>18}: {args.datasets * args.files / duration:7.1f} files/s, {syncer.synced_count} directory '
+                  f'syncs for {syncer.requested_count} requested' + (f', {errors} errors' if errors else ''))
@@ -0,0 +1,48 @@
+##################################################
+# PiHub benchmark - watch uploads keep-alive
+##################################################
+# Sends sessions of small files (connect, uploads, disconnect) to a local watch server, on a single persistent
+# HTTP/1.1 connection and with a new connection for each request (as HTTP/1.0 clients did), and reports the files
+# uploaded per second. --rtt simulates the round-trip time of the Wi-Fi link (one for each new connection and one for
+# each request).
+#
+# Usage: python benchmarks/bench_watch_keep_alive.py [--sessions 10] [--files 20] [--size 4096] [--rtt 5]
+##################################################
+from watch_server import start_watch_server, stop_watch_server, WatchClient
+
+import argparse
+import logging
+import os
+import tempfile
+import time
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Watch uploads keep-alive benchmark')
+    parser.add_argument('--sessions', type=int, default=10, help='Number of watch sessions')
+    parser.add_argument('--files', type=int, default=20, help='Files uploaded in each session')
+    parser.add_argument('--size', type=int, default=4096, help='Size of each file (bytes)')
+    parser.add_argument('--rtt', type=float, default=5., help='Simulated network round-trip time (ms)')
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    data = os.urandom(args.size)
+    print(f'{args.sessions} sessions of {args.files} files of {args.size / 1024:.0f} KB, {args.rtt:.0f} ms RTT')
+    for name, keep_alive in [('new connections', False), ('keep-alive', True)]:
+        with tempfile.TemporaryDirectory() as data_path:
+            server, port = start_watch_server(data_path, durability='none')
+            client = WatchClient(port, keep_alive=keep_alive, rtt=args.rtt / 1000)
+            errors = 0
+            start_time = time.perf_counter()
+            for session in range(args.sessions):
+                errors += client.connect() != 202
+                for index in range(args.files):
+                    errors += client.upload('/session_' + str(session), 'file_' + str(index) + '.data', data,
+                                            len(data)) != 200
+                errors += client.disconnect() != 202
+                client.close()
+            duration = time.perf_counter() - start_time
+            stop_watch_server(server)
+            files_count = args.sessions * args.files
+            print(f'{name:>16}: {files_count / duration:7.1f} files/s, {client.connection_count} connections' +
+                  (f', {errors} errors' if errors else ''))
@@ -0,0 +1,75 @@
+##################################################
+# PiHub benchmark - watch files uploads receive
+##################################################
+# Uploads files of different sizes from a local client to a watch server and measures the throughput and CPU usage of
+# the receive loop, with the readinto loop of BaseAppleWatchRequestHandler and with the legacy loop (4 KiB read() calls,
+# without preallocation). The CPU usage is the CPU time of the receiving thread over the receive duration.
+#
+# Usage: python benchmarks/bench_watch_receive.py [--sizes 1,10,100,500] [--buffer-size 262144]
+##################################################
+from watch_server import start_watch_server, stop_watch_server, QuietRequestHandler, WatchClient
+
+import argparse
+import logging
+import tempfile
+import time
+
+
+class TimedRequestHandler(QuietRequestHandler):
+    last_receive = None     # (bytes received, duration, CPU time)
+
+    def receive_file(self, fh, source, content_length: int, file_hash=None) -> int:
+        start_time, start_cpu = time.perf_counter(), time.thread_time()
+        received_size = self.receive_loop(fh, source, content_length, file_hash)
+        TimedRequestHandler.last_receive = (received_size, time.perf_counter() - start_time,
+                                            time.thread_time() - start_cpu)
+        return received_size
+
+    def receive_loop(self, fh, source, content_length: int, file_hash=None) -> int:
+        return super().receive_file(fh, source, content_length, file_hash)
+
+
+class LegacyRequestHandler(TimedRequestHandler):
+
+    def receive_loop(self, fh, source, content_length: int, file_hash=None) -> int:
+        # Loop of the baseline do_POST
+        buffer_size = 4 * 1024
+        self.received_size = 0
+        while self.received_size < content_length:
+            data = source.read(min(buffer_size, content_length - self.received_size))
+            if not data:
+                break
+            fh.write(data)
+            if file_hash is not None:
+                file_hash.update(data)
+            self.received_size += len(data)
+        return self.received_size
+
+
+def file_body(size: int, chunk: bytes):
+    for offset in range(0, size, len(chunk)):
+        yield chunk[:size - offset]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Watch uploads receive benchmark')
+    parser.add_argument('--sizes', default='1,10,100,500', help='Comma separated sizes of the uploaded files (MB)')
+    parser.add_argument('--buffer-size', type=int, default=256 * 1024, help='receive_buffer_size of the server')
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    chunk = bytes(range(256)) * 4096    # 1 MB
+    for name, request_handler in [('legacy', LegacyRequestHandler), ('readinto', TimedRequestHandler)]:
+        with tempfile.TemporaryDirectory() as data_path:
+            server, port = start_watch_server(data_path, request_handler, receive_buffer_size=args.buffer_size,
+                                              durability='none')
+            client = WatchClient(port)
+            for size in [int(size) for size in args.sizes.split(',')]:
+                size_bytes = size * 1000 * 1000
+                status = client.upload('/bench', 'upload_' + str(size) + '.data', file_body(size_bytes, chunk),
+                                       size_bytes)
+                received_size, duration, cpu_time = request_handler.last_receive
+                print(f'{name:>8} - {size:>4} MB: {received_size / duration / 1e6:7.1f} MB/s, '
+                      f'CPU {100 * cpu_time / duration:5.1f}%' + ('' if status == 200 else f' (HTTP {status})'))
+            client.close()
+            stop_watch_server(server)
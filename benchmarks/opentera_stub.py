@@ -0,0 +1,164 @@
+##################################################
+# PiHub benchmarks - local OpenTera stub
+##################################################
+# WatchServerOpenTera whose devices clients talk to an in-process stub of the OpenTera device API instead of a real
+# server: each request waits for a simulated round-trip time before being answered, and files are uploaded through a
+# simulated link of limited throughput, shared by all uploads.
+# Datasets like the ones received from the watches are generated in its "ToProcess" folder.
+##################################################
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from libs.servers.WatchServerOpenTera import WatchServerOpenTera
+from libs.uploaders.OpenTeraClientCache import OpenTeraClientCache
+
+from opentera_libraries.common.Constants import SessionCategoryEnum
+import opentera_libraries.device.DeviceAPI as DeviceAPI
+
+import json
+import threading
+import time
+
+
+class StubResponse:
+
+    def __init__(self, status_code: int, payload=None):
+        self.status_code = status_code
+        self.reason = 'OK' if status_code == 200 else 'Error'
+        self._payload = payload if payload is not None else {}
+        self.text = json.dumps(self._payload)
+
+    def json(self):
+        return self._payload
+
+
+class StubServer:
+    # Simulated OpenTera server - shared by all devices clients
+
+    def __init__(self, rtt: float = 0.05, upload_mbps: float = 20., max_concurrent_requests: int = 0):
+        self.rtt = rtt
+        self.upload_mbps = upload_mbps
+        self._lock = threading.Lock()
+        self._link_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_concurrent_requests) if max_concurrent_requests else None
+        self.requests = {}      # Request kind: count
+        self.session_count = 0
+
+    def answer(self, kind: str, size: int = 0, payload=None) -> StubResponse:
+        if self._slots:
+            self._slots.acquire()
+        try:
+            time.sleep(self.rtt)
+            if size:
+                with self._link_lock:
+                    time.sleep(size * 8 / (self.upload_mbps * 1e6))
+        finally:
+            if self._slots:
+                self._slots.release()
+        with self._lock:
+            self.requests[kind] = self.requests.get(kind, 0) + 1
+            if kind == 'session':
+                self.session_count += 1
+                payload = {'id_session': self.session_count}
+        return StubResponse(200, payload)
+
+
+class StubDeviceCom:
+    # Same interface as the DeviceComManager methods used by WatchServerOpenTera
+
+    def __init__(self, server: StubServer):
+        self.server = server
+        self.token = None
+
+    def do_get(self, endpoint: str, params: dict | None = None) -> StubResponse:
+        if endpoint == DeviceAPI.ENDPOINT_DEVICE_LOGIN:
+            return self.server.answer('login', payload={
+                'device_info': {'device_subtype': 'Benchmark'},
+                'participants_info': [{'participant_uuid': '00000000-0000-0000-0000-000000000000'}],
+                'session_types_info': [{'id_session_type': 1,
+                                        'session_type_category': SessionCategoryEnum.DATACOLLECT.value}]})
+        return self.server.answer('get', payload=[])   # Assets of a new session
+
+    def do_post(self, endpoint: str, data: dict) -> StubResponse:
+        if endpoint == DeviceAPI.ENDPOINT_DEVICE_SESSIONS:
+            return self.server.answer('session')
+        if endpoint == DeviceAPI.ENDPOINT_DEVICE_SESSION_EVENTS:
+            return self.server.answer('event', payload=data)
+        return self.server.answer('post', payload=data)
+
+    def upload_file(self, id_session: int, asset_name: str, file_path: str) -> StubResponse:
+        return self.server.answer('upload', os.path.getsize(file_path))
+
+
+class StubClientCache(OpenTeraClientCache):
+
+    def __init__(self, server: StubServer, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.server = server
+
+    def client(self, device_name: str, token: str) -> StubDeviceCom:
+        with self._lock:
+            device_com = self._clients.get(device_name)
+            if not device_com or device_com.token != token:
+                device_com = StubDeviceCom(self.server)
+                device_com.token = token
+                self._clients[device_name] = device_com
+            return device_com
+
+
+def create_opentera_server(data_path: str, stub_server: StubServer, **server_config) -> WatchServerOpenTera:
+    # Server working in data_path (its encryption key is created in data_path/config), without HTTP server
+    config = {'hostname': '127.0.0.1', 'port': 0, 'data_path': os.path.join(data_path, 'watch'),
+              'server_base_folder': 'Watch', 'send_logs_only': False, 'minimal_dataset_duration': 0,
+              'min_free_space_mb': 0, 'durability': 'none'}
+    config.update(server_config)
+    opentera_config = {'hostname': '127.0.0.1', 'port': 40075, 'device_register_key': '', 'default_session_type_id': 1}
+    os.makedirs(os.path.join(data_path, 'config'), exist_ok=True)
+    current_dir = os.getcwd()
+    os.chdir(data_path)
+    try:
+        server = WatchServerOpenTera(server_config=config, opentera_config=opentera_config)
+    finally:
+        os.chdir(current_dir)
+    server.opentera_clients = StubClientCache(stub_server, '127.0.0.1', 40075, True)
+    return server
+
+
+def watch_logs(event_count: int, repeat: int = 1) -> list:
+    # Watch log lines (timestamp, event type, context, time string, text) - each event is logged repeat times in a row
+    lines = []
+    for index in range(event_count):
+        timestamp = 1700000000 + index * 60
+        event = ['Battery level: ' + str(100 - index % 100) + '%', 'Heart rate monitoring', 'Sensor sync',
+                 'Wrist detection'][index % 4]
+        for repeated in range(repeat):
+            lines.append(str(timestamp + repeated) + '\t' + str(1 + index % 11) + '\tBenchmark\t' +
+                         time.strftime('%H:%M:%S', time.gmtime(timestamp + repeated)) + '\t' + event)
+    return lines
+
+
+def write_dataset(data_path: str, device_name: str, dataset: str, file_count: int, file_size: int,
+                  event_count: int, repeat: int = 1):
+    folder = os.path.join(data_path, 'ToProcess', device_name, dataset)
+    os.makedirs(folder, exist_ok=True)
+    files = ['watch_' + str(index) + '.data' for index in range(file_count)] + ['watch_logs.txt']
+    for file_name in files[:-1]:
+        with open(os.path.join(folder, file_name), 'wb') as f:
+            f.write(os.urandom(file_size))
+    with open(os.path.join(folder, 'watch_logs.txt'), 'w') as f:
+        f.write('\n'.join(watch_logs(event_count, repeat)) + '\n')
+    with open(os.path.join(folder, 'session.oimi'), 'w') as f:
+        json.dump({'files': files, 'description': 'Benchmark session. Settings:{rate:50}', 'appVersion': '1.0',
+                   'timestamp': '2024-01-01_12:00:00'}, f)
+
+
+def wait_transfers(server: WatchServerOpenTera, job_count: int, timeout: float = 3600.) -> bool:
+    # Wait until job_count transfer jobs were processed
+    end_time = time.monotonic() + timeout
+    queue = server.transfer_queue
+    while queue.completed_count + queue.failed_count < job_count:
+        if time.monotonic() > end_time:
+            return False
+        time.sleep(0.01)
+    return True
@@ -0,0 +1,86 @@
+##################################################
+# PiHub benchmarks - local watch server and client
+##################################################
+# Starts a WatchServerBase (files are received in a temporary folder, nothing is transferred) and sends it requests
+# the way the watches do.
+##################################################
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from libs.servers.WatchServerBase import WatchServerBase
+from libs.servers.handlers.BaseAppleWatchRequestHandler import BaseAppleWatchRequestHandler
+
+import http.client
+import time
+
+
+class QuietRequestHandler(BaseAppleWatchRequestHandler):
+
+    def log_message(self, format, *args):
+        pass    # No access log on stderr
+
+
+def start_watch_server(data_path: str, request_handler=QuietRequestHandler, **server_config) -> tuple:
+    # Returns (server, port)
+    config = {'hostname': '127.0.0.1', 'port': 0, 'data_path': data_path, 'server_base_folder': 'Watch',
+              'send_logs_only': False, 'minimal_dataset_duration': 0, 'min_free_space_mb': 0}
+    config.update(server_config)
+    server = WatchServerBase(server_config=config, request_handler=request_handler)
+    server.start()
+    while not server.is_running or not server.server:
+        time.sleep(0.01)
+    return server, server.server.server_address[1]
+
+
+def stop_watch_server(server: WatchServerBase):
+    server.stop()
+    server.received_files.close()
+
+
+class WatchClient:
+    # Requests of a watch - on a single persistent connection, or on a new connection for each request. A network
+    # round-trip time can be simulated: rtt seconds are waited for each new connection (TCP handshake) and request.
+
+    def __init__(self, port: int, device_name: str = 'BenchWatch', keep_alive: bool = True, rtt: float = 0.):
+        self.port = port
+        self.device_name = device_name
+        self.keep_alive = keep_alive
+        self.rtt = rtt
+        self.connection_count = 0
+        self._connection = None
+
+    def request(self, method: str, headers: dict, body=None) -> http.client.HTTPResponse:
+        if not self._connection or not self.keep_alive:
+            self.close()
+            time.sleep(self.rtt)
+            self._connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=60)
+            self.connection_count += 1
+        time.sleep(self.rtt)
+        headers = dict(headers, **{'Device-Name': self.device_name})
+        if not self.keep_alive:
+            headers['Connection'] = 'close'
+        self._connection.request(method, '/', body=body, headers=headers)
+        response = self._connection.getresponse()
+        response.read()
+        if response.will_close:
+            self.close()
+        return response
+
+    def connect(self) -> int:
+        return self.request('GET', {'Content-Type': 'cdrv-cmd/Connect'}).status
+
+    def disconnect(self) -> int:
+        return self.request('GET', {'Content-Type': 'cdrv-cmd/Disconnect'}).status
+
+    def upload(self, file_path: str, file_name: str, body, length: int, headers: dict | None = None) -> int:
+        # body: bytes, or iterable of bytes of length bytes in total
+        upload_headers = {'Content-Type': 'cdrv-cmd/File-Upload', 'Content-Length': str(length), 'File-Type': 'data',
+                          'Device-Type': 'AppleWatch', 'File-Path': file_path, 'File-Name': file_name}
+        upload_headers.update(headers or {})
+        return self.request('POST', upload_headers, body).status
+
+    def close(self):
+        if self._connection:
+            self._connection.close()
+            self._connection = None
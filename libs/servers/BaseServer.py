@@ -3,6 +3,7 @@
 ##################################################
 # Authors: Simon Brière, Eng. MASc.
 ##################################################
+from libs.utils.StorageBudget import StorageBudget
 
 import threading
 from os import makedirs
@@ -15,6 +16,8 @@ class BaseServer(threading.Thread):
         self.port = server_config['port']
         self.hostname = server_config['hostname']
         self.data_path = server_config['data_path']
+        # Data isn't accepted anymore below that free space
+        self.min_free_space = int(server_config.get('min_free_space_mb', 100) * 1024 * 1024)
         self.is_running = False
         super().__init__()
         self.setName(self.__class__.__name__ + 'Thread')
@@ -28,3 +31,6 @@ class BaseServer(threading.Thread):
 
     def stop(self):
         self.is_running = False
+
+    def has_free_space(self, size: int = 0) -> bool:
+        return StorageBudget.has_space(self.data_path, self.min_free_space, size)
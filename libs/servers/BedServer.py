@@ -6,16 +6,23 @@
 ##################################################
 from libs.servers.BaseServer import BaseServer
 from libs.uploaders.SFTPUploader import SFTPUploader
+from libs.utils.BedSamples import BedSamples
+from libs.utils.BedDataFile import BedDataFile, BedTextFile
+from libs.utils.JobQueue import JobQueue
+from libs.utils.Metrics import Metrics
+from libs.utils.Network import Network
 
 import logging
 import socketserver
 from os import makedirs
 from datetime import datetime
-from pathlib import Path
 
+import asyncio
 import threading
 import os
 import socket
+import tempfile
+import time
 
 
 class BedServer(BaseServer):
@@ -25,34 +32,66 @@ class BedServer(BaseServer):
         super().__init__(server_config=server_config)
         self.sftp_config = sftp_config
         self.server_base_folder = server_config['server_base_folder']
+        # "text" (tab-separated values) or "binary" (see BedDataFile)
+        self.storage_format = server_config.get('storage_format', 'text')
+        # "threaded" (one thread per connection) or "asyncio" (single event loop)
+        self.server_mode = server_config.get('server_mode', 'threaded')
+        # Maximum number of sensor connections received at the same time in "asyncio" mode
+        self.max_connections = server_config.get('max_connections', 256)
+        self.receive_timeout = 10
+        self.receive_buffer_size = 64 * 1024
+        self._loop = None
+        self._connection_slots = None
+
+        # Uploads are done in the background, so connections are released as soon as data is received
+        self.upload_queue = JobQueue(name='BedServerUpload', job_handler=self.transfer_data_file,
+                                     worker_count=server_config.get('upload_workers', 2))
+        # Only append new data to the server files instead of downloading and merging them on each upload
+        self.incremental_upload = server_config.get('incremental_upload', False)
+        # Local data files being received, with their number of connections. Each connection writes its block to its
+        # own connection file, which is added to the local data file once the connection is done.
+        self._open_data_files = {}
+        self._data_files_lock = threading.Lock()
 
     def sync_files(self):
         logging.info("BedServer: Synchronizing files with server...")
-        full_path = Path(self.data_path)
+        logging.info("BedServer: Testing the internet connection...")
+        while not (Network.is_internet_connected()):
+            logging.info("BedServer: Connection failed, retry sync in 10min...")
+            time.sleep(600)
 
-        # Sync local files with the ones on the server
-        try:
-            SFTPUploader.sftp_sync_last(sftp_config=self.sftp_config, local_base_path=str(full_path.absolute()),
-                                        remote_base_path=self.server_base_folder, check_internet=False)
-            # SFTPUploader.sftp_sync(sftp_config=self.sftp_config, local_base_path=str(full_path.absolute()),
-            #                      remote_base_path=self.server_base_folder)
-        except Exception as e:
-            logging.error("Bedserver: Unable to synchronize files - " + str(e))
-        logging.info("BedServer: Synchronization done.")
+        # Queue all local files, including the ones of interrupted uploads
+        for folder in ['local_only', 'uploading']:
+            base_folder = self.data_path + '/' + folder
+            if not os.path.isdir(base_folder):
+                continue
+            for device_name in os.listdir(base_folder):
+                if not os.path.isdir(base_folder + '/' + device_name):
+                    continue
+                for data_file_name in os.listdir(base_folder + '/' + device_name):
+                    if data_file_name.endswith(BedTextFile.extension) or \
+                            data_file_name.endswith(BedDataFile.extension):
+                        if data_file_name != 'tempData.txt':
+                            self.upload_queue.submit((device_name, data_file_name), device_name, data_file_name)
+        logging.info("BedServer: Synchronization queued (" + str(self.upload_queue.depth) + " files).")
 
     def run(self):
         logging.info('BedServer starting...')
+        self.recover_connection_files()
+        self.upload_queue.start()
 
         # Check if all files are on sync on the server, do it on a thread so the logger still start
         thread_sync = threading.Thread(target=self.sync_files)
         thread_sync.start()
 
+        if self.server_mode == 'asyncio':
+            self.run_asyncio()
+            return
+
         try:
             # Add custom values that are need in the request handler
             request_handler = BedServerRequestHandler
-            request_handler.sftp_config = self.sftp_config
-            request_handler.data_path = self.data_path
-            request_handler.server_base_folder = self.server_base_folder
+            request_handler.base_server = self
 
             self.server = socketserver.ThreadingTCPServer(server_address=(self.hostname, self.port),
                                                           RequestHandlerClass=request_handler)
@@ -73,89 +112,288 @@ class BedServer(BaseServer):
         finally:
             logging.info("BedServer stopped.")
 
+    def run_asyncio(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        try:
+            self.server = self._loop.run_until_complete(
+                asyncio.start_server(self.handle_connection, host=self.hostname, port=self.port,
+                                     limit=self.receive_buffer_size))
+        except OSError as e:
+            logging.critical(e.strerror)
+            self._loop.close()
+            return
+        except OverflowError as e:
+            logging.critical(str(e))
+            self._loop.close()
+            return
+
+        self._connection_slots = asyncio.Semaphore(self.max_connections)
+        self.is_running = True
+        logging.info("BedServer started on port " + str(self.port) + " (asyncio, max " + str(self.max_connections) +
+                     " connections)")
+        try:
+            self._loop.run_until_complete(self.server.serve_forever())
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self._loop.run_until_complete(self.server.wait_closed())
+            self._loop.close()
+            logging.info("BedServer stopped.")
+
     def stop(self):
         super().stop()
+        self.upload_queue.stop()
 
         if self.server:
-            self.server.shutdown()
-            self.server.server_close()
-
+            if self._loop:
+                self._loop.call_soon_threadsafe(self.server.close)
+            else:
+                self.server.shutdown()
+                self.server.server_close()
 
-class BedServerRequestHandler(socketserver.StreamRequestHandler):
-    data_path: str = None
-    sftp_config: dict = None
-    server_base_folder: str = None
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            # Connections over the limit wait here, without being read from, until a slot is free
+            async with self._connection_slots:
+                await self.receive_from_device(reader, writer)
+        finally:
+            writer.close()
 
-    def handle(self) -> None:
+    async def receive_from_device(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
         # Greet device
-        logging.info('Got connection from: ' + self.client_address[0])
-        greetings = self.request.recv(22)
-        # greetings = self.rfile.read(1).strip()
+        logging.info('Got connection from: ' + writer.get_extra_info('peername')[0])
+        try:
+            greetings = await asyncio.wait_for(reader.read(22), self.receive_timeout)
+        except (asyncio.TimeoutError, ConnectionError):
+            logging.error("Timeout receiving greetings.")
+            return
         greetings = greetings.decode('utf-8')
         logging.info('Device identified as: ' + greetings)
 
+        if not self.has_free_space():
+            logging.warning('Not enough free space to receive data - refusing connection from ' + greetings)
+            Metrics.inc('pihub_bed_refused_connections_total', description='Bed connections refused (low space)')
+            return
+
+        file, data_file_name = self.open_data_file(greetings)
+
+        logging.info('Starting data transfer...')
+        start_time = time.monotonic()
+        received_size = 0
+        try:
+            pending = b''  # Incomplete sample from the previous chunk
+            while True:
+                try:
+                    data = await asyncio.wait_for(reader.read(self.receive_buffer_size), self.receive_timeout)
+                except (asyncio.TimeoutError, ConnectionError):
+                    logging.error("Timeout receiving data.")
+                    break
+                if not data:
+                    break
+                received_size += len(data)
+                if pending:
+                    data = pending + data
+                complete = len(data) - len(data) % BedSamples.sample_size
+                file.write_samples(memoryview(data)[:complete])
+                pending = data[complete:]
+            if pending:
+                # Incomplete last sample - keep it as a single byte value
+                file.write_samples(pending + b'\0')
+            logging.info("Data transfer complete.")
+        finally:
+            # Adding the block to the data file is blocking - don't stall the other connections
+            await asyncio.get_running_loop().run_in_executor(None, self.close_data_file, greetings, data_file_name,
+                                                             file)
+            self.record_connection(greetings, received_size, time.monotonic() - start_time)
+
+    def open_data_file(self, device_name: str):
         # Establish the correct filename (will be updated each time the sensor is connected
         # Will append the file or create a new one if non-existing
-        # filename = Path("/home/pi/Desktop/Data/"+str(datetime.datetime.now().date())+".txt")
-        filepath = self.data_path + '/local_only/' + str(greetings)
+        filepath = self.data_path + '/local_only/' + device_name
         try:
             makedirs(name=filepath, exist_ok=True)
         except OSError as exc:
             logging.error('Error creating ' + filepath + ': ' + exc.strerror)
-            self.rfile.close()
             raise
 
-        filename = filepath + "/" + str(datetime.now().date()) + ".txt"
+        data_file_class = BedDataFile if self.storage_format == 'binary' else BedTextFile
+        data_file_name = str(datetime.now().date()) + data_file_class.extension
+        filename = filepath + "/" + data_file_name
         try:
-            file = open(filename, 'a')
-            file.write(str(datetime.now()) + "\t")
+            fd, connection_filename = tempfile.mkstemp(suffix=self.connection_file_suffix,
+                                                       prefix=data_file_name + '.', dir=filepath)
+            os.close(fd)
+            file = data_file_class(connection_filename)
+            file.start_block(datetime.now())
         except IOError as exc:
-            logging.error('Error writing to file' + filename + ': ' + exc.strerror)
+            logging.error('Error writing to file' + filename + ': ' + str(exc))
+            raise
+        with self._data_files_lock:
+            self._open_data_files[filename] = self._open_data_files.get(filename, 0) + 1
+        return file, data_file_name
+
+    @staticmethod
+    def record_connection(device_name: str, received_size: int, duration: float):
+        Metrics.inc('pihub_bed_received_bytes_total', received_size, 'Bytes received from bed sensors',
+                    device=device_name)
+        Metrics.observe('pihub_bed_connection_seconds', duration, 'Duration of bed sensors connections')
+
+    def close_data_file(self, device_name: str, data_file_name: str, file):
+        filename = self.data_path + '/local_only/' + device_name + "/" + data_file_name
+        try:
+            file.close()
+        finally:
+            with self._data_files_lock:
+                try:
+                    self.add_data_file(file.filename, filename)
+                except OSError as exc:
+                    # Connection file is kept, and will be recovered on next start
+                    logging.error('Error adding ' + file.filename + ' to ' + filename + ': ' + str(exc))
+                finally:
+                    self._open_data_files[filename] -= 1
+                    if not self._open_data_files[filename]:
+                        del self._open_data_files[filename]
+
+        # Mark the device/day file as dirty - the upload queue will send it
+        self.upload_queue.submit((device_name, data_file_name), device_name, data_file_name)
+        logging.info("BedServer: " + data_file_name + " from " + device_name + " queued for upload (" +
+                     str(self.upload_queue.depth) + " waiting)")
+
+    connection_file_suffix = '.connection'
+
+    @staticmethod
+    def add_data_file(source_filename: str, filename: str):
+        # Add the data of source file to file, and remove source file
+        if not os.path.isfile(source_filename):
+            return
+        if not os.path.isfile(filename) or not os.path.getsize(filename):
+            os.replace(source_filename, filename)
+            return
+        data_file_class = BedDataFile if filename.endswith(BedDataFile.extension) else BedTextFile
+        data_file_class.append(source_filename, filename)
+        os.remove(source_filename)
+
+    def recover_connection_files(self):
+        # Connection files left by an interrupted run are added to their data file
+        base_folder = self.data_path + '/local_only'
+        if not os.path.isdir(base_folder):
+            return
+        for device_name in os.listdir(base_folder):
+            device_folder = base_folder + '/' + device_name
+            if not os.path.isdir(device_folder):
+                continue
+            for connection_file_name in sorted(os.listdir(device_folder)):
+                if not connection_file_name.endswith(self.connection_file_suffix):
+                    continue
+                data_file_name = connection_file_name.split('.')[0] + '.' + connection_file_name.split('.')[1]
+                logging.info('BedServer: Recovering ' + device_name + '/' + connection_file_name)
+                with self._data_files_lock:
+                    try:
+                        self.add_data_file(device_folder + '/' + connection_file_name,
+                                           device_folder + '/' + data_file_name)
+                    except (OSError, IOError) as exc:
+                        logging.error('Error recovering ' + connection_file_name + ': ' + str(exc))
+
+    def transfer_data_file(self, device_name: str, data_file_name: str) -> bool:
+        filename = self.data_path + '/local_only/' + device_name + "/" + data_file_name
+        upload_directory = self.data_path + '/uploading/' + device_name
+        upload_file = upload_directory + "/" + data_file_name
+
+        pending_file = upload_file + '.pending'
+
+        # Data moved out of the way by an interrupted run
+        self.add_data_file(pending_file, upload_file)
+
+        # Move the received data out of the way, so connections can keep on adding to the local file while the
+        # upload is in progress. Only a rename is done while holding the lock.
+        with self._data_files_lock:
+            if filename in self._open_data_files:
+                # Still receiving - will be queued again once that connection is done
+                return True
+            if os.path.isfile(filename):
+                makedirs(upload_directory, exist_ok=True)
+                # Previous upload failed - the new data is added to it
+                os.replace(filename, pending_file if os.path.isfile(upload_file) else upload_file)
+        self.add_data_file(pending_file, upload_file)
+        if not os.path.isfile(upload_file):
+            return True
+
+        # Send file using SFTP
+        file_server_directory = self.server_base_folder + "/" + device_name
+        file_server_path = file_server_directory + "/" + data_file_name
+        temp_file = upload_directory + "/tempData.txt"
+        file_transferred_directory = self.data_path + "/transferred/" + device_name
+        logging.info("Try to create " + file_transferred_directory + ", dir exists = " +
+                     str(not os.path.isdir(file_transferred_directory)))
+        if not os.path.isdir(file_transferred_directory):
+            makedirs(file_transferred_directory)
+        file_transferred_location = file_transferred_directory + "/" + data_file_name
+
+        # Add a file merge before transfer
+        return SFTPUploader.sftp_merge_and_send(sftp_config=self.sftp_config, file_path_on_server=file_server_path,
+                                                file_server_location=file_server_directory, temporary_file=temp_file,
+                                                file_transferred_location=file_transferred_location,
+                                                file_to_transfer=upload_file, incremental=self.incremental_upload)
+
+
+class BedServerRequestHandler(socketserver.StreamRequestHandler):
+    base_server: BedServer = None
+
+    def handle(self) -> None:
+        # Greet device
+        logging.info('Got connection from: ' + self.client_address[0])
+        greetings = self.request.recv(22)
+        # greetings = self.rfile.read(1).strip()
+        greetings = greetings.decode('utf-8')
+        logging.info('Device identified as: ' + greetings)
+
+        if not self.base_server.has_free_space():
+            logging.warning('Not enough free space to receive data - refusing connection from ' + greetings)
+            Metrics.inc('pihub_bed_refused_connections_total', description='Bed connections refused (low space)')
+            return
+
+        try:
+            file, data_file_name = self.base_server.open_data_file(greetings)
+        except (OSError, IOError):
             self.rfile.close()
             raise
 
-        # Loop to transfer data (2 bytes at a time - UINT16 are read from RAM and transmitted by ESP
+        start_time = time.monotonic()
+        received_size = 0
+        try:
+            received_size = self.receive_samples(file)
+        finally:
+            self.base_server.close_data_file(greetings, data_file_name, file)
+            self.base_server.record_connection(greetings, received_size, time.monotonic() - start_time)
+
+    def receive_samples(self, file) -> int:
+        # Loop to transfer data - UINT16 are read from RAM and transmitted by ESP. Receive as much as possible at once
+        # in a preallocated buffer and decode all complete samples in a single step. Returns the number of bytes
+        # received.
         logging.info('Starting data transfer...')
-        self.request.settimeout(10)
+        self.request.settimeout(self.base_server.receive_timeout)
+        buffer = bytearray(self.base_server.receive_buffer_size)
+        view = memoryview(buffer)
+        pending = 0  # Bytes of an incomplete sample kept at the start of the buffer
+        received_size = 0
         while self.connection:
             try:
-                d1minidata = self.request.recv(2)  # self.rfile.read(2)
-                if len(d1minidata) == 0:
-                    break
-                else:
-                    x = int.from_bytes(d1minidata, byteorder='little', signed=False)
-                    file.write(str(x) + "\t")
+                count = self.request.recv_into(view[pending:])
             except (socket.timeout, TimeoutError, ConnectionResetError, ConnectionAbortedError, ConnectionError):
                 logging.error("Timeout receiving data.")
-                # self.request.settimeout(1.0)
-                # while 1:
-                #     try:
-                #         self.request.recv(1)  # Clear all pending bytes, if available.
-                #     except (TimeoutError, ConnectionResetError, ConnectionAbortedError, ConnectionError):
-                #         break
                 self.rfile.close()
-                # logging.error("Remote stream closed")
                 break
+            if count == 0:
+                break
+            received_size += count
+            count += pending
+            pending = count % BedSamples.sample_size
+            file.write_samples(view[:count - pending])
+            if pending:
+                view[:pending] = view[count - pending:count]
+        if pending:
+            # Incomplete last sample - keep it as a single byte value
+            file.write_samples(bytes([buffer[0], 0]))
         logging.info("Data transfer complete.")
-        file.write("\n")
-        file.close()
-
-        # Send file using SFTP
-        file_server_directory = self.server_base_folder + "/" + str(greetings)
-        file_server_path = file_server_directory + "/" + str(datetime.now().date()) + ".txt"
-        temp_file = self.data_path + "/local_only/" + str(greetings) + "/tempData.txt"
-        file_transferred_directory = self.data_path + "/transferred/" + str(greetings)
-        logging.info("Try to create " + file_transferred_directory + ", dir exists = " +
-                     str(not os.path.isdir(file_transferred_directory)))
-        if not os.path.isdir(file_transferred_directory):
-            makedirs(file_transferred_directory)
-        file_transferred_location = file_transferred_directory + "/" + str(datetime.now().date()) + ".txt"
-        # Start SFTP transfer in a new thread, so this one doesn't wait on the transfer
-        # sftp = threading.Thread(target=SFTPUploader.sftp_send, args=(self.sftp_config, file_server_location,
-        #                                                              filename))
-        # sftp.start()
-
-        # Add a file merge before transfer
-        SFTPUploader.sftp_merge_and_send(sftp_config=self.sftp_config, file_path_on_server=file_server_path,
-                                         file_server_location=file_server_directory, temporary_file=temp_file,
-                                         file_transferred_location=file_transferred_location, file_to_transfer=filename)
+        return received_size
@@ -0,0 +1,95 @@
+##################################################
+# PiHub HTTP server with bounded concurrency
+##################################################
+from concurrent.futures import ThreadPoolExecutor
+from http.server import HTTPServer
+
+import logging
+import threading
+
+
+class BoundedHTTPServer(HTTPServer):
+    # HTTP server handling connections with a fixed pool of worker threads instead of a new thread per connection.
+    # Connections accepted while all workers are busy wait in a bounded queue - past that, they are answered with a
+    # "503 Service Unavailable" and a Retry-After delay, so devices come back later instead of exhausting the hub.
+
+    def __init__(self, server_address, request_handler_class, max_workers: int = 16, max_queued_connections: int = 64,
+                 retry_after: int = 30):
+        self.max_workers = max(1, max_workers)
+        self.max_queued_connections = max(0, max_queued_connections)
+        self.retry_after = retry_after
+        # Connections not yet accepted also wait in the listen backlog
+        self.request_queue_size = max(5, self.max_queued_connections)
+
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='BoundedHTTPServer')
+        self._lock = threading.Lock()
+        self._active_count = 0      # Connections running or waiting for a worker
+
+        # Statistics
+        self.accepted_count = 0
+        self.rejected_count = 0
+
+        super().__init__(server_address, request_handler_class)
+
+    @property
+    def active_count(self) -> int:
+        with self._lock:
+            return min(self._active_count, self.max_workers)
+
+    @property
+    def queued_count(self) -> int:
+        with self._lock:
+            return max(0, self._active_count - self.max_workers)
+
+    def process_request(self, request, client_address):
+        with self._lock:
+            admitted = self._active_count < self.max_workers + self.max_queued_connections
+            if admitted:
+                self._active_count += 1
+                self.accepted_count += 1
+            else:
+                self.rejected_count += 1
+        if not admitted:
+            logging.warning(self.__class__.__name__ + ': too many connections - rejecting ' + str(client_address[0]))
+            self.reject_request(request)
+            return
+
+        try:
+            future = self._executor.submit(self.process_request_worker, request, client_address)
+        except RuntimeError:
+            # Server closing
+            self._request_done()
+            self.shutdown_request(request)
+            return
+        # Connections still waiting when the server closes are never processed - close them
+        future.add_done_callback(lambda f: f.cancelled() and self._cancel_request(request))
+
+    def process_request_worker(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._request_done()
+
+    def reject_request(self, request):
+        try:
+            request.settimeout(1)
+            request.sendall(('HTTP/1.1 503 Service Unavailable\r\nRetry-After: ' + str(self.retry_after) +
+                             '\r\nContent-Length: 0\r\nConnection: close\r\n\r\n').encode())
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _cancel_request(self, request):
+        self._request_done()
+        self.shutdown_request(request)
+
+    def _request_done(self):
+        with self._lock:
+            self._active_count -= 1
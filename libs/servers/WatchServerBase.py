@@ -1,31 +1,71 @@
 from libs.servers.BaseServer import BaseServer
-from http.server import ThreadingHTTPServer
+from libs.servers.BoundedHTTPServer import BoundedHTTPServer
+from libs.utils.DeviceRegistry import DeviceRegistry
+from libs.utils.DirectorySyncer import DirectorySyncer
+from libs.utils.ReceivedFilesIndex import ReceivedFilesIndex
+from http.server import HTTPServer, ThreadingHTTPServer
 
 import logging
 import os
+import threading
+import time
 
 
 class WatchServerBase(BaseServer):
-    server: ThreadingHTTPServer | None = None
+    server: HTTPServer | None = None
     _request_handler = None
-    processed_files = []
-    _connected_devices = []
 
     def __init__(self, server_config: dict, request_handler):
         super().__init__(server_config=server_config)
         self.server_base_folder = server_config['server_base_folder']
         self.send_logs_only = server_config['send_logs_only']
         self.minimal_dataset_duration = server_config['minimal_dataset_duration']
+        self.receive_buffer_size = server_config.get('receive_buffer_size', 256 * 1024)
+        self.received_files = ReceivedFilesIndex(os.path.join(self.data_path, 'Index'))
+        # Seconds the index entry of a file that wasn't processed is kept
+        self.received_files_max_age = server_config.get('received_files_max_age', 30 * 24 * 3600)
+        # Seconds after which an interrupted upload that wasn't resumed is abandoned
+        self.partial_file_max_age = server_config.get('partial_file_max_age', 7 * 24 * 3600)
+        self.devices = DeviceRegistry()
+        self.processed_files = []
+        self._processed_files_lock = threading.Lock()
+
+        # Durability of received files - "none" (left to the OS), "file" (files synced before being moved to be
+        # processed) or "full" (folders also synced, in batch)
+        self.durability = server_config.get('durability', 'file')
+        self.directory_syncer = DirectorySyncer(server_config.get('directory_sync_delay', 1.))
+
+        # Server engine - "threading" (one thread per connection) or "bounded" (fixed pool of workers, with admission
+        # control)
+        self.server_engine = server_config.get('server_engine', 'threading')
+        self.max_workers = server_config.get('max_workers', 16)
+        self.max_queued_connections = server_config.get('max_queued_connections', 64)
+        self.connection_timeout = server_config.get('connection_timeout', None)
+        self.retry_after = server_config.get('retry_after', 30)
+        self.keep_alive_timeout = server_config.get('keep_alive_timeout', 15)
+        self.max_keep_alive_requests = server_config.get('max_keep_alive_requests', 100)
+        max_concurrent_uploads = server_config.get('max_concurrent_uploads', 0)
+        self.upload_slots = threading.BoundedSemaphore(max_concurrent_uploads) if max_concurrent_uploads else None
 
         self._request_handler = request_handler
         self._request_handler.base_server = self
+        if self.connection_timeout:
+            # Socket timeout of each connection - a stalled device can't hold a worker forever
+            self._request_handler.timeout = self.connection_timeout
 
     def run(self):
         logging.info(self.__class__.__name__ + ' starting...')
-        self.server = ThreadingHTTPServer((self.hostname, self.port), self._request_handler)
+        if self.server_engine == 'bounded':
+            self.server = BoundedHTTPServer((self.hostname, self.port), self._request_handler,
+                                            max_workers=self.max_workers,
+                                            max_queued_connections=self.max_queued_connections,
+                                            retry_after=self.retry_after)
+        else:
+            self.server = ThreadingHTTPServer((self.hostname, self.port), self._request_handler)
         self.server.timeout = 5  # 5 seconds timeout should be ok since we are usually on local network
         self.is_running = True
-        logging.info(self.__class__.__name__ + ' started on port ' + str(self.port))
+        logging.info(self.__class__.__name__ + ' started on port ' + str(self.port) + ' (' + self.server_engine +
+                     ' engine)')
 
         # Thread will wait here
         self.server.serve_forever()
@@ -34,6 +74,7 @@ class WatchServerBase(BaseServer):
 
     def stop(self):
         super().stop()
+        self.directory_syncer.flush()
 
         if self.server:
             self.server.shutdown()
@@ -41,20 +82,46 @@ class WatchServerBase(BaseServer):
 
     def new_file_received(self, device_name: str, filename: str):
         # logging.debug(self.__class__.__name__ + ' - unhandled new file received')
-        if device_name not in self._connected_devices:
-            self._connected_devices.append(device_name)
+        self.devices.connected(device_name)
 
     def device_disconnected(self, device_name: str):
         # logging.debug(self.__class__.__name__ + ' - unhandled device disconnected')
-        if device_name in self._connected_devices:
-            self._connected_devices.remove(device_name)
+        self.directory_syncer.flush()
+        self.devices.disconnected(device_name)
 
     def device_connected(self, device_name: str):
-        if device_name not in self._connected_devices:
-            self._connected_devices.append(device_name)
+        self.devices.connected(device_name)
+
+    def received_file_key(self, full_filepath: str) -> tuple:
+        # (device name, relative path) of a file (or folder) in the "ToProcess" folder
+        relative_path = os.path.relpath(full_filepath, os.path.join(self.data_path, 'ToProcess'))
+        device_name, _, relative_path = relative_path.replace(os.sep, '/').partition('/')
+        return device_name, relative_path
+
+    def received_file_infos(self, full_filepath: str) -> dict | None:
+        # Index entry ({'size', 'hash', 'received'}) of a file in the "ToProcess" folder
+        return self.received_files.get(*self.received_file_key(full_filepath))
+
+    def received_file_processed(self, full_filepath: str):
+        # File (or folder) processed - its index entries are kept, so the devices still know it was received
+        self.received_files.set_processed(*self.received_file_key(full_filepath))
+
+    def check_received_file(self, full_filepath: str) -> bool:
+        # Check that a file wasn't altered since it was received, without reading it again
+        file_infos = self.received_file_infos(full_filepath)
+        if not file_infos:
+            return True  # Not received through the index (older file)
+        file_size = os.path.getsize(full_filepath)
+        if file_size != file_infos['size']:
+            logging.error(full_filepath + ': size changed since received (' + str(file_size) + ' bytes, ' +
+                          str(file_infos['size']) + ' expected).')
+            return False
+        return True
 
     @staticmethod
-    def move_files(source_files, target_folder):
+    def move_files(source_files, target_folder) -> list:
+        # Returns the files moved
+        moved_files = []
         for full_filepath in source_files:
             # Move file from "ToProcess" to the target folder
             target_file = full_filepath.replace(os.sep + 'ToProcess' + os.sep, os.sep + target_folder + os.sep)
@@ -74,27 +141,58 @@ class WatchServerBase(BaseServer):
                 logging.error('Error moving ' + full_filepath + ' to ' + target_file + ': ' + exc.strerror)
                 continue
                 # raise
+            moved_files.append(full_filepath)
+        return moved_files
 
     @staticmethod
-    def move_folder(source_folder, target_folder):
+    def move_folder(source_folder, target_folder) -> bool:
+        # Returns False if the folder couldn't be moved
         import shutil
         try:
             if os.path.exists(target_folder):
                 shutil.rmtree(target_folder)
             shutil.move(source_folder, target_folder)
-        except shutil.Error as exc:
+        except OSError as exc:  # Includes shutil.Error
             error = exc.strerror
             if not error:
-                error = 'Unknown error'
+                error = str(exc) or 'Unknown error'
             logging.critical('Error moving ' + source_folder + ' to ' + target_folder + ': ' + error)
+            return False
+        return True
 
     def file_was_processed(self, full_filepath: str):
         # Mark file as processed - will be moved later on to prevent conflicts
-        self.processed_files.append(full_filepath)
+        with self._processed_files_lock:
+            self.processed_files.append(full_filepath)
 
     def move_processed_files(self):
-        self.move_files(self.processed_files, 'Processed')
-        self.processed_files.clear()
+        with self._processed_files_lock:
+            processed_files = self.processed_files
+            self.processed_files = []
+        for full_filepath in self.move_files(processed_files, 'Processed'):
+            self.received_file_processed(full_filepath)
+
+    def remove_stale_files(self):
+        # Abandoned uploads, and old index entries
+        base_folder = os.path.join(self.data_path, 'Partial')
+        if os.path.isdir(base_folder):
+            now = time.time()
+            for path, _, files in os.walk(base_folder):
+                for file_name in files:
+                    partial_path = os.path.join(path, file_name)
+                    try:
+                        if now - os.path.getmtime(partial_path) > self.partial_file_max_age:
+                            logging.info(self.__class__.__name__ + ': Removing abandoned upload ' + partial_path)
+                            os.remove(partial_path)
+                    except OSError as e:
+                        logging.error('Unable to remove ' + partial_path + ': ' + str(e))
+            self.remove_empty_folders(base_folder)
+        if self._request_handler:
+            self._request_handler.prune_partial_hashes()
+
+        removed_count = self.received_files.prune(self.received_files_max_age)
+        if removed_count:
+            logging.info(self.__class__.__name__ + ': Removed ' + str(removed_count) + ' old received files entries')
 
     @staticmethod
     def remove_empty_folders(path_abs):
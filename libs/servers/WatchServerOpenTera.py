@@ -1,5 +1,9 @@
 from libs.servers.WatchServerBase import WatchServerBase
 from libs.servers.handlers.OpenTeraAppleWatchRequestHandler import OpenTeraAppleWatchRequestHandler
+from libs.uploaders.OpenTeraClientCache import OpenTeraClientCache
+from libs.utils.JobQueue import JobQueue
+from libs.utils.Metrics import Metrics
+from libs.utils.TransferJournal import TransferJournal
 
 from opentera_libraries.device.DeviceComManager import DeviceComManager
 from opentera_libraries.common.Constants import SessionStatus, SessionEventTypes, SessionCategoryEnum
@@ -7,8 +11,8 @@ from opentera_libraries.common.Constants import SessionStatus, SessionEventTypes
 from Globals import version_string
 
 import opentera_libraries.device.DeviceAPI as DeviceAPI
+from concurrent.futures import ThreadPoolExecutor
 from cryptography.fernet import Fernet
-from threading import Lock
 
 import logging
 import os
@@ -16,17 +20,11 @@ import threading
 import json
 import datetime
 import struct
-
-opentera_lock = Lock()
+import time
 
 
 class WatchServerOpenTera(WatchServerBase):
 
-    _device_tokens = {}     # Mapping of devices names and tokens
-    _device_timeouts = {}   # Timers of devices, since a watch can "disappear" and not send a "disconnect" command
-
-    _device_retries = {}    # Mapping of device names and number of retries, to automatically try to resend data
-
     file_syncher_timer = None
 
     def __init__(self, server_config: dict, opentera_config: dict):
@@ -35,11 +33,28 @@ class WatchServerOpenTera(WatchServerBase):
         request_handler = OpenTeraAppleWatchRequestHandler
 
         super().__init__(server_config=server_config, request_handler=request_handler)
+        self._device_tokens = {}     # Mapping of devices names and tokens
+        self._device_timeouts = {}   # Timers of devices, since a watch can "disappear" and not send a "disconnect"
+        self._device_retries = {}    # Mapping of device names and number of retries, to automatically try to resend
+        self._device_lock = threading.Lock()    # Protects the mappings above, used by the requests handlers threads
+
+        # Devices are transferred in parallel, but a device is never transferred by two workers at the same time
+        transfer_workers = max(1, server_config.get('transfer_workers', 4))
+        self.transfer_queue = JobQueue(name='OpenTeraTransfer', job_handler=self.initiate_opentera_transfer,
+                                       worker_count=transfer_workers)
+        self.asset_upload_workers = max(1, server_config.get('asset_upload_workers', 4))  # Files uploaded at once
+        self.event_post_workers = max(1, server_config.get('event_post_workers', 8))      # Events posted at once
+
         self.opentera_config = opentera_config
         self.opentera_server_url = ('https://' + self.opentera_config['hostname'] + ':' +
                                     str(self.opentera_config['port']))
         self.allow_insecure_server = (self.opentera_config['hostname'] == 'localhost' or
                                       self.opentera_config['hostname'] == '127.0.0.1')
+        self.opentera_clients = OpenTeraClientCache(self.opentera_config['hostname'], self.opentera_config['port'],
+                                                    self.allow_insecure_server,
+                                                    login_ttl=self.opentera_config.get('login_cache_ttl', 300),
+                                                    pool_size=self.opentera_pool_size(transfer_workers))
+        self.transfer_journal = TransferJournal(os.path.join(self.data_path, 'transfers.db'))
 
         # Load cryptographic key (to encrypt tokens, for example)
         if not os.path.isfile('config/secure_opentera'):
@@ -55,13 +70,28 @@ class WatchServerOpenTera(WatchServerBase):
         # Open token file and decrypt tokens
         self.load_tokens()
 
+    def opentera_pool_size(self, transfer_workers: int) -> int:
+        # Connections kept alive to OpenTera: each transfer worker uploads files or posts events with its own workers,
+        # and the requests handlers proxy devices requests (registration, ...)
+        return transfer_workers * max(self.asset_upload_workers, self.event_post_workers) + self.max_workers
+
     def run(self):
         # Check if all files are on sync on the server (after the main server has started)
         self.file_syncher_timer = threading.Timer(30, self.sync_files)
         self.file_syncher_timer.start()
+        self.transfer_queue.start()
 
         super().run()
 
+    def stop(self):
+        super().stop()
+        if self.file_syncher_timer:
+            self.file_syncher_timer.cancel()
+            self.file_syncher_timer = None
+        self.transfer_queue.stop()
+        self.opentera_clients.close()
+        self.transfer_journal.close()
+
     def load_tokens(self):
         tokens_file = os.path.join(self.data_path, 'tokens')
         if os.path.isfile(tokens_file):
@@ -72,329 +102,449 @@ class WatchServerOpenTera(WatchServerBase):
             # Decrypt tokens
             fernet = Fernet(self.secure_key)
             device_tokens = fernet.decrypt(tokens).decode()
-            self._device_tokens = json.loads(device_tokens.replace('\'', '"'))
+            with self._device_lock:
+                self._device_tokens = json.loads(device_tokens.replace('\'', '"'))
 
     def save_tokens(self):
         tokens_file = os.path.join(self.data_path, 'tokens')
         # Encrypt tokens
         fernet = Fernet(self.secure_key)
+        with self._device_lock:
+            device_tokens = str(self._device_tokens)
         with open(tokens_file, 'wb') as f:
-            f.write(fernet.encrypt(str(self._device_tokens).encode()))
+            f.write(fernet.encrypt(device_tokens.encode()))
 
     def update_device_token(self, device_name: str, token: str):
-        update_required = device_name not in self._device_tokens
-        if device_name in self._device_tokens and self._device_tokens[device_name] != token:
-            update_required = True
+        with self._device_lock:
+            update_required = device_name not in self._device_tokens
+            if device_name in self._device_tokens and self._device_tokens[device_name] != token:
+                update_required = True
+            if update_required:
+                self._device_tokens[device_name] = token
         if update_required:
-            self._device_tokens[device_name] = token
             self.save_tokens()
 
+    def device_token(self, device_name: str) -> str | None:
+        with self._device_lock:
+            return self._device_tokens.get(device_name)
+
     def new_file_received(self, device_name: str, filename: str):
         super().new_file_received(device_name, filename)
         # Start timeout timer in case device doesn't properly disconnect
-        if device_name in self._device_timeouts:
-            # Stop previous timer
-            self._device_timeouts[device_name].cancel()
-
-        # Starts a timeout timer in case the device doesn't properly disconnect (and thus trigger the transfer)
-        self._device_timeouts[device_name] = threading.Timer(1200, self.device_disconnected,
-                                                             kwargs={'device_name': device_name})
-        self._device_timeouts[device_name].start()
+        with self._device_lock:
+            if device_name in self._device_timeouts:
+                # Stop previous timer
+                self._device_timeouts[device_name].cancel()
 
-        # Cancel sync timer on new file
-        if self.file_syncher_timer:
-            self.file_syncher_timer.cancel()
-            self.file_syncher_timer = None
+            # Starts a timeout timer in case the device doesn't properly disconnect (and thus trigger the transfer)
+            self._device_timeouts[device_name] = threading.Timer(1200, self.device_disconnected,
+                                                                 kwargs={'device_name': device_name})
+            self._device_timeouts[device_name].start()
 
     def device_disconnected(self, device_name: str):
         super().device_disconnected(device_name)
         # self.initiate_opentera_transfer(device_name)
-        # Wait 30 seconds after the last disconnected device to start transfer
-        self.file_syncher_timer = threading.Timer(30, self.sync_files)
-        self.file_syncher_timer.start()
-
-    def device_connected(self, device_name: str):
-        super().device_connected(device_name)
+        # Wait 30 seconds after the last disconnected device to start transfer. Devices still connected then are
+        # skipped, and transferred once they disconnect - other devices don't wait for them.
         if self.file_syncher_timer:
             self.file_syncher_timer.cancel()
-            self.file_syncher_timer = None
+        self.file_syncher_timer = threading.Timer(30, self.sync_files)
+        self.file_syncher_timer.start()
 
     def sync_files(self):
         self.file_syncher_timer = None
         logging.info("WatchServerOpenTera: Checking if any pending transfers...")
-        if self._connected_devices:
-            logging.info("WatchServerOpenTera: Devices still connected: " + ', '.join(self._connected_devices) +
-                         ' - will transfer later.')
-            return
+        self.remove_stale_files()
+
+        # Files must be on disk before being processed
+        self.directory_syncer.flush()
 
         # Get base folder path
         base_folder = os.path.join(self.data_path, 'ToProcess')
         if os.path.isdir(base_folder):
             for device_name in os.listdir(base_folder):
-                self.initiate_opentera_transfer(device_name)
+                self.transfer_queue.submit(device_name, device_name)
+            logging.info("WatchServerOpenTera: Transfers queued (" + str(self.transfer_queue.depth) + " devices).")
 
         # logging.info("All done!")
 
     def initiate_opentera_transfer(self, device_name: str):
-        # Only one thread can transfer at a time - this prevent file conflicts
-        with ((opentera_lock)):
-            logging.info("WatchServerOpenTera: Initiating data transfer for " + device_name + "...")
+        # Data of a device is only transferred once it is done sending it - the transfer queue makes sure a single
+        # worker transfers it at a time
+        if not self.devices.begin_transfer(device_name):
+            logging.info('WatchServerOpenTera: ' + device_name + ' is ' + self.devices.state(device_name) +
+                         ' - will transfer later.')
+            return
+        try:
+            self.transfer_device_data(device_name)
+        finally:
+            self.devices.end_transfer(device_name)
+
+    def transfer_device_data(self, device_name: str):
+        logging.info("WatchServerOpenTera: Initiating data transfer for " + device_name + "...")
 
+        with self._device_lock:
             if device_name in self._device_timeouts:
                 # Stop timer if needed
-                self._device_timeouts[device_name].cancel()
-
-            # Get base folder path
-            base_folder = os.path.join(self.data_path, 'ToProcess', device_name)
-            if not os.path.isdir(base_folder):
-                logging.error('Unable to locate data folder ' + base_folder)
-                return
+                self._device_timeouts.pop(device_name).cancel()
 
-            # Create OpenTera com module
-            device_com = DeviceComManager(self.opentera_config['hostname'], self.opentera_config['port'],
-                                          self.allow_insecure_server)
-            if device_name not in self._device_tokens:
-                logging.error('No OpenTera token for ' + device_name + ' - aborting transfer.')
-                return
+        # Get base folder path
+        base_folder = os.path.join(self.data_path, 'ToProcess', device_name)
+        if not os.path.isdir(base_folder):
+            logging.error('Unable to locate data folder ' + base_folder)
+            return
 
-            device_com.token = self._device_tokens[device_name]
+        device_token = self.device_token(device_name)
+        if not device_token:
+            logging.error('No OpenTera token for ' + device_name + ' - aborting transfer.')
+            return
 
-            # Do device login
-            try:
-                response = device_com.do_get(DeviceAPI.ENDPOINT_DEVICE_LOGIN)
-            except Exception as e:
-                logging.error('OpenTera: Unable to login device ' + device_name + ': ' + str(e))
-                self.plan_upload_retry(device_name)
-                return
+        # Do device login (or reuse the previous one)
+        login_infos = self.opentera_clients.login(device_name, device_token)
+        if not login_infos:
+            self.plan_upload_retry(device_name)
+            return
+        device_com = self.opentera_clients.client(device_name, device_token)
 
-            if response.status_code != 200:
-                logging.error('OpenTera: Unable to login device ' + device_name + ': ' + str(response.status_code) +
-                              ' - ' + response.text.strip())
-                self.plan_upload_retry(device_name)
-                return
+        device_infos = login_infos['device_info']
+        participants_infos = login_infos['participants_info']
+        session_types_infos = login_infos['session_types_info']
 
-            device_infos = response.json()['device_info']
-            participants_infos = response.json()['participants_info']
-            session_types_infos = response.json()['session_types_info']
+        if len(participants_infos) == 0:
+            logging.error('No participant assigned to this device - will not transfer until this is fixed.')
+            return
 
-            if len(participants_infos) == 0:
-                logging.error('No participant assigned to this device - will not transfer until this is fixed.')
-                return
+        # Find correct session type to use
+        # possible_session_types_ids = [st['id_session_type'] for st in session_types_infos
+        #                               if 'session_type_service_key' in st and
+        #                               st['session_type_service_key'] == 'FileTransferService']
+        # if len(possible_session_types_ids) == 0:
+        #     logging.error('No session types with service "FileTransfer" available to this device - will not '
+        #                   'transfer until this is fixed.')
+        #     return
+        # Find correct session type to use
+        possible_session_types_ids = [st['id_session_type'] for st in session_types_infos
+                                      if st['session_type_category'] == SessionCategoryEnum.DATACOLLECT.value]
+        if len(possible_session_types_ids) == 0:
+            logging.error(
+                'No "Data Collect" session types available to this device - will not transfer until this '
+                'is fixed.')
+            return
 
-            # Find correct session type to use
-            # possible_session_types_ids = [st['id_session_type'] for st in session_types_infos
-            #                               if 'session_type_service_key' in st and
-            #                               st['session_type_service_key'] == 'FileTransferService']
-            # if len(possible_session_types_ids) == 0:
-            #     logging.error('No session types with service "FileTransfer" available to this device - will not '
-            #                   'transfer until this is fixed.')
-            #     return
-            # Find correct session type to use
-            possible_session_types_ids = [st['id_session_type'] for st in session_types_infos
-                                          if st['session_type_category'] == SessionCategoryEnum.DATACOLLECT.value]
-            if len(possible_session_types_ids) == 0:
-                logging.error(
-                    'No "Data Collect" session types available to this device - will not transfer until this '
-                    'is fixed.')
-                return
+        id_session_type = self.opentera_config['default_session_type_id']
+        if id_session_type not in possible_session_types_ids:
+            logging.warning('Default session type ID not in available session types - will use the first one: ' +
+                            str(possible_session_types_ids[0]))
+            id_session_type = possible_session_types_ids[0]
+
+        # Browse all data folders
+        erronous_paths = []
+        processed_paths = []
+        for (dir_path, dir_name, files) in os.walk(base_folder):
+            if dir_path == base_folder:
+                continue
+            logging.info('WatchServerOpenTera: Processing ' + dir_path)
+            # Read session.oimi file
+            session_file = os.path.join(dir_path, 'session.oimi')
+            session_file = session_file.replace('/', os.sep)
+            if not os.path.isfile(session_file):
+                logging.error('No session file in ' + dir_path)
+                continue
 
-            id_session_type = self.opentera_config['default_session_type_id']
-            if id_session_type not in possible_session_types_ids:
-                logging.warning('Default session type ID not in available session types - will use the first one: ' +
-                                str(possible_session_types_ids[0]))
-                id_session_type = possible_session_types_ids[0]
+            with open(session_file) as f:
+                session_data = f.read()
 
-            # Browse all data folders
-            erronous_paths = []
-            for (dir_path, dir_name, files) in os.walk(base_folder):
-                if dir_path == base_folder:
-                    continue
-                logging.info('WatchServerOpenTera: Processing ' + dir_path)
-                # Read session.oimi file
-                session_file = os.path.join(dir_path, 'session.oimi')
-                session_file = session_file.replace('/', os.sep)
-                if not os.path.isfile(session_file):
-                    logging.error('No session file in ' + dir_path)
-                    continue
+            session_data_json = json.loads(session_data)
 
-                with open(session_file) as f:
-                    session_data = f.read()
+            # Check if we have all the required files for that session
+            if 'files' in session_data_json:
+                required_files = session_data_json['files']
+                current_files = [f for f in os.listdir(dir_path) if os.path.isfile(os.path.join(dir_path, f))]
+                missing_files = set(required_files).difference(current_files)
+                if missing_files:
+                    # Missing files
+                    # Ignore beacon missing file
+                    if 'watch_Beacons.data' in missing_files:
+                        missing_files.remove('watch_Beacons.data')
+                        logging.warning("Missing 'watch_Beacons.data', but expected.")
 
-                session_data_json = json.loads(session_data)
+                    # Ignore coordinates missing file
+                    if 'watch_Coordinates.data' in missing_files:
+                        missing_files.remove('watch_Coordinates.data')
+                        logging.warning("Missing 'watch_Coordinates.data', but expected.")
 
-                # Check if we have all the required files for that session
-                if 'files' in session_data_json:
-                    required_files = session_data_json['files']
-                    current_files = [f for f in os.listdir(dir_path) if os.path.isfile(os.path.join(dir_path, f))]
-                    missing_files = set(required_files).difference(current_files)
                     if missing_files:
-                        # Missing files
-                        # Ignore beacon missing file
-                        if 'watch_Beacons.data' in missing_files:
-                            missing_files.remove('watch_Beacons.data')
-                            logging.warning("Missing 'watch_Beacons.data', but expected.")
-
-                        # Ignore coordinates missing file
-                        if 'watch_Coordinates.data' in missing_files:
-                            missing_files.remove('watch_Coordinates.data')
-                            logging.warning("Missing 'watch_Coordinates.data', but expected.")
-
-                        if missing_files:
-                            logging.error('Missing files in dataset: ' + ', '.join(missing_files) + ' - ignoring dataset for now')
-                            continue
-
-                # Read watch_logs.txt file
-                log_file = os.path.join(dir_path, 'watch_logs.txt')
-                log_file = log_file.replace('/', os.sep)
-                if not os.path.isfile(log_file):
-                    logging.error('No watch logs file in ' + dir_path)
-                    continue
-
-                with open(log_file) as f:
-                    logs_data = f.read().splitlines()
-
-                if len(logs_data) < 2:
-                    logging.info('Empty log file - ignoring...')
-                    self.move_folder(dir_path, dir_path.replace('ToProcess', 'Rejected'))
-                    continue
+                        logging.error('Missing files in dataset: ' + ', '.join(missing_files) + ' - ignoring dataset for now')
+                        continue
 
-                # Compute duration
-                first_timestamp = logs_data[0].split('\t')[0]
-                last_timestamp = logs_data[-1].split('\t')[0]
-                try:
-                    duration = float(last_timestamp) - float(first_timestamp)
-                except ValueError:
-                    logging.info('Badly formatted log file - ignoring dataset...')
-                    self.move_folder(dir_path, dir_path.replace('ToProcess', 'Rejected'))
-                    continue
+            # Read watch_logs.txt file
+            log_file = os.path.join(dir_path, 'watch_logs.txt')
+            log_file = log_file.replace('/', os.sep)
+            if not os.path.isfile(log_file):
+                logging.error('No watch logs file in ' + dir_path)
+                continue
 
-                # Update duration from "battery" file, if present, since "watch_logs" duration can be under-evaluated
-                # if watch battery was depleted or a new day started
-                battery_file = os.path.join(dir_path, 'watch_Battery.data')
-                battery_file = battery_file.replace('/', os.sep)
-                if os.path.isfile(battery_file):
-                    with open(battery_file, mode='rb') as f:
-                        try:
-                            f.seek(-10, os.SEEK_END)
-                        except OSError as e:
-                            logging.info('Badly formatted battery file - ignoring dataset...')
-                            f.close()
-                            self.move_folder(dir_path, dir_path.replace('ToProcess', 'Rejected'))
-                            continue
-                        batt_data = f.read(8)  # Read the last timestamp of the file
-                        if len(batt_data) == 8:
-                            batt_last_timestamp = struct.unpack("<Q", batt_data)[0] / 1000
-                            if batt_last_timestamp and batt_last_timestamp > float(last_timestamp):
-                                duration = float(batt_last_timestamp) - float(first_timestamp)
-
-                if duration <= self.minimal_dataset_duration:
-                    logging.info('Rejected folder ' + dir_path + ': dataset too small.')
-                    self.move_folder(dir_path, dir_path.replace('ToProcess', 'Rejected'))
-                    continue
+            with open(log_file) as f:
+                logs_data = f.read().splitlines()
 
-                # Clean session parameters
-                session_params = session_data_json['description'].split('Settings:')[-1]
-                session_params = session_params.replace('\n', '').replace('\t', '').replace(',,', ',').replace('{,', '{'). \
-                    replace(' ', '').replace(',}', '}')
+            if len(logs_data) < 2:
+                logging.info('Empty log file - ignoring...')
+                self.move_folder(dir_path, dir_path.replace('ToProcess', 'Rejected'))
+                continue
 
-                session_comments = 'Created by ' + device_name + ' [SensorLogger v' + session_data_json['appVersion'] + ']'
-                session_comments += ', Uploaded by PiHub v' + version_string
+            # Compute duration
+            first_timestamp = logs_data[0].split('\t')[0]
+            last_timestamp = logs_data[-1].split('\t')[0]
+            try:
+                duration = float(last_timestamp) - float(first_timestamp)
+            except ValueError:
+                logging.info('Badly formatted log file - ignoring dataset...')
+                self.move_folder(dir_path, dir_path.replace('ToProcess', 'Rejected'))
+                continue
 
-                # Create session
-                if 'timestamp' in session_data_json:
-                    session_starttime = datetime.datetime.fromisoformat(session_data_json['timestamp'].replace('_', ' '))
-                else:
-                    logging.warning('No session timestamp found - using current time')
-                    session_starttime = datetime.datetime.now()
+            # Update duration from "battery" file, if present, since "watch_logs" duration can be under-evaluated
+            # if watch battery was depleted or a new day started
+            battery_file = os.path.join(dir_path, 'watch_Battery.data')
+            battery_file = battery_file.replace('/', os.sep)
+            if os.path.isfile(battery_file):
+                with open(battery_file, mode='rb') as f:
+                    try:
+                        f.seek(-10, os.SEEK_END)
+                    except OSError as e:
+                        logging.info('Badly formatted battery file - ignoring dataset...')
+                        f.close()
+                        self.move_folder(dir_path, dir_path.replace('ToProcess', 'Rejected'))
+                        continue
+                    batt_data = f.read(8)  # Read the last timestamp of the file
+                    if len(batt_data) == 8:
+                        batt_last_timestamp = struct.unpack("<Q", batt_data)[0] / 1000
+                        if batt_last_timestamp and batt_last_timestamp > float(last_timestamp):
+                            duration = float(batt_last_timestamp) - float(first_timestamp)
+
+            if duration <= self.minimal_dataset_duration:
+                logging.info('Rejected folder ' + dir_path + ': dataset too small.')
+                self.move_folder(dir_path, dir_path.replace('ToProcess', 'Rejected'))
+                continue
 
-                session_name = device_name
-                if 'device_subtype' in device_infos:
-                    session_name += ' [' + device_infos['device_subtype'] + ']'
-                session_name += ' - ' + session_starttime.strftime("%Y-%m-%d %H:%M:%S")
+            # Clean session parameters
+            session_params = session_data_json['description'].split('Settings:')[-1]
+            session_params = session_params.replace('\n', '').replace('\t', '').replace(',,', ',').replace('{,', '{'). \
+                replace(' ', '').replace(',}', '}')
 
-                session_info = {'id_session': 0, 'session_name': session_name,
-                                'session_start_datetime': session_starttime.isoformat(),
-                                'session_duration': int(duration), 'session_status': SessionStatus.STATUS_COMPLETED.value,
-                                'session_parameters': session_params, 'session_comments': session_comments,
-                                'id_session_type': id_session_type,
-                                'session_participants': [part['participant_uuid'] for part in participants_infos]}
+            session_comments = 'Created by ' + device_name + ' [SensorLogger v' + session_data_json['appVersion'] + ']'
+            session_comments += ', Uploaded by PiHub v' + version_string
 
+            # Create session
+            if 'timestamp' in session_data_json:
+                session_starttime = datetime.datetime.fromisoformat(session_data_json['timestamp'].replace('_', ' '))
+            else:
+                logging.warning('No session timestamp found - using current time')
+                session_starttime = datetime.datetime.now()
+
+            session_name = device_name
+            if 'device_subtype' in device_infos:
+                session_name += ' [' + device_infos['device_subtype'] + ']'
+            session_name += ' - ' + session_starttime.strftime("%Y-%m-%d %H:%M:%S")
+
+            session_info = {'id_session': 0, 'session_name': session_name,
+                            'session_start_datetime': session_starttime.isoformat(),
+                            'session_duration': int(duration), 'session_status': SessionStatus.STATUS_COMPLETED.value,
+                            'session_parameters': session_params, 'session_comments': session_comments,
+                            'id_session_type': id_session_type,
+                            'session_participants': [part['participant_uuid'] for part in participants_infos]}
+
+            # Resume the transfer of that dataset, if it was started before
+            dataset = os.path.relpath(dir_path, os.path.join(self.data_path, 'ToProcess')).replace(os.sep, '/')
+            journal_session = self.transfer_journal.session(dataset)
+            if journal_session:
+                id_session = journal_session['id_session']
+                events_done = journal_session['events_done']
+                session_file_names = []     # Uploaded files are in the journal
+                logging.info('WatchServerOpenTera: Resuming transfer of ' + dir_path + ' in session ' +
+                             str(id_session))
+            else:
                 response = device_com.do_post(DeviceAPI.ENDPOINT_DEVICE_SESSIONS, {'session': session_info})
                 if response.status_code != 200:
+                    self.opentera_clients.check_response(device_name, response)
                     logging.error('OpenTera: Unable to create session - skipping: ' + str(response.status_code) +
                                   ' - ' + response.text.strip())
                     continue
 
                 id_session = response.json()['id_session']
+                self.transfer_journal.session_created(dataset, device_name, id_session)
 
                 # Get list of assets already present for that session
                 response = device_com.do_get(DeviceAPI.ENDPOINT_DEVICE_ASSETS, {'id_session': id_session})
                 if response.status_code != 200:
+                    self.opentera_clients.check_response(device_name, response)
                     logging.error('OpenTera: Unable to query assets for session: ' + str(response.status_code) +
                                   ' - ' + response.text.strip())
                     continue
                 session_file_names = [asset['asset_name'] for asset in response.json()]
+                events_done = bool(session_file_names)  # Files already uploaded - events were created
+
+            # Create session events
+            upload_errors = False
+            if not events_done:
+                session_events = self.coalesce_events(self.watch_logs_to_events(logs_data))
+                if self.post_session_events(device_com, device_name, dataset, id_session, session_events):
+                    self.transfer_journal.events_done(dataset)
+                else:
+                    upload_errors = True    # Missing events will be posted on retry
 
-                # Create session events
-                if not session_file_names:  # No files uploaded - create events
-                    session_events = self.watch_logs_to_events(logs_data)
-                    for index, event in enumerate(session_events):
-                        if index >= 100:
-                            logging.warning('OpenTera: More than 100 session events for session ' + session_name +
-                                            ' - ignoring the rest...')
-                            break
-                        event['id_session'] = id_session
-                        event['id_session_event'] = 0
-                        response = device_com.do_post(DeviceAPI.ENDPOINT_DEVICE_SESSION_EVENTS,
-                                                      {'session_event': event})
-                        if response.status_code != 200:
-                            logging.error(
-                                'OpenTera: Unable to create session event - skipping: ' + str(response.status_code) +
-                                ' - ' + response.text.strip())
-                            continue
-
-                # Upload all files to FileTransfer service
-                upload_errors = False
-                for data_file in files:
-                    full_path = str(os.path.join(dir_path, data_file))
-                    if data_file in session_file_names:
-                        logging.warning('File ' + data_file + ' already in session - ignoring.')
-                        continue
-                    if os.path.getsize(full_path) == 0:
-                        logging.warning('File ' + data_file + ' is empty - ignoring.')
-                        continue
-                    logging.info('Uploading ' + full_path + '...')
-                    response = device_com.upload_file(id_session=id_session, asset_name=data_file, file_path=full_path)
-                    if response.status_code != 200:
-                        logging.error('OpenTera: Unable to upload file - skipping: ' + str(response.status_code) +
-                                      ' - ' + response.text.strip())
-                        upload_errors = True
-                        continue
+            # Upload all files to FileTransfer service
+            if not self.upload_session_files(device_com, device_name, dataset, id_session, dir_path, files,
+                                             session_file_names):
+                upload_errors = True
 
-                logging.info('WatchServerOpenTera: Done processing ' + dir_path)
-                if not upload_errors:
-                    self.processed_files.append(dir_path)
-                else:
-                    erronous_paths.append(dir_path)
+            logging.info('WatchServerOpenTera: Done processing ' + dir_path)
+            if not upload_errors:
+                processed_paths.append(dir_path)
+            else:
+                erronous_paths.append(dir_path)
 
-            for dir_path in self.processed_files:
-                logging.info('Moving ' + dir_path + '...')
-                self.move_folder(dir_path, dir_path.replace('ToProcess', 'Processed'))
-            self.processed_files.clear()
+        for dir_path in processed_paths:
+            logging.info('Moving ' + dir_path + '...')
+            if not self.move_folder(dir_path, dir_path.replace('ToProcess', 'Processed')):
+                # Still in ToProcess - keep its journal, or its session would be created again on the next transfer
+                continue
+            self.received_file_processed(dir_path)
+            self.transfer_journal.remove(os.path.relpath(dir_path, os.path.join(self.data_path, 'ToProcess'))
+                                         .replace(os.sep, '/'))
 
-            logging.info('WatchServerOpenTera: Data transfer for ' + device_name + ' completed')
+        logging.info('WatchServerOpenTera: Data transfer for ' + device_name + ' completed')
 
-            if erronous_paths:
-                self.plan_upload_retry(device_name)
-            else:
-                if device_name in self._device_retries:
-                    del self._device_retries[device_name]
+        if erronous_paths:
+            self.plan_upload_retry(device_name)
+        else:
+            with self._device_lock:
+                self._device_retries.pop(device_name, None)
+
+    def upload_session_files(self, device_com: DeviceComManager, device_name: str, dataset: str, id_session: int,
+                             dir_path: str, files: list, session_file_names: list) -> bool:
+        # Uploads the files of a session folder, asset_upload_workers at a time - returns False if any failed
+        upload_errors = False
+        upload_files = []
+        uploaded_assets = self.transfer_journal.uploaded_assets(dataset)
+        for data_file in files:
+            full_path = str(os.path.join(dir_path, data_file))
+            if data_file in session_file_names:
+                logging.warning('File ' + data_file + ' already in session - ignoring.')
+                continue
+            file_size = os.path.getsize(full_path)
+            if file_size == 0:
+                logging.warning('File ' + data_file + ' is empty - ignoring.')
+                continue
+            if not self.check_received_file(full_path):
+                upload_errors = True
+                continue
+            file_infos = self.received_file_infos(full_path)
+            file_hash = file_infos['hash'] if file_infos else None
+            if uploaded_assets.get(data_file) == (file_size, file_hash):
+                logging.info('File ' + data_file + ' already uploaded - ignoring.')
+                continue
+            upload_files.append((data_file, full_path, file_size, file_hash))
+
+        if not upload_files:
+            return not upload_errors
+
+        def upload_file(upload_infos: tuple) -> int | None:
+            data_file, full_path, file_size, file_hash = upload_infos
+            uploaded_size = self.upload_session_file(device_com, device_name, id_session, data_file, full_path)
+            if uploaded_size is not None:
+                self.transfer_journal.asset_uploaded(dataset, data_file, file_size, file_hash)
+            return uploaded_size
+
+        start_time = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.asset_upload_workers,
+                                thread_name_prefix='OpenTeraUpload') as executor:
+            uploaded_sizes = list(executor.map(upload_file, upload_files))
+        duration = time.monotonic() - start_time
+
+        if None in uploaded_sizes:
+            upload_errors = True
+        uploaded_size = sum(size for size in uploaded_sizes if size)
+        logging.info('WatchServerOpenTera: Uploaded ' + str(len(uploaded_sizes) - uploaded_sizes.count(None)) + '/' +
+                     str(len(uploaded_sizes)) + ' files (' + str(uploaded_size) + ' bytes) of ' + dir_path + ' in ' +
+                     f'{duration:.1f}s ({uploaded_size / max(duration, 1e-6) / 1e6:.2f} MB/s)')
+        return not upload_errors
+
+    def post_session_events(self, device_com: DeviceComManager, device_name: str, dataset: str, id_session: int,
+                            events: list) -> bool:
+        # Posts the events of a session not posted yet, event_post_workers at a time - returns False if any failed
+        posted_events = self.transfer_journal.posted_events(dataset)
+        remaining_events = [(index, event) for index, event in enumerate(events) if index not in posted_events]
+        if not remaining_events:
+            return True
+
+        def post_event(indexed_event: tuple) -> bool:
+            if not self.post_session_event(device_com, device_name, id_session, indexed_event[1]):
+                return False
+            self.transfer_journal.event_posted(dataset, indexed_event[0])
+            return True
+
+        start_time = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.event_post_workers, thread_name_prefix='OpenTeraEvents') as executor:
+            posted = list(executor.map(post_event, remaining_events))
+        posted_count = posted.count(True)
+        logging.info('WatchServerOpenTera: Posted ' + str(posted_count) + '/' + str(len(remaining_events)) +
+                     ' session events in ' + f'{time.monotonic() - start_time:.1f}s' +
+                     (' (' + str(len(posted_events)) + ' already posted)' if posted_events else ''))
+        return posted_count == len(remaining_events)
+
+    def post_session_event(self, device_com: DeviceComManager, device_name: str, id_session: int,
+                           event: dict) -> bool:
+        event = dict(event, id_session=id_session, id_session_event=0)
+        try:
+            response = device_com.do_post(DeviceAPI.ENDPOINT_DEVICE_SESSION_EVENTS, {'session_event': event})
+        except Exception as e:
+            logging.error('OpenTera: Unable to create session event - skipping: ' + str(e))
+            Metrics.inc('pihub_opentera_events_total', description='Session events posted to OpenTera',
+                        result='error')
+            return False
+        Metrics.inc('pihub_opentera_events_total', description='Session events posted to OpenTera',
+                    result='posted' if response.status_code == 200 else 'error')
+        if response.status_code != 200:
+            self.opentera_clients.check_response(device_name, response)
+            logging.error('OpenTera: Unable to create session event - skipping: ' + str(response.status_code) +
+                          ' - ' + response.text.strip())
+            return False
+        return True
+
+    def upload_session_file(self, device_com: DeviceComManager, device_name: str, id_session: int, asset_name: str,
+                            file_path: str) -> int | None:
+        # Returns the uploaded size, or None on error
+        logging.info('Uploading ' + file_path + '...')
+        file_size = os.path.getsize(file_path)
+        start_time = time.monotonic()
+        try:
+            response = device_com.upload_file(id_session=id_session, asset_name=asset_name, file_path=file_path)
+        except Exception as e:
+            logging.error('OpenTera: Unable to upload file - skipping: ' + str(e))
+            Metrics.inc('pihub_opentera_uploads_total', description='Assets uploaded to OpenTera, by result',
+                        result='error')
+            return None
+        if response.status_code != 200:
+            self.opentera_clients.check_response(device_name, response)
+            logging.error('OpenTera: Unable to upload file - skipping: ' + str(response.status_code) +
+                          ' - ' + response.text.strip())
+            Metrics.inc('pihub_opentera_uploads_total', description='Assets uploaded to OpenTera, by result',
+                        result='error')
+            return None
+        duration = time.monotonic() - start_time
+        Metrics.inc('pihub_opentera_uploads_total', description='Assets uploaded to OpenTera, by result',
+                    result='uploaded')
+        Metrics.inc('pihub_opentera_uploaded_bytes_total', file_size, 'Bytes uploaded to OpenTera', device=device_name)
+        Metrics.observe('pihub_opentera_upload_seconds', duration, 'Duration of assets uploads to OpenTera')
+        logging.info('Uploaded ' + file_path + ' (' + str(file_size) + ' bytes in ' + f'{duration:.1f}s, ' +
+                     f'{file_size / max(duration, 1e-6) / 1e6:.2f} MB/s)')
+        return file_size
 
     def plan_upload_retry(self, device_name):
-        if device_name not in self._device_retries.keys():
-            self._device_retries[device_name] = 1
-        else:
-            self._device_retries[device_name] = self._device_retries[device_name] + 1
+        Metrics.inc('pihub_opentera_retries_total', description='OpenTera transfers planned to be retried',
+                    device=device_name)
+        with self._device_lock:
+            self._device_retries[device_name] = self._device_retries.get(device_name, 0) + 1
             if self._device_retries[device_name] > 5:
                 logging.warning('Too many retries for device ' + device_name + ' - abandonning automatic '
                                                                                'transfer resuming')
@@ -402,8 +552,7 @@ class WatchServerOpenTera(WatchServerBase):
                 return
         # Plan next retry timer
         logging.warning('Errors occured in transfer for ' + device_name + ' - will retry later!')
-        retry_timer = threading.Timer(120, self.initiate_opentera_transfer,
-                                      kwargs={'device_name': device_name})
+        retry_timer = threading.Timer(120, self.transfer_queue.submit, args=(device_name, device_name))
         retry_timer.start()
 
     # def file_upload_callback(self, monitor):
@@ -455,3 +604,31 @@ class WatchServerOpenTera(WatchServerBase):
             events.append(session_event)
 
         return events
+
+    @staticmethod
+    def coalesce_events(events: list) -> list:
+        # Merges consecutive identical events (same type, text and context, as a watch repeatedly logs some states) in
+        # the first one
+        coalesced_events = []
+        repeat_count = 0
+        for event in events:
+            previous_event = coalesced_events[-1] if coalesced_events else None
+            if previous_event and all(previous_event[key] == event[key] for key in
+                                      ['id_session_event_type', 'session_event_text', 'session_event_context']):
+                repeat_count += 1
+                continue
+            if repeat_count:
+                coalesced_events[-1] = WatchServerOpenTera.repeated_event(previous_event, repeat_count)
+            coalesced_events.append(event)
+            repeat_count = 0
+        if repeat_count:
+            coalesced_events[-1] = WatchServerOpenTera.repeated_event(coalesced_events[-1], repeat_count)
+        if len(coalesced_events) < len(events):
+            logging.info('WatchServerOpenTera: ' + str(len(events) - len(coalesced_events)) +
+                         ' repeated session events coalesced')
+        return coalesced_events
+
+    @staticmethod
+    def repeated_event(event: dict, repeat_count: int) -> dict:
+        # Event logged repeat_count more times
+        return dict(event, session_event_text=event['session_event_text'] + ' (x' + str(repeat_count + 1) + ')')
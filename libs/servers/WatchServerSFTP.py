@@ -41,6 +41,9 @@ class WatchServerSFTP(WatchServerBase):
             return
 
         self.synching_files = True
+        self.remove_stale_files()
+        # Files must be on disk before being processed
+        self.directory_syncer.flush()
         # Build list of files to transfer
         base_folder = self.data_path + '/ToProcess/'
         base_folder = base_folder.replace('/', os.sep)
@@ -80,6 +83,7 @@ class WatchServerSFTP(WatchServerBase):
                                 pass
 
                     folder_files = f
+                folder_files = [file for file in folder_files if self.check_received_file(os.path.join(dp, file))]
                 files.extend(folder_files)
                 full_files.extend([os.path.join(dp, file) for file in folder_files])
                 file_folder = dp.replace(base_folder, '')
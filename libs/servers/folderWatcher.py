@@ -52,6 +52,7 @@ class FolderWatcher(BaseServer):
         before = dict([(f, None) for f in os.listdir(path_to_watch)])
 
         logging.info("folderWatcher started")
+        storage_low = False
         try:
             # Watch the filepath every 1s and if number of file changes transfer files.
             while 1:
@@ -63,6 +64,17 @@ class FolderWatcher(BaseServer):
                 added = [f for f in after if not f in before]
                 removed = [f for f in before if not f in after]
                 # Check if a file was added or removed
+                if added and not self.has_free_space():
+                    # Transfers need local space (merged and transferred copies) - retry on the next scans
+                    if not storage_low:
+                        logging.warning("FolderWatcher: Not enough free space - deferring transfer of " +
+                                        ", ".join(added))
+                    storage_low = True
+                    for filename in added:
+                        del after[filename]
+                    added = []
+                elif added:
+                    storage_low = False
                 if added:
                     logging.info("FolderWatcher: Local File(s) Added: " + ", ".join(added))
                     for i in range(0, len(added)):
@@ -1,16 +1,147 @@
 from http.server import BaseHTTPRequestHandler
+from libs.utils.Metrics import Metrics
+from libs.utils.ReceivedFilesIndex import ReceivedFilesIndex
+from libs.utils.StorageBudget import StorageBudget
+from libs.utils.StreamDecoder import StreamDecoder
 from pathlib import Path
 
 import logging
 import os
+import threading
+import time
 
 
 class BaseAppleWatchRequestHandler(BaseHTTPRequestHandler):
     base_server = None
 
+    # Persistent connections - a device can send all its commands and files on the same connection
+    protocol_version = 'HTTP/1.1'
+    requests_count = 0
+    received_size = 0       # Bytes of the current file received so far
+
+    # Receive buffers, reused from one upload to the next
+    _receive_buffers = []
+    _receive_buffers_lock = threading.Lock()
+
+    # Hash of the partial files being received, to resume without reading them again - partial path: (size, hash)
+    _partial_hashes = {}
+    _partial_hashes_lock = threading.Lock()
+
     def setup(self):
         BaseHTTPRequestHandler.setup(self)
 
+    def handle(self):
+        # Handle requests until the device closes the connection, stays idle too long or sent too many requests
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection:
+            try:
+                self.connection.settimeout(self.base_server.keep_alive_timeout if self.base_server else None)
+                if not self.rfile.peek(1):
+                    break  # Connection closed by the device
+            except OSError:
+                break  # Idle for too long
+            self.handle_one_request()
+
+    def parse_request(self) -> bool:
+        # Request received - back to the connection timeout for the rest of it
+        self.connection.settimeout(self.timeout)
+        self.requests_count += 1
+        if not super().parse_request():
+            return False
+        if self.base_server and self.requests_count >= self.base_server.max_keep_alive_requests:
+            self.close_connection = True
+        return True
+
+    def send_reply(self, code: int, content_type: str | None = None, headers: dict | None = None,
+                   close_connection: bool = False):
+        # Response without body. The connection must be closed if the request body wasn't read.
+        self.send_response(code)
+        if content_type:
+            self.send_header('Content-type', content_type)
+        if headers:
+            for header, value in headers.items():
+                self.send_header(header, value)
+        self.send_header('Content-Length', '0')
+        if close_connection or self.close_connection:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+
+    def receive_file(self, fh, source: StreamDecoder, content_length: int, file_hash=None) -> int:
+        # Receive content_length bytes of (decoded) request body to fh, at its current position, and returns the number
+        # of bytes actually received. The received data is also added to file_hash, if specified.
+        offset = fh.tell()
+        if content_length > 0 and hasattr(os, 'posix_fallocate'):
+            try:
+                # Reserve the whole file at once to limit fragmentation
+                os.posix_fallocate(fh.fileno(), offset, content_length)
+            except OSError:
+                pass  # Not supported by that file system
+
+        buffer_size = self.base_server.receive_buffer_size if self.base_server else 256 * 1024
+        with self._receive_buffers_lock:
+            buffer = self._receive_buffers.pop() if self._receive_buffers else None
+        if buffer is None or len(buffer) != buffer_size:
+            buffer = bytearray(buffer_size)
+        view = memoryview(buffer)
+
+        self.received_size = 0
+        try:
+            while self.received_size < content_length:
+                count = source.readinto(view[:min(buffer_size, content_length - self.received_size)])
+                if not count:
+                    break  # Connection closed
+                fh.write(view[:count])
+                if file_hash is not None:
+                    file_hash.update(view[:count])
+                self.received_size += count
+            if self.received_size == content_length and (source.readinto(view[:1]) or not source.finished):
+                raise ValueError('Decoded data longer than expected')
+        finally:
+            view.release()
+            with self._receive_buffers_lock:
+                self._receive_buffers.append(buffer)
+            if self.received_size < content_length:
+                # Release preallocated space that won't be used
+                fh.truncate(offset + self.received_size)
+        return self.received_size
+
+    @staticmethod
+    def prune_partial_hashes():
+        # Forget the hash of the partial files that were completed or removed
+        with BaseAppleWatchRequestHandler._partial_hashes_lock:
+            for partial_path in [path for path in BaseAppleWatchRequestHandler._partial_hashes
+                                 if not os.path.isfile(path)]:
+                del BaseAppleWatchRequestHandler._partial_hashes[partial_path]
+
+    @staticmethod
+    def count_upload(result: str):
+        Metrics.inc('pihub_watch_uploads_total', description='Files uploads requests from watches, by result',
+                    result=result)
+
+    def upload_paths(self, device_name: str, file_path: str, file_name: str) -> tuple:
+        # Returns (partial path, destination path) of an uploaded file. Files are received in the "Partial" folder and
+        # only moved to the "ToProcess" folder once complete.
+        paths = []
+        for folder in ['Partial', 'ToProcess']:
+            paths.append((self.base_server.data_path + '/' + folder + '/' + device_name + '/' + file_path + '/' +
+                          file_name).replace('//', '/').replace('/', os.sep))
+        return tuple(paths)
+
+    @staticmethod
+    def parse_content_range(content_range: str) -> tuple | None:
+        # "bytes start-end/total" to (start, end, total), or None if invalid
+        try:
+            unit, byte_range = content_range.strip().split(' ', 1)
+            byte_range, total = byte_range.split('/')
+            start, end = byte_range.split('-')
+            start, end, total = int(start), int(end), int(total)
+        except ValueError:
+            return None
+        if unit != 'bytes' or start < 0 or end < start or end >= total:
+            return None
+        return start, end, total
+
     # Simple get to show what to do for file transfer
     def do_GET(self):
         # Ping requests can be answered directly
@@ -18,9 +149,7 @@ class BaseAppleWatchRequestHandler(BaseHTTPRequestHandler):
         if content_type == 'cdrv-cmd/Connect':
             # self.streamer.add_log.emit("Connexion de " + self.headers['Device-Name'], LogTypes.LOGTYPE_INFO)
             logging.info(self.headers['Device-Name'] + ' connected.')
-            self.send_response(202)
-            self.send_header('Content-type', 'cdrv-cmd/Connect')
-            self.end_headers()
+            self.send_reply(202, 'cdrv-cmd/Connect')
             if self.base_server:
                 self.base_server.device_connected(self.headers['Device-Name'])
             return
@@ -28,16 +157,39 @@ class BaseAppleWatchRequestHandler(BaseHTTPRequestHandler):
         if content_type == 'cdrv-cmd/Disconnect':
             # self.streamer.add_log.emit("Déconnexion de " + self.headers['Device-Name'], LogTypes.LOGTYPE_INFO)
             logging.info(self.headers['Device-Name'] + ' disconnected.')
-            self.send_response(202)
-            self.send_header('Content-type', 'cdrv-cmd/Disconnect')
-            self.end_headers()
+            self.send_reply(202, 'cdrv-cmd/Disconnect')
             if self.base_server:
                 self.base_server.device_disconnected(self.headers['Device-Name'])
             return
 
-        self.send_response(200)
-        self.send_header('Content-type', 'text/html')
-        self.end_headers()
+        if content_type == 'cdrv-cmd/File-Status':
+            # Bytes already received for a file, to resume an interrupted upload
+            device_name = self.headers['Device-Name']
+            file_path = self.headers['File-Path']
+            file_name = self.headers['File-Name']
+            if None in [device_name, file_path, file_name]:
+                logging.error("Badly formatted request - missing some headers.")
+                self.send_reply(400, close_connection=True)
+                return
+            # File already received intact? The device can specify the size (File-Size) and hash (File-Hash) of its file
+            file_complete = False
+            if self.headers['File-Size'] is not None and self.base_server:
+                try:
+                    file_complete = self.base_server.received_files.is_intact(
+                        device_name, ReceivedFilesIndex.relative_path(file_path, file_name),
+                        int(self.headers['File-Size']), self.headers['File-Hash'])
+                except ValueError:
+                    pass
+            if file_complete:
+                file_size = int(self.headers['File-Size'])
+            else:
+                partial_path, _ = self.upload_paths(device_name, file_path, file_name)
+                file_size = os.path.getsize(partial_path) if os.path.isfile(partial_path) else 0
+            self.send_reply(200, 'cdrv-cmd/File-Status', {'File-Size': str(file_size),
+                                                          'File-Complete': 'true' if file_complete else 'false'})
+            return
+
+        self.send_reply(200, 'text/html')
 
     def do_POST(self):
         # Unpack metadata
@@ -51,112 +203,215 @@ class BaseAppleWatchRequestHandler(BaseHTTPRequestHandler):
 
         if None in [file_type, device_type, device_name, file_path, file_name]:
             logging.error(device_name + " - Badly formatted request - missing some headers.")
-            self.send_response(400)
-            self.end_headers()
+            self.send_reply(400, close_connection=True)
             return
 
         if content_type != 'cdrv-cmd/File-Upload':
             logging.warning(device_name + " - Unknown command: " + content_type)
-            self.send_response(400)
-            self.end_headers()
+            self.send_reply(400, close_connection=True)
             return
 
+        # Uploaded part of the file, if only a part is sent
+        start, total = 0, content_length
+        content_range = self.headers['Content-Range']
+        if content_range is not None:
+            byte_range = self.parse_content_range(content_range)
+            if byte_range is None or byte_range[1] - byte_range[0] + 1 != content_length:
+                logging.error(device_name + " - Invalid Content-Range: " + content_range)
+                self.send_reply(400, 'file-transfer/invalid-range', close_connection=True)
+                return
+            start, _, total = byte_range
+
+        # Compressed upload? Ranges are only supported for uncompressed data, since they are offsets in the file.
+        content_encoding = (self.headers['Content-Encoding'] or 'identity').strip().lower()
+        decoded_length = content_length
+        if content_encoding != 'identity':
+            if content_encoding not in StreamDecoder.supported_encodings():
+                logging.error(device_name + " - Unsupported Content-Encoding: " + content_encoding)
+                self.send_reply(415, 'file-transfer/invalid-encoding', close_connection=True)
+                return
+            try:
+                decoded_length = int(self.headers['X-Decoded-Length'])
+            except (TypeError, ValueError):
+                decoded_length = -1
+            if content_range is not None or decoded_length < 0:
+                logging.error(device_name + " - Compressed uploads require X-Decoded-Length and no Content-Range.")
+                self.send_reply(400, 'file-transfer/invalid-encoding', close_connection=True)
+                return
+            total = decoded_length
+
         # Prepare to receive data
-        destination_dir = (self.base_server.data_path + '/ToProcess/' + device_name + '/' + file_path + '/')\
-            .replace('//', '/').replace('/', os.sep)
-        destination_path = destination_dir + file_name
+        partial_path, destination_path = self.upload_paths(device_name, file_path, file_name)
+        relative_path = ReceivedFilesIndex.relative_path(file_path, file_name)
 
         file_name = device_name + file_path + '/' + file_name
-        logging.info(device_name + " - Receiving: " + file_name + " (" + str(content_length) + " bytes)")
+        logging.info(device_name + " - Receiving: " + file_name + " (" + str(content_length) + " bytes" +
+                     (", from byte " + str(start) + "/" + str(total) if content_range is not None else "") +
+                     (", " + content_encoding + " encoded, " + str(decoded_length) + " bytes decoded"
+                      if content_encoding != 'identity' else "") + ")")
 
         # Check if file exists and size matches
-        file_infos = Path(destination_path)
-        if file_infos.exists():
-            file_infos = os.stat(destination_path)
-            if file_infos.st_size < content_length:
-                logging.warning(device_name + ": " + file_name + " - Existing file, but incomplete (" +
-                                str(file_infos.st_size) + "/" + str(content_length) + " bytes), resending.")
-            else:
-                logging.warning(device_name + ": " + file_name + " - Existing file - replacing file.")
+        if os.path.exists(destination_path) and start == 0:
+            logging.warning(device_name + ": " + file_name + " - Existing file - replacing file.")
+        partial_size = os.path.getsize(partial_path) if os.path.isfile(partial_path) else 0
+        if start > partial_size:
+            # Missing data between what we have and what is sent - the device must resend from what we have
+            logging.warning(device_name + ": " + file_name + " - Can't resume at byte " + str(start) + ", only " +
+                            str(partial_size) + " bytes received.")
+            self.send_reply(416, 'file-transfer/invalid-range', {'File-Size': str(partial_size)},
+                            close_connection=True)
+            return
+        if start > 0:
+            logging.info(device_name + ": " + file_name + " - Resuming transfer at byte " + str(start) + ".")
 
         # Destination directory if it doesn't exist
-        Path(destination_dir).mkdir(parents=True, exist_ok=True)
-
-        # Gets the data and save to file
-        buffer_size = 4 * 1024
-        content_size_remaining = content_length
-        # last_pc = -1
+        Path(os.path.dirname(partial_path)).mkdir(parents=True, exist_ok=True)
 
         # Supported file type?
         if file_type.lower() in ['data', 'dat', 'csv', 'txt', 'oimi']:
+            # Reserve space for the file - if the storage is too full, the device is asked to retry later
+            reserved_size = decoded_length
+            if not StorageBudget.reserve(self.base_server.data_path, reserved_size, self.base_server.min_free_space):
+                logging.warning(device_name + " - " + file_name + " - Not enough free space, retry later.")
+                self.send_reply(507, 'file-transfer/storage-full', {'Retry-After': str(self.base_server.retry_after)},
+                                close_connection=True)
+                self.count_upload('rejected')
+                return
 
-            # if file_type.lower() in ['data', 'dat']:
-            # Binary file
-            fh = open(destination_path, 'wb')
-            # text_format = False
-            # else:
-            # Text file
-            # fh = open(destination_path, 'w')
-            # text_format = True
-
-            while content_size_remaining > 0:
-                if buffer_size > content_size_remaining:
-                    buffer_size = content_size_remaining
+            # Limit the number of files received at the same time - others wait, then are asked to retry later
+            upload_slots = self.base_server.upload_slots
+            if upload_slots and not upload_slots.acquire(timeout=self.base_server.connection_timeout or 30):
+                StorageBudget.release(self.base_server.data_path, reserved_size)
+                logging.warning(device_name + " - " + file_name + " - Too many uploads in progress, retry later.")
+                self.send_reply(503, 'file-transfer/busy', {'Retry-After': str(self.base_server.retry_after)},
+                                close_connection=True)
+                self.count_upload('rejected')
+                return
+            receive_start = time.monotonic()
+            self.received_size = 0
+            source = StreamDecoder(self.rfile, content_length, content_encoding)
+            self.base_server.devices.begin_receiving(device_name)
+            try:
+                # Gets the data and save to file, hashing it on the fly
                 try:
-                    data = self.rfile.read(buffer_size)
+                    with self._partial_hashes_lock:
+                        partial_hash = self._partial_hashes.pop(partial_path, None)
+                    if start == 0:
+                        file_hash = ReceivedFilesIndex.new_hash()
+                    elif partial_hash and partial_hash[0] == start:
+                        file_hash = partial_hash[1]
+                    else:
+                        file_hash = ReceivedFilesIndex.hash_file(partial_path, start)
+                    try:
+                        with open(partial_path, 'r+b' if start > 0 else 'wb') as fh:
+                            fh.seek(start)
+                            fh.truncate()
+                            received_size = self.receive_file(fh, source, decoded_length, file_hash)
+                            if start + received_size == total and self.base_server.durability != 'none':
+                                # Complete file must be on disk before being moved to be processed
+                                fh.flush()
+                                os.fsync(fh.fileno())
+                    finally:
+                        if start + self.received_size < total:
+                            with self._partial_hashes_lock:
+                                self._partial_hashes[partial_path] = (start + self.received_size, file_hash)
+                except ValueError as err:
+                    # Corrupted compressed data
+                    logging.error(device_name + " - Error decoding " + file_name + ": " + str(err))
+                    self.send_reply(400, 'file-transfer/invalid-encoding', close_connection=True)
+                    with self._partial_hashes_lock:
+                        self._partial_hashes.pop(partial_path, None)
+                    os.remove(partial_path)
+                    self.count_upload('error')
+                    return
                 except OSError as err:
+                    # Keep what was received so far, so the transfer can be resumed
                     err_desc = err.strerror
                     if not err_desc and len(err.args) > 0:
                         err_desc = err.args[0]
                     logging.error(device_name + " - Error occured while transferring " + file_name + ": " +
                                   str(err_desc))
-                    fh.close()
-                    os.remove(destination_path)
+                    self.close_connection = True
+                    self.count_upload('error')
                     return
-
-                # if text_format:
-                #     fh.write(data.decode(errors="ignore"))  # Ignore unknown characters and errors
-                # else:
-                fh.write(data)
-                content_size_remaining -= buffer_size
-            fh.close()
+            finally:
+                self.base_server.devices.end_receiving(device_name)
+                if upload_slots:
+                    upload_slots.release()
+                StorageBudget.release(self.base_server.data_path, reserved_size)
+                Metrics.inc('pihub_watch_received_bytes_total', self.received_size,
+                            'Bytes received from watches (decoded)', device=device_name)
+                Metrics.inc('pihub_watch_received_encoded_bytes_total', source.raw_count,
+                            'Bytes of upload requests bodies from watches', device=device_name)
+                Metrics.observe('pihub_watch_receive_seconds', time.monotonic() - receive_start,
+                                'Duration of files uploads from watches')
         else:
             # self.streamer.add_log.emit(device_name + ": " + file_name + " - Type de fichier non-supporté: " +
             #                            file_type.lower(), LogTypes.LOGTYPE_ERROR)
             logging.error(device_name + " - " + file_name + " - Unsupported file type: " + file_type.lower())
-            self.send_response(400)
-            self.send_header('Content-type', 'file-transfer/invalid-file-type')
-            self.end_headers()
+            self.send_reply(400, 'file-transfer/invalid-file-type', close_connection=True)
             return
 
         # Check if everything was received correctly
-        file_infos = os.stat(destination_path)
-        if file_infos.st_size < content_length:
-            # Missing data?!?!
-            error = "Transfer error: " + str(file_infos.st_size) + " bytes received, " + str(content_length) + \
+        if received_size < decoded_length:
+            # Missing data?!?! Keep what was received so far, so the transfer can be resumed
+            error = "Transfer error: " + str(received_size) + " bytes received, " + str(decoded_length) + \
                     " expected."
             logging.error(device_name + " - " + file_name + " - " + error)
-            self.send_response(400)
-            self.send_header('Content-type', 'file-transfer/error')
-            self.end_headers()
-            os.remove(destination_path)
+            self.send_reply(400, 'file-transfer/error', {'File-Size': str(start + received_size)},
+                            close_connection=True)
+            self.count_upload('error')
             return
 
-        if content_length == 0 or (file_infos.st_size == 0 and content_length != 0):
+        if total == 0 or start + received_size == 0:
             error = "Transfer error: 0 byte received."
             logging.error(device_name + " - " + file_name + " - " + error)
-            self.send_response(400)
-            self.send_header('Content-type', 'file-transfer/error')
-            self.end_headers()
-            os.remove(destination_path)
+            self.send_reply(400, 'file-transfer/error')
+            os.remove(partial_path)
+            self.count_upload('error')
+            return
+
+        if start + received_size < total:
+            # More parts to come
+            self.send_reply(202, 'file-transfer/partial-ack', {'File-Size': str(start + received_size)})
+            self.count_upload('partial')
+            return
+
+        # Complete file - check if it matches what the device sent
+        validation_start = time.monotonic()
+        file_hash = file_hash.hexdigest()
+        expected_hash = self.headers['File-Hash']
+        if expected_hash is not None and expected_hash.lower() != file_hash:
+            logging.error(device_name + " - " + file_name + " - Transfer error: hash mismatch.")
+            self.send_reply(400, 'file-transfer/hash-mismatch')
+            os.remove(partial_path)
+            self.count_upload('error')
+            return
+        if self.base_server.received_files.is_intact(device_name, relative_path, total, file_hash):
+            logging.info(device_name + ": " + file_name + " - Identical to the previously received file.")
+
+        # Ready to be processed
+        try:
+            Path(os.path.dirname(destination_path)).mkdir(parents=True, exist_ok=True)
+            os.replace(partial_path, destination_path)
+            if self.base_server.durability == 'full':
+                # Directories (new dataset folder included) are synchronized in batch
+                self.base_server.directory_syncer.add(os.path.dirname(destination_path))
+                self.base_server.directory_syncer.add(os.path.dirname(os.path.dirname(destination_path)))
+            self.base_server.received_files.set(device_name, relative_path, total, file_hash)
+        except OSError as err:
+            logging.error(device_name + " - Error moving " + file_name + " to be processed: " + str(err))
+            self.send_reply(500, 'file-transfer/error')
+            self.count_upload('error')
             return
+        Metrics.observe('pihub_watch_validation_seconds', time.monotonic() - validation_start,
+                        'Duration of received files validation (hash check, move and index update)')
 
         # All is good!
         logging.info("Completed: " + device_name + " - " + file_name)
 
-        self.send_response(200)
-        self.send_header('Content-type', 'file-transfer/ack')
-        self.end_headers()
+        self.send_reply(200, 'file-transfer/ack', {'File-Hash': file_hash})
+        self.count_upload('complete')
 
         # Signal base server that we got new files
         if self.base_server:
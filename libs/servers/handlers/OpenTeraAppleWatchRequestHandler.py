@@ -1,5 +1,4 @@
 from libs.servers.handlers.BaseAppleWatchRequestHandler import BaseAppleWatchRequestHandler
-from opentera_libraries.device.DeviceComManager import DeviceComManager
 import urllib.parse
 
 import logging
@@ -21,9 +20,7 @@ class OpenTeraAppleWatchRequestHandler(BaseAppleWatchRequestHandler):
             opentera_config = self.base_server.opentera_config
 
             if query_path.endswith('register'):
-                device_com = DeviceComManager(server_url=opentera_config['hostname'],
-                                              server_port=opentera_config['port'],
-                                              allow_insecure=self.base_server.allow_insecure_server)
+                device_com = self.base_server.opentera_clients.registration_client()
                 if 'name' not in params or 'type_key' not in params:
                     self.send_error(400, 'Bad parameters')
                     return
@@ -43,9 +40,14 @@ class OpenTeraAppleWatchRequestHandler(BaseAppleWatchRequestHandler):
                 else:
                     logging.warning("Register failed: " + str(response.status_code) + " - " + response.reason)
                 self.forward_opentera_response(response)
+                return
             else:
-                response = requests.get(url=self.base_server.opentera_server_url + query_path, params=query_params,
-                                        headers=self.headers, verify=not self.base_server.allow_insecure_server)
+                # Connections to OpenTera are kept alive and shared by all requests - hop-by-hop headers are not
+                # forwarded
+                headers = {header: value for header, value in self.headers.items()
+                           if header.lower() not in ['connection', 'keep-alive']}
+                response = self.base_server.opentera_clients.session.get(
+                    url=self.base_server.opentera_server_url + query_path, params=query_params, headers=headers)
                 # Copy response from OpenTera
                 self.forward_opentera_response(response)
                 return
@@ -64,8 +66,15 @@ class OpenTeraAppleWatchRequestHandler(BaseAppleWatchRequestHandler):
         super().do_POST()
 
     def forward_opentera_response(self, response: requests.Response):
+        # Content is already decoded by requests - its length and encoding must be set again
         self.send_response_only(response.status_code)
         for header in response.headers:
+            if header.lower() in ['content-length', 'content-encoding', 'transfer-encoding', 'connection',
+                                  'keep-alive']:
+                continue
             self.send_header(header, response.headers[header])
+        self.send_header('Content-Length', str(len(response.content)))
+        if self.close_connection:
+            self.send_header('Connection', 'close')
         self.end_headers()
-        self.wfile.write(bytes(response.text, 'utf-8'))
+        self.wfile.write(response.content)
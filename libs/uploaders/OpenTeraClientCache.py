@@ -0,0 +1,154 @@
+##################################################
+# PiHub OpenTera clients cache
+##################################################
+from opentera_libraries.device.DeviceComManager import DeviceComManager
+import opentera_libraries.device.DeviceAPI as DeviceAPI
+from requests.adapters import HTTPAdapter
+
+from libs.utils.Metrics import Metrics
+
+import json
+import logging
+import requests
+import threading
+import time
+
+
+class PooledDeviceComManager(DeviceComManager):
+    # DeviceComManager sending its requests with a shared requests.Session - a keep-alive pool of connections to the
+    # server - so consecutive requests don't each need a new connection and TLS handshake. The requests used by PiHub
+    # are sent here on the session, following the OpenTera device API (the token is sent in the Authorization header).
+
+    assets_upload_endpoint = '/file/api/assets'     # Assets are uploaded through the file transfer service
+
+    def __init__(self, session: requests.Session, server_url: str, server_port: int, allow_insecure: bool = False):
+        super().__init__(server_url=server_url, server_port=server_port, allow_insecure=allow_insecure)
+        self.session = session
+        self.base_url = 'https://' + server_url + ':' + str(server_port)
+
+    def authorization(self, token: str | None) -> dict:
+        return {'Authorization': 'OpenTera ' + token} if token else {}
+
+    def do_get(self, endpoint: str, params: dict | None = None) -> requests.Response:
+        return self.session.get(url=self.base_url + endpoint, params=params, headers=self.authorization(self.token))
+
+    def do_post(self, endpoint: str, data: dict) -> requests.Response:
+        return self.session.post(url=self.base_url + endpoint, json=data, headers=self.authorization(self.token))
+
+    def upload_file(self, id_session: int, asset_name: str, file_path: str) -> requests.Response:
+        with open(file_path, 'rb') as f:
+            return self.session.post(url=self.base_url + self.assets_upload_endpoint,
+                                     headers=self.authorization(self.token),
+                                     data={'file_asset': json.dumps({'id_session': id_session,
+                                                                     'asset_name': asset_name})},
+                                     files={'file': (asset_name, f)})
+
+    def register_device(self, server_key: str, device_name: str, device_type_key: str,
+                        device_subtype_name: str | None = None) -> requests.Response:
+        device_info = {'device_name': device_name, 'device_type_key': device_type_key}
+        if device_subtype_name:
+            device_info['device_subtype_name'] = device_subtype_name
+        return self.session.post(url=self.base_url + DeviceAPI.ENDPOINT_DEVICE_REGISTER,
+                                 headers=self.authorization(server_key), json={'device_info': device_info})
+
+
+class OpenTeraClientCache:
+    # OpenTera clients of the devices, kept between transfers along with their login response (device, participants
+    # and session types infos) for login_ttl seconds. A login is thus only done once per sync window, unless the
+    # server refuses the token (401 / 403), which invalidates the cached login. All requests to the server (devices
+    # clients and proxied requests) share a pool of keep-alive connections.
+
+    def __init__(self, hostname: str, port: int, allow_insecure: bool, login_ttl: float = 300,
+                 pool_size: int = 16):
+        self.hostname = hostname
+        self.port = port
+        self.allow_insecure = allow_insecure
+        self.login_ttl = login_ttl
+        self.server_url = 'https://' + hostname + ':' + str(port)
+
+        self.session = requests.Session()
+        self.session.verify = not allow_insecure
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self._lock = threading.Lock()
+        self._clients = {}      # Device name: DeviceComManager
+        self._logins = {}       # Device name: (token, login infos, login time)
+        self._registration_client = None
+
+        # Statistics
+        self.login_count = 0        # Logins done
+        self.cached_login_count = 0  # Logins avoided
+
+    def client(self, device_name: str, token: str) -> DeviceComManager:
+        with self._lock:
+            device_com = self._clients.get(device_name)
+            if not device_com or device_com.token != token:
+                device_com = PooledDeviceComManager(self.session, server_url=self.hostname, server_port=self.port,
+                                                    allow_insecure=self.allow_insecure)
+                device_com.token = token
+                self._clients[device_name] = device_com
+            return device_com
+
+    def registration_client(self) -> DeviceComManager:
+        # Client without token, to register new devices
+        with self._lock:
+            if not self._registration_client:
+                self._registration_client = PooledDeviceComManager(self.session, server_url=self.hostname,
+                                                                   server_port=self.port,
+                                                                   allow_insecure=self.allow_insecure)
+            return self._registration_client
+
+    def login(self, device_name: str, token: str) -> dict | None:
+        # Login infos of the device, or None if the login failed
+        with self._lock:
+            login = self._logins.get(device_name)
+            if login and login[0] == token and time.monotonic() - login[2] < self.login_ttl:
+                self.cached_login_count += 1
+                Metrics.inc('pihub_opentera_logins_total', description='OpenTera devices logins, by result',
+                            result='cached')
+                return login[1]
+
+        device_com = self.client(device_name, token)
+        try:
+            response = device_com.do_get(DeviceAPI.ENDPOINT_DEVICE_LOGIN)
+        except Exception as e:
+            logging.error('OpenTera: Unable to login device ' + device_name + ': ' + str(e))
+            Metrics.inc('pihub_opentera_logins_total', description='OpenTera devices logins, by result',
+                        result='error')
+            return None
+
+        if response.status_code != 200:
+            logging.error('OpenTera: Unable to login device ' + device_name + ': ' + str(response.status_code) +
+                          ' - ' + response.text.strip())
+            Metrics.inc('pihub_opentera_logins_total', description='OpenTera devices logins, by result',
+                        result='error')
+            self.invalidate(device_name)
+            return None
+
+        login_infos = response.json()
+        with self._lock:
+            self._logins[device_name] = (token, login_infos, time.monotonic())
+            self.login_count += 1
+        Metrics.inc('pihub_opentera_logins_total', description='OpenTera devices logins, by result',
+                    result='login')
+        return login_infos
+
+    def check_response(self, device_name: str, response: requests.Response):
+        # Token refused - the device must login again
+        if response.status_code in [401, 403]:
+            logging.warning('OpenTera: ' + device_name + ' not authorized (' + str(response.status_code) +
+                            ') - login required.')
+            self.invalidate(device_name)
+
+    def invalidate(self, device_name: str):
+        with self._lock:
+            self._logins.pop(device_name, None)
+            self._clients.pop(device_name, None)
+
+    def close(self):
+        with self._lock:
+            self._clients.clear()
+            self._logins.clear()
+        self.session.close()
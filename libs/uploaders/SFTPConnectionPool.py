@@ -0,0 +1,186 @@
+##################################################
+# PiHub SFTP connections pool
+##################################################
+from contextlib import contextmanager
+
+import fabric
+from paramiko import SFTPClient
+
+from libs.uploaders.SFTPMetadataCache import SFTPMetadataCache
+from libs.utils.Metrics import Metrics
+
+import logging
+import socket
+import threading
+import time
+
+
+class SFTPSession:
+
+    def __init__(self, connection: fabric.Connection, metadata_cache_ttl: float | None = None,
+                 channel_timeout: float | None = None):
+        self.connection = connection
+        self.client: SFTPClient = connection.sftp()
+        # A request without an answer (half-open link) fails instead of blocking forever
+        self.client.get_channel().settimeout(channel_timeout)
+        self.last_used = time.monotonic()
+        # Known remote directories and files for that session
+        self.metadata_cache = SFTPMetadataCache(ttl=metadata_cache_ttl)
+
+    def is_active(self) -> bool:
+        transport = self.connection.client.get_transport()
+        if not transport or not transport.is_active():
+            return False
+        channel = self.client.get_channel()
+        return channel is not None and not channel.closed
+
+    def is_healthy(self, check_interval: float) -> bool:
+        if not self.is_active():
+            return False
+        if time.monotonic() - self.last_used < check_interval:
+            return True
+        # Idle for a while - make sure the server still answers
+        try:
+            self.client.normalize('.')
+        except (IOError, EOFError, socket.timeout):
+            return False
+        return True
+
+    def close(self):
+        try:
+            self.connection.close()
+        except Exception as e:
+            logging.debug('SFTPSession: error closing connection - ' + str(e))
+
+
+class SFTPConnectionPool:
+    # Process-wide pool of opened SFTP sessions, shared by all servers. Sessions are borrowed for the duration of a
+    # transfer, then kept opened (with SSH keepalive) to be reused by the next transfer to the same server.
+
+    keepalive_interval = 30     # Seconds between SSH keepalive packets
+    metadata_cache_ttl = 300    # Seconds remote metadata is kept between transfers (0 = only during a transfer)
+    idle_timeout = 300          # Seconds before an unused session is closed
+    max_idle_sessions = 4       # Maximum number of unused sessions kept per server
+    channel_timeout = 60        # Seconds to wait for an answer of the server before giving up
+
+    _lock = threading.Lock()
+    _idle_sessions = {}         # Server key: list of unused sessions, most recently used last
+    _cleanup_timer = None
+
+    # Statistics
+    handshake_count = 0         # New connections opened
+    reuse_count = 0             # Transfers done on an already opened session (handshakes avoided)
+    evicted_count = 0           # Sessions closed because they were idle or not healthy anymore
+
+    @staticmethod
+    def server_key(sftp_config: dict) -> tuple:
+        return sftp_config['hostname'], sftp_config['port'], sftp_config['username']
+
+    @staticmethod
+    @contextmanager
+    def session(sftp_config: dict):
+        session = SFTPConnectionPool.acquire(sftp_config)
+        try:
+            yield session
+        except BaseException:
+            # Session state is unknown after an error - don't reuse it
+            session.close()
+            raise
+        SFTPConnectionPool.release(sftp_config, session)
+
+    @staticmethod
+    def acquire(sftp_config: dict) -> SFTPSession:
+        key = SFTPConnectionPool.server_key(sftp_config)
+        while True:
+            with SFTPConnectionPool._lock:
+                sessions = SFTPConnectionPool._idle_sessions.get(key, [])
+                session = sessions.pop() if sessions else None
+            if not session:
+                break
+            if time.monotonic() - session.last_used < sftp_config.get('idle_timeout', SFTPConnectionPool.idle_timeout)\
+                    and session.is_healthy(SFTPConnectionPool.keepalive_interval):
+                with SFTPConnectionPool._lock:
+                    SFTPConnectionPool.reuse_count += 1
+                if not sftp_config.get('metadata_cache_ttl', SFTPConnectionPool.metadata_cache_ttl):
+                    session.metadata_cache.invalidate()
+                return session
+            # Dead or expired session - try the next one
+            session.close()
+            with SFTPConnectionPool._lock:
+                SFTPConnectionPool.evicted_count += 1
+
+        connection = fabric.Connection(host=sftp_config["hostname"], user=sftp_config["username"],
+                                       connect_kwargs={'password': sftp_config["password"]},
+                                       port=sftp_config["port"], connect_timeout=10)
+        connection.open()
+        connection.client.get_transport().set_keepalive(sftp_config.get('keepalive_interval',
+                                                                         SFTPConnectionPool.keepalive_interval))
+        with SFTPConnectionPool._lock:
+            SFTPConnectionPool.handshake_count += 1
+        return SFTPSession(connection, sftp_config.get('metadata_cache_ttl', SFTPConnectionPool.metadata_cache_ttl)
+                           or None, sftp_config.get('channel_timeout', SFTPConnectionPool.channel_timeout))
+
+    @staticmethod
+    def release(sftp_config: dict, session: SFTPSession):
+        key = SFTPConnectionPool.server_key(sftp_config)
+        session.last_used = time.monotonic()
+        with SFTPConnectionPool._lock:
+            sessions = SFTPConnectionPool._idle_sessions.setdefault(key, [])
+            sessions.append(session)
+            extra_sessions = sessions[:-SFTPConnectionPool.max_idle_sessions]
+            del sessions[:-SFTPConnectionPool.max_idle_sessions]
+            SFTPConnectionPool.evicted_count += len(extra_sessions)
+            if not SFTPConnectionPool._cleanup_timer:
+                SFTPConnectionPool._schedule_cleanup(sftp_config.get('idle_timeout', SFTPConnectionPool.idle_timeout))
+        for extra_session in extra_sessions:
+            extra_session.close()
+
+    @staticmethod
+    def cleanup(idle_timeout: float):
+        # Close sessions that were not used for a while
+        expired_sessions = []
+        with SFTPConnectionPool._lock:
+            SFTPConnectionPool._cleanup_timer = None
+            now = time.monotonic()
+            for key, sessions in SFTPConnectionPool._idle_sessions.items():
+                expired_sessions.extend([session for session in sessions if now - session.last_used >= idle_timeout])
+                sessions[:] = [session for session in sessions if now - session.last_used < idle_timeout]
+            SFTPConnectionPool.evicted_count += len(expired_sessions)
+            if any(SFTPConnectionPool._idle_sessions.values()):
+                SFTPConnectionPool._schedule_cleanup(idle_timeout)
+        for session in expired_sessions:
+            session.close()
+        if expired_sessions:
+            logging.info('SFTPConnectionPool: closed ' + str(len(expired_sessions)) + ' idle session(s) - ' +
+                         str(SFTPConnectionPool.handshake_count) + ' handshake(s), ' +
+                         str(SFTPConnectionPool.reuse_count) + ' reuse(s) so far.')
+
+    @staticmethod
+    def close_all():
+        with SFTPConnectionPool._lock:
+            sessions = [session for sessions in SFTPConnectionPool._idle_sessions.values() for session in sessions]
+            SFTPConnectionPool._idle_sessions.clear()
+            if SFTPConnectionPool._cleanup_timer:
+                SFTPConnectionPool._cleanup_timer.cancel()
+                SFTPConnectionPool._cleanup_timer = None
+        for session in sessions:
+            session.close()
+
+    @staticmethod
+    def _schedule_cleanup(idle_timeout: float):
+        # Must be called with the lock held
+        SFTPConnectionPool._cleanup_timer = threading.Timer(idle_timeout / 2, SFTPConnectionPool.cleanup,
+                                                            [idle_timeout])
+        SFTPConnectionPool._cleanup_timer.daemon = True
+        SFTPConnectionPool._cleanup_timer.start()
+
+
+Metrics.register_gauge('pihub_sftp_handshakes_total', lambda: SFTPConnectionPool.handshake_count,
+                       'SFTP connections opened', 'counter')
+Metrics.register_gauge('pihub_sftp_session_reuses_total', lambda: SFTPConnectionPool.reuse_count,
+                       'Transfers done on an already opened SFTP session', 'counter')
+Metrics.register_gauge('pihub_sftp_idle_sessions', lambda: sum(len(sessions) for sessions in
+                                                               list(SFTPConnectionPool._idle_sessions.values())),
+                       'Opened SFTP sessions waiting to be reused')
+Metrics.register_gauge('pihub_sftp_metadata_cache_saved_requests_total', lambda: SFTPMetadataCache.saved_round_trips,
+                       'SFTP requests answered by the remote metadata cache', 'counter')
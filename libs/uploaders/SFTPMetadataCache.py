@@ -0,0 +1,72 @@
+##################################################
+# PiHub SFTP remote metadata cache
+##################################################
+from paramiko import SFTPAttributes
+
+import posixpath
+import stat
+import threading
+import time
+
+
+class SFTPMetadataCache:
+    # Remote paths attributes (or None if the path doesn't exist) known for an SFTP session. Entries expire after ttl
+    # seconds, if set, since other clients could change the server files. Once a directory is listed, any path in it
+    # that isn't in the cache is known not to exist.
+
+    _lock = threading.Lock()
+    saved_round_trips = 0       # Total of remote requests answered by all caches
+
+    def __init__(self, ttl: float | None = None):
+        self.ttl = ttl
+        self.hits = 0
+        self._entries = {}      # Remote path: (attributes, time added)
+        self._listings = {}     # Listed remote directory: time listed
+
+    def get(self, remotepath: str) -> tuple:
+        # Returns (found, attributes)
+        entry = self._entries.get(remotepath)
+        if entry is not None and self.ttl is not None and time.monotonic() - entry[1] > self.ttl:
+            del self._entries[remotepath]
+            entry = None
+        if entry is None:
+            if not self.is_listed(posixpath.dirname(remotepath)):
+                return False, None
+            entry = (None, None)
+        self.hits += 1
+        with SFTPMetadataCache._lock:
+            SFTPMetadataCache.saved_round_trips += 1
+        return True, entry[0]
+
+    def set(self, remotepath: str, attributes: SFTPAttributes | None):
+        self._entries[remotepath] = (attributes, time.monotonic())
+
+    def set_directory(self, remotepath: str):
+        attributes = SFTPAttributes()
+        attributes.st_mode = stat.S_IFDIR | 0o755
+        self.set(remotepath, attributes)
+
+    def is_listed(self, remotedir: str) -> bool:
+        listed_time = self._listings.get(remotedir)
+        if listed_time is None:
+            return False
+        if self.ttl is not None and time.monotonic() - listed_time > self.ttl:
+            del self._listings[remotedir]
+            return False
+        return True
+
+    def set_listing(self, remotedir: str, attributes_list: list):
+        # Directory content, from SFTPClient.listdir_attr
+        self.set_directory(remotedir)
+        for attributes in attributes_list:
+            self.set(remotedir + '/' + attributes.filename, attributes)
+        self._listings[remotedir] = time.monotonic()
+
+    def invalidate(self, remotepath: str | None = None):
+        if remotepath is None:
+            self._entries.clear()
+            self._listings.clear()
+        else:
+            self._entries.pop(remotepath, None)
+            self._listings.pop(remotepath, None)
+            self._listings.pop(posixpath.dirname(remotepath), None)
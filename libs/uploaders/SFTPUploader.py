@@ -6,17 +6,24 @@
 ##################################################
 import logging
 import os
+import queue
 import time
+import shutil
 import socket
 import stat
+import threading
 from os import walk
 from os import makedirs
 
-import fabric
-from paramiko import BadHostKeyException, AuthenticationException, SSHException, SFTPClient
+from paramiko import BadHostKeyException, AuthenticationException, SSHException, SFTPClient, SFTPAttributes
 
 from libs.hardware.PiHubHardware import PiHubHardware
+from libs.uploaders.SFTPConnectionPool import SFTPConnectionPool
+from libs.uploaders.SFTPMetadataCache import SFTPMetadataCache
+from libs.utils.BedDataFile import BedDataFile, BedTextFile
+from libs.utils.Metrics import Metrics
 from libs.utils.Network import Network
+from libs.utils.TextFileMerge import TextFileMerge
 
 
 class SFTPUploader:
@@ -30,99 +37,164 @@ class SFTPUploader:
 
         # Do the transfer
         logging.info('About to send files to server at ' + sftp_config["hostname"] + ':' + str(sftp_config["port"]))
+        pending_files = queue.Queue()
+        for file_server_location, file_to_transfer in zip(files_directory_on_server, files_to_transfer):
+            pending_files.put((file_server_location, file_to_transfer))
+        files_count = pending_files.qsize()
+        failed_files = []
+        saved_round_trips = SFTPMetadataCache.saved_round_trips
+
+        # Each worker sends files on its own SFTP session until all files are sent
+        parallel_transfers = max(1, min(sftp_config.get('parallel_transfers', 1), files_count))
+        if parallel_transfers == 1:
+            SFTPUploader.sftp_send_worker(sftp_config, pending_files, failed_files, file_transferred_callback)
+        else:
+            workers = [threading.Thread(target=SFTPUploader.sftp_send_worker,
+                                        args=(sftp_config, pending_files, failed_files, file_transferred_callback),
+                                        name=threading.current_thread().name + 'SFTP' + str(index))
+                       for index in range(parallel_transfers)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+
+        # Files left if no session could be opened
+        while not pending_files.empty():
+            failed_files.append(pending_files.get_nowait()[1])
+
+        logging.debug('Remote metadata cache saved ' + str(SFTPMetadataCache.saved_round_trips - saved_round_trips) +
+                      ' round-trip(s).')
+        if failed_files:
+            logging.error(str(len(failed_files)) + '/' + str(files_count) + ' file(s) not transferred: ' +
+                          ', '.join(failed_files))
+            return False
+        logging.info('Files transfer complete!')
+        return True
+
+    @staticmethod
+    def sftp_send_worker(sftp_config: dict, pending_files: queue.Queue, failed_files: list,
+                         file_transferred_callback: callable = None):
         file_to_transfer = None
         try:
-            with fabric.Connection(host=sftp_config["hostname"], user=sftp_config["username"],
-                                   connect_kwargs={'password': sftp_config["password"]},
-                                   port=sftp_config["port"], connect_timeout=10) as c:
-                c.open()
-                client: SFTPClient = c.sftp()
-                for file_server_location, file_to_transfer in zip(files_directory_on_server, files_to_transfer):
-                    # Create directories on server if needed
-                    if not (SFTPUploader.isdir(client, file_server_location)):
-                        SFTPUploader.makedirs(client, file_server_location)
-
-                    # Move to directory
-                    # client.chdir(file_server_location)
-                    file_name = os.path.basename(file_to_transfer)
-                    # Query file size from server and compare to local file size
-                    local_attr = os.stat(file_to_transfer)
-                    local_size = local_attr.st_size
-                    remote_file_name = file_server_location + '/' + file_name
+            with SFTPConnectionPool.session(sftp_config) as session:
+                client: SFTPClient = session.client
+                while True:
                     try:
-                        remote_attr = client.lstat(remote_file_name)
-                        remote_size = remote_attr.st_size
-                        if local_size == remote_size:
-                            # Same size on server as local file, skip!
-                            logging.info('Skipping ' + file_to_transfer + ': already present on server.')
-                            if file_transferred_callback:
-                                file_transferred_callback(file_to_transfer)
-                            continue
-                    except IOError:
-                        # File not on server = ok, continue!
-                        pass
-
-                    logging.info('Sending ' + file_to_transfer + ' to ' + file_server_location + ' ...')
-                    client.put(localpath=file_to_transfer, remotepath=remote_file_name, confirm=True,
-                               callback=lambda current, total:
-                               SFTPUploader.file_upload_progress(current, total, file_to_transfer,
-                                                                 file_transferred_callback))
-                    # Update time on server
-                    times = (local_attr.st_atime, local_attr.st_mtime)
-                    client.utime(remote_file_name, times)
-
-        except (BadHostKeyException, SSHException, AuthenticationException, socket.error, IOError) as exc:
+                        file_server_location, file_to_transfer = pending_files.get_nowait()
+                    except queue.Empty:
+                        break
+                    SFTPUploader.sftp_put(client, file_server_location, file_to_transfer, file_transferred_callback,
+                                          session.metadata_cache)
+                    file_to_transfer = None
+
+        except Exception as exc:
+            # Any error (EOFError when the link drops, for example) must be reported: the pooled session is closed,
+            # and the file being sent is marked as failed so a retry is planned
             err_msg = str(exc)
             if hasattr(exc, 'message'):
                 err_msg = exc.message + ' ' + err_msg
             if file_to_transfer:
+                # Session is closed on errors - this worker stops and leaves remaining files to the others
+                failed_files.append(file_to_transfer)
                 logging.error('Error occurred transferring ' + str(file_to_transfer) + ': ' + err_msg)
             else:
                 logging.error('Error occured while trying to transfer: ' + err_msg)
-            return False
-        logging.info('Files transfer complete!')
-        return True
+
+    @staticmethod
+    def sftp_put(client: SFTPClient, file_server_location: str, file_to_transfer: str,
+                 file_transferred_callback: callable = None, cache: SFTPMetadataCache = None):
+        # List the target directory once, so the checks below don't need a request for each file
+        if cache and not cache.is_listed(file_server_location):
+            SFTPUploader.list_directory(client, file_server_location, cache)
+
+        # Create directories on server if needed
+        if not (SFTPUploader.isdir(client, file_server_location, cache)):
+            SFTPUploader.makedirs(client, file_server_location, cache)
+
+        # Move to directory
+        # client.chdir(file_server_location)
+        file_name = os.path.basename(file_to_transfer)
+        # Query file size and time from server and compare to local file
+        local_attr = os.stat(file_to_transfer)
+        remote_file_name = file_server_location + '/' + file_name
+        remote_attr = SFTPUploader.lstat(client, remote_file_name, cache)
+        if remote_attr and local_attr.st_size == remote_attr.st_size and \
+                int(local_attr.st_mtime) == remote_attr.st_mtime:
+            # Same file on server as local file, skip!
+            logging.info('Skipping ' + file_to_transfer + ': already present on server.')
+            SFTPUploader.record_upload('skipped')
+            if file_transferred_callback:
+                file_transferred_callback(file_to_transfer)
+            return
+
+        logging.info('Sending ' + file_to_transfer + ' to ' + file_server_location + ' ...')
+        start_time = time.monotonic()
+        try:
+            remote_attr = client.put(localpath=file_to_transfer, remotepath=remote_file_name, confirm=True,
+                                     callback=lambda current, total:
+                                     SFTPUploader.file_upload_progress(current, total, file_to_transfer,
+                                                                       file_transferred_callback))
+            # Update time on server
+            times = (local_attr.st_atime, local_attr.st_mtime)
+            client.utime(remote_file_name, times)
+        except (SSHException, socket.error, IOError, EOFError):
+            SFTPUploader.record_upload('error')
+            if cache:
+                cache.invalidate(remote_file_name)
+                cache.invalidate(file_server_location)
+            raise
+        SFTPUploader.record_upload('sent', local_attr.st_size, time.monotonic() - start_time)
+        if cache:
+            remote_attr.st_atime, remote_attr.st_mtime = int(local_attr.st_atime), int(local_attr.st_mtime)
+            cache.set(remote_file_name, remote_attr)
 
     @staticmethod
     def sftp_merge_and_send(sftp_config: dict, file_path_on_server: str, file_server_location: str,
                             file_to_transfer: str, temporary_file: str, file_transferred_location: str,
                             file_transferred_callback: callable = None,
-                            check_internet: bool = True) -> bool:
+                            check_internet: bool = True, incremental: bool = False) -> bool:
         # Check if Internet connected
         if check_internet:
             PiHubHardware.ensure_internet_is_available()
 
         logging.info('About to get files from server at ' + sftp_config["hostname"] + ':' + str(sftp_config["port"]))
         try:
-            with fabric.Connection(host=sftp_config["hostname"], user=sftp_config["username"],
-                                   connect_kwargs={'password': sftp_config["password"]},
-                                   port=sftp_config["port"], connect_timeout=10) as c:
-                c.open()
-                client: SFTPClient = c.sftp()
+            with SFTPConnectionPool.session(sftp_config) as session:
+                client: SFTPClient = session.client
+                # Only send new data if the server file wasn't changed since the last transfer
+                if incremental and SFTPUploader.sftp_append(client, file_path_on_server=file_path_on_server,
+                                                            file_to_transfer=file_to_transfer,
+                                                            file_transferred_location=file_transferred_location):
+                    os.remove(file_to_transfer)
+                    if file_transferred_callback:
+                        file_transferred_callback(file_to_transfer)
+                    return True
+
+                start_time = time.monotonic()
+
                 # Check if the file exist on remote and get it locally
                 if not (SFTPUploader.isfile(client, file_path_on_server)):
                     logging.info('No file on server to merge with ' + file_to_transfer)
                 else:
                     client.get(file_path_on_server, temporary_file)
+                    merge_start_time = time.monotonic()
                     # Now do the merge in the local file
-                    m_point = "/mnt/app"
-                    lines = lambda f: [line for line in open(f).read().splitlines()]
-                    lines1 = lines(temporary_file)
-                    lines2 = lines(file_to_transfer)
-                    checks = [line.split(m_point)[-1] for line in lines1]
-                    for item in sum([[line for line in lines2 if c in line] for c in checks], []):
-                        lines2.remove(item)
-                    if os.path.isfile(file_to_transfer):
-                        os.remove(file_to_transfer)
-                    file_merged = open(file_to_transfer, "a+")
-                    for item in lines1 + lines2:
-                        file_merged.write(item + "\n")
-                    file_merged.close()
+                    if file_to_transfer.endswith(BedDataFile.extension):
+                        merged_file = file_to_transfer + '.merged'
+                        BedDataFile.merge(base_file=temporary_file, new_file=file_to_transfer,
+                                          merged_file=merged_file)
+                        os.replace(merged_file, file_to_transfer)
+                    else:
+                        TextFileMerge.merge(base_file=temporary_file, new_file=file_to_transfer,
+                                            merged_file=file_to_transfer)
                     os.remove(temporary_file)
+                    Metrics.observe('pihub_sftp_merge_seconds', time.monotonic() - merge_start_time,
+                                    'Duration of local files merges before SFTP uploads')
                     logging.info('Files for ' + file_to_transfer + ' merged')
                 # Then send it to ftp
-                if not (SFTPUploader.isdir(client, file_server_location)):
+                if not (SFTPUploader.isdir(client, file_server_location, session.metadata_cache)):
                     client.mkdir(file_server_location)
+                    session.metadata_cache.set_directory(file_server_location)
 
                 file_name = os.path.basename(file_to_transfer)
                 remote_file_name = file_server_location + '/' + file_name
@@ -135,13 +207,14 @@ class SFTPUploader:
                 # Update time on server
                 times = (local_attr.st_atime, local_attr.st_mtime)
                 client.utime(remote_file_name, times)
+                SFTPUploader.record_upload('merged', local_attr.st_size, time.monotonic() - start_time)
 
                 # Move the local file in the transferred directory
                 if os.path.isfile(file_transferred_location):
                     os.remove(file_transferred_location)
                 os.replace(file_to_transfer, file_transferred_location)
 
-        except (BadHostKeyException, SSHException, AuthenticationException, socket.error, IOError) as exc:
+        except (BadHostKeyException, SSHException, AuthenticationException, socket.error, IOError, EOFError) as exc:
             err_msg = str(exc)
             if hasattr(exc, 'message'):
                 err_msg = exc.message + ' ' + err_msg
@@ -149,9 +222,70 @@ class SFTPUploader:
                 logging.error('Error occurred transferring ' + str(file_to_transfer) + ': ' + err_msg)
             else:
                 logging.error('Error occured while trying to transfer: ' + err_msg)
+            SFTPUploader.record_upload('error')
+            return False
+        return True
+
+    @staticmethod
+    def sftp_append(client: SFTPClient, file_path_on_server: str, file_to_transfer: str,
+                    file_transferred_location: str) -> bool:
+        # The local transferred file is a copy of the server file as of the last transfer. If the server file still has
+        # the same size, append the new data to the transferred file and send only that part to the server.
+        if not os.path.isfile(file_transferred_location):
+            return False
+        transferred_size = os.path.getsize(file_transferred_location)
+        try:
+            remote_size = client.lstat(file_path_on_server).st_size
+        except IOError:
+            remote_size = None
+        if remote_size != transferred_size:
+            logging.info('Server file ' + file_path_on_server + ' changed since last transfer - will merge.')
             return False
+
+        data_file_class = BedDataFile if file_to_transfer.endswith(BedDataFile.extension) else BedTextFile
+        data_file_class.append(file_to_transfer, file_transferred_location)
+        start_time = time.monotonic()
+        try:
+            logging.info('Appending ' + file_to_transfer + ' to ' + file_path_on_server + ' from offset ' +
+                         str(transferred_size) + '...')
+            with open(file_transferred_location, 'rb') as local_file, \
+                    client.open(file_path_on_server, 'r+') as remote_file:
+                local_file.seek(transferred_size)
+                remote_file.seek(transferred_size)
+                remote_file.set_pipelined(True)
+                shutil.copyfileobj(local_file, remote_file, 32768)
+            local_attr = os.stat(file_transferred_location)
+            if client.lstat(file_path_on_server).st_size != local_attr.st_size:
+                raise IOError('Size mismatch after appending to ' + file_path_on_server)
+            client.utime(file_path_on_server, (local_attr.st_atime, local_attr.st_mtime))
+            SFTPUploader.record_upload('appended', local_attr.st_size - transferred_size, time.monotonic() - start_time)
+        except (SSHException, socket.error, IOError, EOFError) as exc:
+            # Remove the partial data from the server file, so it still matches the transferred file
+            try:
+                client.truncate(file_path_on_server, transferred_size)
+            except (SSHException, socket.error, IOError, EOFError) as truncate_exc:
+                logging.warning('Unable to restore ' + file_path_on_server + ' after failed append (' + str(exc) +
+                                '): ' + str(truncate_exc) + ' - sending the whole file.')
+                try:
+                    client.put(localpath=file_transferred_location, remotepath=file_path_on_server)
+                    local_attr = os.stat(file_transferred_location)
+                    client.utime(file_path_on_server, (local_attr.st_atime, local_attr.st_mtime))
+                    SFTPUploader.record_upload('merged', local_attr.st_size, time.monotonic() - start_time)
+                    return True
+                except (SSHException, socket.error, IOError, EOFError):
+                    pass
+            # Restore the transferred file so it still matches what is on the server
+            os.truncate(file_transferred_location, transferred_size)
+            raise
         return True
 
+    @staticmethod
+    def record_upload(result: str, size: int = 0, duration: float = 0.):
+        Metrics.inc('pihub_sftp_uploads_total', description='Files sent to the SFTP server, by result', result=result)
+        if size:
+            Metrics.inc('pihub_sftp_uploaded_bytes_total', size, 'Bytes sent to the SFTP server')
+            Metrics.observe('pihub_sftp_upload_seconds', duration, 'Duration of files uploads to the SFTP server')
+
     @staticmethod
     def file_upload_progress(current_bytes: int, total_bytes: int, filename: str = 'Unknown',
                              file_transferred_callback: callable = None):
@@ -206,32 +340,57 @@ class SFTPUploader:
             os.rmdir(folders[i])
 
     @staticmethod
-    def makedirs(client: SFTPClient, remotedir: str):
-        if SFTPUploader.isdir(client, remotedir):
+    def makedirs(client: SFTPClient, remotedir: str, cache: SFTPMetadataCache = None):
+        if SFTPUploader.isdir(client, remotedir, cache):
             pass
 
-        elif SFTPUploader.isfile(client, remotedir):
+        elif SFTPUploader.isfile(client, remotedir, cache):
             raise OSError("a file with the same name as the remotedir, "
                           "'%s', already exists." % remotedir)
         else:
             head, tail = os.path.split(remotedir)
-            if head and not SFTPUploader.isdir(client, head):
-                SFTPUploader.makedirs(client, head)
+            if head and not SFTPUploader.isdir(client, head, cache):
+                SFTPUploader.makedirs(client, head, cache)
             if tail:
-                client.mkdir(remotedir)
+                try:
+                    client.mkdir(remotedir)
+                except IOError:
+                    # May have been created by a parallel transfer in the meantime
+                    if cache:
+                        cache.invalidate(remotedir)
+                    if not SFTPUploader.isdir(client, remotedir, cache):
+                        raise
+                if cache:
+                    # New directory - nothing in it yet
+                    cache.set_listing(remotedir, [])
 
     @staticmethod
-    def isdir(client: SFTPClient, remotepath: str) -> bool:
+    def list_directory(client: SFTPClient, remotedir: str, cache: SFTPMetadataCache):
         try:
-            result = stat.S_ISDIR(client.lstat(remotepath).st_mode)
-        except IOError:  # no such file
-            result = False
-        return result
+            cache.set_listing(remotedir, client.listdir_attr(remotedir))
+        except IOError:  # no such directory
+            cache.set(remotedir, None)
 
     @staticmethod
-    def isfile(client: SFTPClient, remotepath: str) -> bool:
+    def lstat(client: SFTPClient, remotepath: str, cache: SFTPMetadataCache = None) -> SFTPAttributes | None:
+        if cache:
+            found, attributes = cache.get(remotepath)
+            if found:
+                return attributes
         try:
-            result = stat.S_ISREG(client.lstat(remotepath).st_mode)
+            attributes = client.lstat(remotepath)
         except IOError:  # no such file
-            result = False
-        return result
+            attributes = None
+        if cache:
+            cache.set(remotepath, attributes)
+        return attributes
+
+    @staticmethod
+    def isdir(client: SFTPClient, remotepath: str, cache: SFTPMetadataCache = None) -> bool:
+        attributes = SFTPUploader.lstat(client, remotepath, cache)
+        return attributes is not None and stat.S_ISDIR(attributes.st_mode)
+
+    @staticmethod
+    def isfile(client: SFTPClient, remotepath: str, cache: SFTPMetadataCache = None) -> bool:
+        attributes = SFTPUploader.lstat(client, remotepath, cache)
+        return attributes is not None and stat.S_ISREG(attributes.st_mode)
@@ -0,0 +1,207 @@
+##################################################
+# PiHub bed sensor data files
+##################################################
+# Binary container layout (all values little-endian):
+#   File header: magic (4s), version (H), header size (H), reserved (8x)
+#   For each sensor connection, a block made of:
+#       Index entry: timestamp in microseconds since 1970-01-01, local time (q), data offset (Q),
+#                    sample count (I), reserved (4x)
+#       Raw uint16 samples, as sent by the sensor
+# The index is rebuilt by walking the entries. The sample count is set to unknown_count while a connection is being
+# received and is then computed from the file size, so an interrupted connection can still be read.
+##################################################
+from libs.utils.BedSamples import BedSamples
+
+from datetime import datetime, timedelta
+
+import logging
+import mmap
+import os
+import shutil
+import struct
+import sys
+
+
+class BedTextFile:
+    # Legacy tab-separated decimal text file - one line per sensor connection
+    extension = '.txt'
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self._file = open(filename, 'a')
+
+    def start_block(self, timestamp: datetime):
+        self._file.write(str(timestamp) + "\t")
+
+    def write_samples(self, data):
+        self._file.write(BedSamples.to_text(BedSamples.decode(data)))
+
+    def close(self):
+        self._file.write("\n")
+        self._file.close()
+
+    @staticmethod
+    def append(source_file: str, target_file: str):
+        with open(source_file, 'rb') as source, open(target_file, 'ab') as target:
+            shutil.copyfileobj(source, target)
+
+
+class BedDataFile:
+    extension = '.bed'
+
+    magic = b'PIHB'
+    version = 1
+    header_format = struct.Struct('<4sHH8x')
+    entry_format = struct.Struct('<qQI4x')
+    epoch = datetime(1970, 1, 1)
+    unknown_count = 0xFFFFFFFF
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        if os.path.isfile(filename) and os.path.getsize(filename) > 0:
+            self._file = open(filename, 'r+b')
+            BedDataFile.read_header(self._file)
+            self._file.seek(0, os.SEEK_END)
+        else:
+            self._file = open(filename, 'w+b')
+            self._file.write(self.header_format.pack(self.magic, self.version, self.header_format.size))
+        self._entry_position = None
+        self._sample_count = 0
+
+    def start_block(self, timestamp: datetime):
+        self._entry_position = self._file.tell()
+        self._sample_count = 0
+        self._file.write(self.entry_format.pack(BedDataFile.timestamp_to_int(timestamp),
+                                                self._entry_position + self.entry_format.size,
+                                                self.unknown_count))
+
+    def write_samples(self, data):
+        self._file.write(data)
+        self._sample_count += len(data) // BedSamples.sample_size
+
+    def close(self):
+        if self._entry_position is not None:
+            # Update sample count in the block index entry
+            end_position = self._file.tell()
+            self._file.seek(self._entry_position + 16)
+            self._file.write(struct.pack('<I', self._sample_count))
+            self._file.seek(end_position)
+        self._file.close()
+
+    @staticmethod
+    def timestamp_to_int(timestamp: datetime) -> int:
+        return (timestamp - BedDataFile.epoch) // timedelta(microseconds=1)
+
+    @staticmethod
+    def int_to_timestamp(value: int) -> datetime:
+        return BedDataFile.epoch + timedelta(microseconds=value)
+
+    @staticmethod
+    def read_header(file) -> int:
+        header = file.read(BedDataFile.header_format.size)
+        if len(header) < BedDataFile.header_format.size:
+            raise IOError('Invalid bed data file: header too short')
+        magic, version, header_size = BedDataFile.header_format.unpack(header)
+        if magic != BedDataFile.magic:
+            raise IOError('Invalid bed data file: bad magic')
+        if version > BedDataFile.version:
+            raise IOError('Unsupported bed data file version: ' + str(version))
+        return header_size
+
+    @staticmethod
+    def append(source_file: str, target_file: str):
+        # Add the blocks of source file at the end of target file
+        with BedDataFileReader(source_file) as reader, open(target_file, 'ab') as f:
+            BedDataFile.write_blocks(f, reader, reader.blocks)
+
+    @staticmethod
+    def merge(base_file: str, new_file: str, merged_file: str):
+        # Keep all blocks from base file, and add blocks from new file that are not already present. A block present
+        # in both files is kept from the one having the most samples, since the other copy may have been truncated by
+        # an interrupted transfer.
+        with BedDataFileReader(base_file) as base_reader, BedDataFileReader(new_file) as new_reader:
+            new_blocks = {block[0]: block for block in new_reader.blocks}
+            with open(merged_file, 'wb') as f:
+                f.write(BedDataFile.header_format.pack(BedDataFile.magic, BedDataFile.version,
+                                                       BedDataFile.header_format.size))
+                for block in base_reader.blocks:
+                    new_block = new_blocks.pop(block[0], None)
+                    if new_block and new_block[2] > block[2]:
+                        BedDataFile.write_blocks(f, new_reader, [new_block])
+                    else:
+                        BedDataFile.write_blocks(f, base_reader, [block])
+                BedDataFile.write_blocks(f, new_reader, [block for block in new_reader.blocks
+                                                         if block[0] in new_blocks])
+
+    @staticmethod
+    def write_blocks(f, reader, blocks: list):
+        for block in blocks:
+            timestamp, _, count = block
+            f.write(BedDataFile.entry_format.pack(timestamp, f.tell() + BedDataFile.entry_format.size, count))
+            f.write(reader.raw_samples(block))
+
+    @staticmethod
+    def to_text(filename: str, text_filename: str):
+        # Convert to the legacy text format
+        with BedDataFileReader(filename) as reader, open(text_filename, 'w') as f:
+            for block in reader.blocks:
+                f.write(str(BedDataFile.int_to_timestamp(block[0])) + "\t")
+                f.write(BedSamples.to_text(reader.samples(block)))
+                f.write("\n")
+
+
+class BedDataFileReader:
+    # Memory-mapped reader - blocks are (timestamp, data offset, sample count) tuples
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.blocks = []
+        self._file = open(filename, 'rb')
+        header_size = BedDataFile.read_header(self._file)
+        file_size = os.fstat(self._file.fileno()).st_size
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if file_size else None
+
+        position = header_size
+        entry_size = BedDataFile.entry_format.size
+        while position + entry_size <= file_size:
+            timestamp, offset, count = BedDataFile.entry_format.unpack_from(self._map, position)
+            if offset != position + entry_size:
+                logging.warning('BedDataFileReader: ' + filename + ' - corrupted index at ' + str(position) +
+                                ', ignoring the rest of the file.')
+                break
+            available = (file_size - offset) // BedSamples.sample_size
+            if count == BedDataFile.unknown_count or count > available:
+                count = available
+            self.blocks.append((timestamp, offset, count))
+            position = offset + count * BedSamples.sample_size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if self._map:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+    def raw_samples(self, block) -> memoryview:
+        _, offset, count = block
+        return memoryview(self._map)[offset:offset + count * BedSamples.sample_size]
+
+    def samples(self, block):
+        # Zero-copy view of the samples on little-endian systems
+        if sys.byteorder != 'little':
+            return BedSamples.decode(self.raw_samples(block))
+        return self.raw_samples(block).cast('H')
+
+
+if __name__ == '__main__':
+    # Convert a binary bed data file to the legacy text format
+    if len(sys.argv) < 2:
+        print('Usage: python -m libs.utils.BedDataFile <file.bed> [<file.txt>]')
+        exit(1)
+    target = sys.argv[2] if len(sys.argv) > 2 else os.path.splitext(sys.argv[1])[0] + BedTextFile.extension
+    BedDataFile.to_text(sys.argv[1], target)
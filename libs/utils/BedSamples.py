@@ -0,0 +1,27 @@
+##################################################
+# PiHub bed sensor samples decoding utilities
+##################################################
+from array import array
+
+import sys
+
+
+class BedSamples:
+    # Bed sensors (ESP32) send their RTC buffer as a raw stream of little-endian unsigned 16 bits values
+    sample_size = 2
+
+    @staticmethod
+    def decode(data) -> array:
+        # Decode a buffer of complete samples in a single pass - data length must be a multiple of sample_size
+        samples = array('H')
+        samples.frombytes(data)
+        if sys.byteorder != 'little':
+            samples.byteswap()
+        return samples
+
+    @staticmethod
+    def to_text(samples) -> str:
+        # Same output as writing str(sample) + "\t" for each sample
+        if not samples:
+            return ''
+        return '\t'.join(map(str, samples)) + '\t'
@@ -0,0 +1,94 @@
+##################################################
+# PiHub registry of known devices
+##################################################
+import threading
+import time
+
+
+class DeviceRegistry:
+    # State and last activity time of each device seen by a server. A device is "connected" between its connect and
+    # disconnect commands, "receiving" while at least one of its files is being received, "transferring" while its data
+    # is sent to the server and "idle" otherwise.
+
+    STATE_CONNECTED = 'connected'
+    STATE_RECEIVING = 'receiving'
+    STATE_IDLE = 'idle'
+    STATE_TRANSFERRING = 'transferring'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._devices = {}      # Device name: {'state', 'last_seen', 'receiving_count'}
+
+    def _device(self, device_name: str) -> dict:
+        # Must be called with the lock held
+        device = self._devices.get(device_name)
+        if not device:
+            device = self._devices[device_name] = {'state': DeviceRegistry.STATE_IDLE, 'last_seen': 0.,
+                                                   'receiving_count': 0}
+        return device
+
+    def connected(self, device_name: str):
+        with self._lock:
+            device = self._device(device_name)
+            device['last_seen'] = time.time()
+            if not device['receiving_count']:
+                device['state'] = DeviceRegistry.STATE_CONNECTED
+
+    def disconnected(self, device_name: str):
+        with self._lock:
+            device = self._device(device_name)
+            device['last_seen'] = time.time()
+            device['receiving_count'] = 0
+            if device['state'] != DeviceRegistry.STATE_TRANSFERRING:
+                device['state'] = DeviceRegistry.STATE_IDLE
+
+    def begin_receiving(self, device_name: str):
+        with self._lock:
+            device = self._device(device_name)
+            device['last_seen'] = time.time()
+            device['receiving_count'] += 1
+            device['state'] = DeviceRegistry.STATE_RECEIVING
+
+    def end_receiving(self, device_name: str):
+        with self._lock:
+            device = self._device(device_name)
+            device['last_seen'] = time.time()
+            device['receiving_count'] = max(0, device['receiving_count'] - 1)
+            if not device['receiving_count'] and device['state'] == DeviceRegistry.STATE_RECEIVING:
+                device['state'] = DeviceRegistry.STATE_CONNECTED
+
+    def begin_transfer(self, device_name: str) -> bool:
+        # Returns False if the device is connected or its data is already being transferred
+        with self._lock:
+            device = self._device(device_name)
+            if device['state'] != DeviceRegistry.STATE_IDLE:
+                return False
+            device['state'] = DeviceRegistry.STATE_TRANSFERRING
+            return True
+
+    def end_transfer(self, device_name: str):
+        with self._lock:
+            device = self._device(device_name)
+            if device['state'] == DeviceRegistry.STATE_TRANSFERRING:
+                device['state'] = DeviceRegistry.STATE_IDLE
+
+    def state(self, device_name: str) -> str:
+        with self._lock:
+            device = self._devices.get(device_name)
+            return device['state'] if device else DeviceRegistry.STATE_IDLE
+
+    def last_seen(self, device_name: str) -> float | None:
+        # Time of the last activity of the device, or None if never seen
+        with self._lock:
+            device = self._devices.get(device_name)
+            return device['last_seen'] if device and device['last_seen'] else None
+
+    def devices(self, *states: str) -> list:
+        # Names of the devices in one of the states (or all devices)
+        with self._lock:
+            return [name for name, device in self._devices.items() if not states or device['state'] in states]
+
+    def active_devices(self) -> list:
+        # Devices connected or sending data
+        return self.devices(DeviceRegistry.STATE_CONNECTED, DeviceRegistry.STATE_RECEIVING)
+
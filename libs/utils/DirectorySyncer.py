@@ -0,0 +1,59 @@
+##################################################
+# PiHub batched directories synchronization
+##################################################
+import logging
+import os
+import threading
+
+
+class DirectorySyncer:
+    # A file renamed in a directory is only durable once that directory is fsync'd. Directories are collected and
+    # synchronized together at most delay seconds later (or when flushed), so files received in the same directory in
+    # a burst only cost one fsync.
+
+    def __init__(self, delay: float = 1.):
+        self.delay = delay
+        self._lock = threading.Lock()
+        self._directories = set()
+        self._timer = None
+
+        # Statistics
+        self.requested_count = 0    # Directories synchronizations requested
+        self.synced_count = 0       # Directories synchronizations done
+
+    def add(self, directory: str):
+        with self._lock:
+            self._directories.add(directory)
+            self.requested_count += 1
+            if not self._timer:
+                self._timer = threading.Timer(self.delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        with self._lock:
+            directories = self._directories
+            self._directories = set()
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+        for directory in directories:
+            self.sync_directory(directory)
+        with self._lock:
+            self.synced_count += len(directories)
+
+    @staticmethod
+    def sync_directory(directory: str):
+        if os.name == 'nt':
+            return  # Directories can't be opened on Windows - renames are journaled by NTFS
+        try:
+            fd = os.open(directory, os.O_RDONLY)
+        except OSError as e:
+            logging.error('DirectorySyncer: unable to open ' + directory + ' - ' + str(e))
+            return
+        try:
+            os.fsync(fd)
+        except OSError as e:
+            logging.error('DirectorySyncer: unable to sync ' + directory + ' - ' + str(e))
+        finally:
+            os.close(fd)
@@ -0,0 +1,133 @@
+##################################################
+# PiHub background job queue
+##################################################
+from collections import deque
+from libs.utils.Metrics import Metrics
+
+import logging
+import threading
+import time
+import weakref
+
+
+class JobQueue:
+    # Jobs are identified by a key: submitting a key that is already waiting is coalesced with the waiting job, and a
+    # key submitted while it is being processed is queued again once done. The same key is thus never processed by two
+    # workers at the same time, and keys are processed in order of submission.
+
+    _queues = weakref.WeakSet()     # All queues, for metrics
+
+    def __init__(self, name: str, job_handler: callable, worker_count: int = 1):
+        self.name = name
+        self._job_handler = job_handler
+        self._worker_count = max(1, worker_count)
+        self._condition = threading.Condition()
+        self._queue = deque()       # Waiting keys, in order of submission
+        self._jobs = {}             # Waiting key: (args, submission time)
+        self._resubmitted = {}      # Running key: (args, submission time) of a job submitted while running
+        self._running = set()
+        self._workers = []
+        self.is_running = False
+
+        # Statistics
+        self.submitted_count = 0
+        self.coalesced_count = 0
+        self.completed_count = 0
+        self.failed_count = 0
+        self.last_latency = 0.
+        self.total_latency = 0.
+
+        if not JobQueue._queues:
+            Metrics.register_gauge('pihub_job_queue_depth', JobQueue.queues_depths, 'Jobs waiting in each queue')
+        JobQueue._queues.add(self)
+
+    @staticmethod
+    def queues_depths() -> dict:
+        return {(('queue', job_queue.name),): job_queue.depth for job_queue in list(JobQueue._queues)}
+
+    @property
+    def depth(self) -> int:
+        with self._condition:
+            return len(self._queue)
+
+    @property
+    def running_count(self) -> int:
+        with self._condition:
+            return len(self._running)
+
+    @property
+    def average_latency(self) -> float:
+        processed_count = self.completed_count + self.failed_count
+        if not processed_count:
+            return 0.
+        return self.total_latency / processed_count
+
+    def start(self):
+        with self._condition:
+            if self.is_running:
+                return
+            self.is_running = True
+        for index in range(self._worker_count):
+            worker = threading.Thread(target=self._process_jobs, name=self.name + 'Worker' + str(index), daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def stop(self):
+        with self._condition:
+            self.is_running = False
+            self._condition.notify_all()
+        self._workers.clear()
+
+    def submit(self, key, *args):
+        with self._condition:
+            self.submitted_count += 1
+            if key in self._running:
+                # Keep the first submission time to measure the latency of the oldest waiting data
+                submit_time = self._resubmitted[key][1] if key in self._resubmitted else time.monotonic()
+                self._resubmitted[key] = (args, submit_time)
+                return
+            if key in self._jobs:
+                self.coalesced_count += 1
+                self._jobs[key] = (args, self._jobs[key][1])
+                return
+            self._jobs[key] = (args, time.monotonic())
+            self._queue.append(key)
+            self._condition.notify()
+
+    def _process_jobs(self):
+        while True:
+            with self._condition:
+                while self.is_running and not self._queue:
+                    self._condition.wait()
+                if not self.is_running:
+                    return
+                key = self._queue.popleft()
+                args, submit_time = self._jobs.pop(key)
+                self._running.add(key)
+
+            success = False
+            try:
+                success = self._job_handler(*args) is not False
+            except Exception as e:
+                logging.error(self.name + ': Error processing ' + str(key) + ' - ' + str(e))
+
+            latency = time.monotonic() - submit_time
+            with self._condition:
+                self._running.remove(key)
+                if success:
+                    self.completed_count += 1
+                else:
+                    self.failed_count += 1
+                self.last_latency = latency
+                self.total_latency += latency
+                if key in self._resubmitted:
+                    self._jobs[key] = self._resubmitted.pop(key)
+                    self._queue.append(key)
+                    self._condition.notify()
+                depth = len(self._queue)
+            Metrics.inc('pihub_job_queue_jobs_total', description='Jobs processed, by queue and result',
+                        queue=self.name, result='completed' if success else 'failed')
+            Metrics.observe('pihub_job_queue_latency_seconds', latency,
+                            'Delay between a job submission and the end of its processing', queue=self.name)
+            logging.info(self.name + ': ' + str(key) + (' done' if success else ' failed') + ' in ' +
+                         f'{latency:.1f}' + 's (' + str(depth) + ' waiting)')
@@ -0,0 +1,142 @@
+##################################################
+# PiHub metrics registry
+##################################################
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import bisect
+import logging
+import threading
+
+
+class Metrics:
+    # Process-wide counters, histograms and gauges, served in Prometheus text format. Metrics are identified by name
+    # and labels. Gauges are callbacks evaluated when metrics are read, so the monitored values don't need updating.
+
+    default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30., 60., 120., 300.)
+
+    _lock = threading.Lock()
+    _descriptions = {}      # Metric name: (type, help text)
+    _counters = {}          # (metric name, labels): value
+    _histograms = {}        # (metric name, labels): [buckets, buckets counts, sum, count]
+    _gauges = {}            # Metric name: callback returning a value or a {labels: value} dict
+    _server = None
+
+    @staticmethod
+    def labels_key(labels: dict) -> tuple:
+        return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+    @staticmethod
+    def inc(name: str, value: float = 1, description: str = '', **labels):
+        key = (name, Metrics.labels_key(labels))
+        with Metrics._lock:
+            Metrics._descriptions.setdefault(name, ('counter', description))
+            Metrics._counters[key] = Metrics._counters.get(key, 0) + value
+
+    @staticmethod
+    def observe(name: str, value: float, description: str = '', buckets: tuple = None, **labels):
+        key = (name, Metrics.labels_key(labels))
+        with Metrics._lock:
+            Metrics._descriptions.setdefault(name, ('histogram', description))
+            histogram = Metrics._histograms.get(key)
+            if not histogram:
+                histogram_buckets = buckets or Metrics.default_buckets
+                histogram = Metrics._histograms[key] = [histogram_buckets, [0] * len(histogram_buckets), 0., 0]
+            index = bisect.bisect_left(histogram[0], value)
+            if index < len(histogram[1]):
+                histogram[1][index] += 1
+            histogram[2] += value
+            histogram[3] += 1
+
+    @staticmethod
+    def register_gauge(name: str, callback: callable, description: str = '', metric_type: str = 'gauge'):
+        # callback returns a value, or a dict of {labels dict as a tuple of (name, value): value}
+        with Metrics._lock:
+            Metrics._descriptions[name] = (metric_type, description)
+            Metrics._gauges[name] = callback
+
+    @staticmethod
+    def unregister_gauge(name: str):
+        with Metrics._lock:
+            Metrics._gauges.pop(name, None)
+            Metrics._descriptions.pop(name, None)
+
+    @staticmethod
+    def render() -> str:
+        with Metrics._lock:
+            counters = dict(Metrics._counters)
+            histograms = {key: [value[0], list(value[1]), value[2], value[3]]
+                          for key, value in Metrics._histograms.items()}
+            gauges = dict(Metrics._gauges)
+            descriptions = dict(Metrics._descriptions)
+
+        samples = {}    # Metric name: list of (sample name, labels, value)
+        for (name, labels), value in counters.items():
+            samples.setdefault(name, []).append((name, labels, value))
+        for (name, labels), (buckets, counts, total, count) in histograms.items():
+            cumulative_count = 0
+            for bucket, bucket_count in zip(buckets, counts):
+                cumulative_count += bucket_count
+                samples.setdefault(name, []).append((name + '_bucket', labels + (('le', str(bucket)),),
+                                                     cumulative_count))
+            samples[name].append((name + '_bucket', labels + (('le', '+Inf'),), count))
+            samples[name].append((name + '_sum', labels, total))
+            samples[name].append((name + '_count', labels, count))
+        for name, callback in gauges.items():
+            try:
+                values = callback()
+            except Exception as e:
+                logging.debug('Metrics: unable to read ' + name + ' - ' + str(e))
+                continue
+            if not isinstance(values, dict):
+                values = {(): values}
+            samples[name] = [(name, labels, value) for labels, value in values.items()]
+
+        lines = []
+        for name in sorted(samples):
+            metric_type, description = descriptions.get(name, ('untyped', ''))
+            if description:
+                lines.append('# HELP ' + name + ' ' + description)
+            lines.append('# TYPE ' + name + ' ' + metric_type)
+            for sample_name, labels, value in samples[name]:
+                lines.append(sample_name + Metrics.format_labels(labels) + ' ' + repr(float(value)))
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def format_labels(labels: tuple) -> str:
+        if not labels:
+            return ''
+        return '{' + ','.join(name + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+                              + '"' for name, value in labels) + '}'
+
+    @staticmethod
+    def start_server(port: int, hostname: str = '127.0.0.1'):
+        if Metrics._server:
+            return
+        Metrics._server = ThreadingHTTPServer((hostname, port), MetricsRequestHandler)
+        Metrics._server.daemon_threads = True
+        threading.Thread(target=Metrics._server.serve_forever, name='MetricsServerThread', daemon=True).start()
+        logging.info('Metrics available on http://' + hostname + ':' + str(port) + '/metrics')
+
+    @staticmethod
+    def stop_server():
+        if Metrics._server:
+            Metrics._server.shutdown()
+            Metrics._server.server_close()
+            Metrics._server = None
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ['/', '/metrics']:
+            self.send_error(404)
+            return
+        content = Metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass  # Scraped regularly - don't fill the logs
@@ -0,0 +1,93 @@
+##################################################
+# PiHub index of files received from devices
+##################################################
+import datetime
+import hashlib
+import os
+import sqlite3
+import threading
+
+
+class ReceivedFilesIndex:
+    # Size and hash of each file received from a device, saved in a SQLite database (WAL mode, so recording a file is a
+    # cheap append). The hashes are reused to validate files without reading them again, and a device can know the hub
+    # already has a file. Entries are kept once their files are processed (and marked as such), so a device re-sending
+    # a file the hub already handled is told so, until they are pruned for their age. Each entry is synced to disk when
+    # recorded: a file the hub acknowledged must still be known after a power cut.
+
+    hash_algorithm = 'sha256'
+
+    def __init__(self, index_path: str):
+        self.index_path = index_path
+        self._lock = threading.Lock()
+        os.makedirs(index_path, exist_ok=True)
+        self._db = sqlite3.connect(os.path.join(index_path, 'received_files.db'), check_same_thread=False,
+                                   isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=FULL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS files (device TEXT NOT NULL, path TEXT NOT NULL, '
+                         'size INTEGER NOT NULL, hash TEXT NOT NULL, received TEXT NOT NULL, processed TEXT, '
+                         'PRIMARY KEY (device, path))')
+        self._db.execute('CREATE INDEX IF NOT EXISTS files_received ON files (received)')
+
+    @staticmethod
+    def new_hash():
+        return hashlib.new(ReceivedFilesIndex.hash_algorithm)
+
+    @staticmethod
+    def hash_file(filename: str, size: int | None = None, file_hash=None):
+        # Hash the first size bytes (or all) of a file, continuing file_hash if specified
+        if file_hash is None:
+            file_hash = ReceivedFilesIndex.new_hash()
+        remaining = size
+        with open(filename, 'rb') as f:
+            while remaining is None or remaining > 0:
+                data = f.read(1024 * 1024 if remaining is None else min(1024 * 1024, remaining))
+                if not data:
+                    break
+                file_hash.update(data)
+                if remaining is not None:
+                    remaining -= len(data)
+        return file_hash
+
+    @staticmethod
+    def relative_path(file_path: str, file_name: str) -> str:
+        return '/'.join(part for part in (file_path + '/' + file_name).replace(os.sep, '/').split('/') if part)
+
+    def get(self, device_name: str, relative_path: str) -> dict | None:
+        # Returns {'size', 'hash', 'received', 'processed'} of a received file, or None if unknown
+        with self._lock:
+            row = self._db.execute('SELECT size, hash, received, processed FROM files WHERE device = ? AND path = ?',
+                                   (device_name, relative_path)).fetchone()
+        return {'size': row[0], 'hash': row[1], 'received': row[2], 'processed': row[3]} if row else None
+
+    def set(self, device_name: str, relative_path: str, size: int, file_hash: str):
+        # File received (again) - to be processed
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO files (device, path, size, hash, received) VALUES (?, ?, ?, ?, ?)',
+                             (device_name, relative_path, size, file_hash,
+                              datetime.datetime.now().isoformat(timespec='seconds')))
+
+    def is_intact(self, device_name: str, relative_path: str, size: int, file_hash: str | None = None) -> bool:
+        # File already received with that size (and hash, if known)
+        entry = self.get(device_name, relative_path)
+        if not entry or entry['size'] != size:
+            return False
+        return file_hash is None or entry['hash'].lower() == file_hash.lower()
+
+    def set_processed(self, device_name: str, relative_path: str):
+        # File (or all the files of a folder) processed
+        with self._lock:
+            self._db.execute('UPDATE files SET processed = ? WHERE device = ? AND (path = ? OR substr(path, 1, ?) = ?)',
+                             (datetime.datetime.now().isoformat(timespec='seconds'), device_name, relative_path,
+                              len(relative_path) + 1, relative_path + '/'))
+
+    def prune(self, max_age: float) -> int:
+        # Remove the entries older than max_age seconds - returns the number of entries removed
+        oldest = (datetime.datetime.now() - datetime.timedelta(seconds=max_age)).isoformat(timespec='seconds')
+        with self._lock:
+            return self._db.execute('DELETE FROM files WHERE received < ?', (oldest,)).rowcount
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,113 @@
+##################################################
+# PiHub storage space budget
+##################################################
+from libs.utils.Metrics import Metrics
+
+import logging
+import os
+import threading
+import time
+
+
+class StorageBudget:
+    # Free space of the file systems data is received to, shared by all servers. Free space is queried at most every
+    # cache_duration seconds, and space is reserved for data being received, so concurrent uploads can't together
+    # fill the storage.
+
+    cache_duration = 2.     # Seconds a free space query is reused
+
+    _lock = threading.Lock()
+    _free_spaces = {}       # File system: (free bytes, query time)
+    _reservations = {}      # File system: reserved bytes
+    _paths = {}             # Path: file system
+
+    @staticmethod
+    def free_space(path: str) -> int:
+        with StorageBudget._lock:
+            return StorageBudget._free_space(StorageBudget._file_system(path))
+
+    @staticmethod
+    def reserved_space(path: str) -> int:
+        with StorageBudget._lock:
+            return StorageBudget._reservations.get(StorageBudget._file_system(path), 0)
+
+    @staticmethod
+    def usage() -> dict:
+        # Path: (free bytes, reserved bytes) of all paths checked so far
+        with StorageBudget._lock:
+            return {path: (StorageBudget._free_space(file_system), StorageBudget._reservations.get(file_system, 0))
+                    for path, file_system in StorageBudget._paths.items()}
+
+    @staticmethod
+    def has_space(path: str, min_free_space: int, size: int = 0) -> bool:
+        # At least min_free_space bytes would remain after storing size bytes
+        with StorageBudget._lock:
+            file_system = StorageBudget._file_system(path)
+            return StorageBudget._available_space(file_system, min_free_space) >= size
+
+    @staticmethod
+    def reserve(path: str, size: int, min_free_space: int) -> bool:
+        with StorageBudget._lock:
+            file_system = StorageBudget._file_system(path)
+            if StorageBudget._available_space(file_system, min_free_space) < size:
+                return False
+            StorageBudget._reservations[file_system] = StorageBudget._reservations.get(file_system, 0) + size
+            return True
+
+    @staticmethod
+    def release(path: str, size: int):
+        # Data was stored (or not) - the actual free space must be queried again
+        with StorageBudget._lock:
+            file_system = StorageBudget._file_system(path)
+            StorageBudget._reservations[file_system] = max(0, StorageBudget._reservations.get(file_system, 0) - size)
+            StorageBudget._free_spaces.pop(file_system, None)
+
+    @staticmethod
+    def _file_system(path: str):
+        # Must be called with the lock held
+        if path not in StorageBudget._paths:
+            try:
+                StorageBudget._paths[path] = os.stat(path).st_dev
+            except OSError:
+                return path
+        return StorageBudget._paths[path]
+
+    @staticmethod
+    def _free_space(file_system) -> int:
+        # Must be called with the lock held
+        free_space = StorageBudget._free_spaces.get(file_system)
+        if free_space and time.monotonic() - free_space[1] < StorageBudget.cache_duration:
+            return free_space[0]
+        # Any path of that file system will do - paths removed since they were checked are forgotten
+        paths = [path for path, fs in StorageBudget._paths.items() if fs == file_system] or [file_system]
+        error = None
+        for path in paths:
+            try:
+                if hasattr(os, 'statvfs'):
+                    stats = os.statvfs(path)
+                    free_bytes = stats.f_bavail * stats.f_frsize
+                else:
+                    import shutil
+                    free_bytes = shutil.disk_usage(path).free
+            except OSError as e:
+                error = e
+                StorageBudget._paths.pop(path, None)
+                continue
+            StorageBudget._free_spaces[file_system] = (free_bytes, time.monotonic())
+            return free_bytes
+        logging.error('StorageBudget: unable to query free space of ' + str(paths[-1]) + ' - ' + str(error))
+        return 0
+
+    @staticmethod
+    def _available_space(file_system, min_free_space: int) -> int:
+        # Must be called with the lock held
+        return (StorageBudget._free_space(file_system) - StorageBudget._reservations.get(file_system, 0) -
+                min_free_space)
+
+
+Metrics.register_gauge('pihub_storage_free_bytes', lambda: {(('path', path),): usage[0] for path, usage
+                                                            in StorageBudget.usage().items()},
+                       'Free space of the data paths')
+Metrics.register_gauge('pihub_storage_reserved_bytes', lambda: {(('path', path),): usage[1] for path, usage
+                                                                in StorageBudget.usage().items()},
+                       'Space reserved for data being received')
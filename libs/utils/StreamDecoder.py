@@ -0,0 +1,83 @@
+##################################################
+# PiHub decoding of compressed streams
+##################################################
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class StreamDecoder:
+    # Decoded content of the next length bytes of a stream (an HTTP request body, for example), read with readinto.
+    # Whatever the compression ratio, a read never returns more than the size of the buffer, so memory usage stays
+    # bounded. Invalid encoded data raises ValueError.
+
+    read_size = 64 * 1024   # Encoded bytes read at once
+
+    def __init__(self, stream, length: int, encoding: str = 'identity'):
+        self.stream = stream
+        self.length = length
+        self.encoding = encoding
+        self.raw_count = 0      # Encoded bytes read from the stream
+        self._decompressor = None
+        self._reader = None
+
+        if encoding == 'gzip':
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == 'zstd' and zstandard:
+            self._reader = zstandard.ZstdDecompressor().stream_reader(self, read_size=self.read_size)
+        elif encoding != 'identity':
+            raise ValueError('Unsupported content encoding: ' + encoding)
+
+    @staticmethod
+    def supported_encodings() -> list:
+        return ['identity', 'gzip'] + (['zstd'] if zstandard else [])
+
+    @property
+    def finished(self) -> bool:
+        # All encoded data was read and decoded
+        if self.raw_count < self.length:
+            return False
+        if self._decompressor:
+            return self._decompressor.eof and not self._decompressor.unconsumed_tail
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        # Encoded data
+        remaining = self.length - self.raw_count
+        if size < 0 or size > remaining:
+            size = remaining
+        data = self.stream.read(size) if size else b''
+        self.raw_count += len(data)
+        return data
+
+    def readinto(self, buffer) -> int:
+        # Decoded data - returns 0 once everything was decoded (or if the stream ended)
+        if self._reader:
+            try:
+                return self._reader.readinto(buffer)
+            except zstandard.ZstdError as e:
+                raise ValueError('Invalid zstd data: ' + str(e))
+
+        if not self._decompressor:
+            remaining = self.length - self.raw_count
+            if not remaining:
+                return 0
+            count = self.stream.readinto(buffer[:remaining]) or 0
+            self.raw_count += count
+            return count
+
+        while not self._decompressor.eof:
+            data = self._decompressor.unconsumed_tail or self.read(self.read_size)
+            if not data:
+                return 0
+            try:
+                decoded = self._decompressor.decompress(data, len(buffer))
+            except zlib.error as e:
+                raise ValueError('Invalid gzip data: ' + str(e))
+            if decoded:
+                buffer[:len(decoded)] = decoded
+                return len(decoded)
+        return 0
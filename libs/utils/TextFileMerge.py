@@ -0,0 +1,97 @@
+##################################################
+# PiHub text files merging
+##################################################
+import hashlib
+import os
+import sqlite3
+
+
+class TextFileKeys:
+    # Hashed keys of the lines of a file, kept in memory up to max_memory_keys keys, then in a temporary database next
+    # to the merged file (on disk, with a small page cache) so the memory used doesn't grow with the file size.
+
+    def __init__(self, database_file: str, max_memory_keys: int):
+        self.database_file = database_file
+        self.max_memory_keys = max_memory_keys
+        self._keys = set()
+        self._pending_keys = []     # Keys to insert in the database, in batch
+        self._db = None
+
+    def add(self, key: bytes):
+        if self._db is None:
+            self._keys.add(key)
+            if len(self._keys) > self.max_memory_keys:
+                self._spill()
+        else:
+            self._pending_keys.append((key,))
+            if len(self._pending_keys) >= 10000:
+                self._flush()
+
+    def __contains__(self, key: bytes) -> bool:
+        if self._db is None:
+            return key in self._keys
+        if self._pending_keys:
+            self._flush()
+        return self._db.execute('SELECT 1 FROM keys WHERE key = ?', (key,)).fetchone() is not None
+
+    def _spill(self):
+        if os.path.exists(self.database_file):
+            os.remove(self.database_file)   # Left by an interrupted merge
+        self._db = sqlite3.connect(self.database_file)
+        self._db.execute('PRAGMA journal_mode=OFF')
+        self._db.execute('PRAGMA synchronous=OFF')
+        self._db.execute('PRAGMA cache_size=-4096')     # 4 MB
+        self._db.execute('CREATE TABLE keys (key BLOB PRIMARY KEY) WITHOUT ROWID')
+        self._db.executemany('INSERT OR IGNORE INTO keys VALUES (?)', ((key,) for key in self._keys))
+        self._keys = set()
+
+    def _flush(self):
+        self._db.executemany('INSERT OR IGNORE INTO keys VALUES (?)', self._pending_keys)
+        self._pending_keys = []
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+            os.remove(self.database_file)
+        self._keys = set()
+        self._pending_keys = []
+
+
+class TextFileMerge:
+    # A line of the new file is considered already merged if its key (what follows the last mount point in the line,
+    # or the whole line) is the key of a base file line. This matches the previous substring comparison for identical
+    # lines and for files paths logged from the same mount point, with two hashed keys lookups per line. The keys of
+    # the base file lines are kept in memory up to max_memory_keys lines (about 80 bytes each), then on disk.
+
+    max_memory_keys = 200000
+
+    @staticmethod
+    def key(text: str) -> bytes:
+        return hashlib.blake2b(text.encode(), digest_size=16).digest()
+
+    @staticmethod
+    def lines(filename: str):
+        with open(filename) as f:
+            for line in f:
+                yield line.rstrip('\r\n')
+
+    @staticmethod
+    def merge(base_file: str, new_file: str, merged_file: str, mount_point: str = '/mnt/app'):
+        # Keep all lines of the base file, followed by the lines of the new file that are not in the base file.
+        # Files are streamed line by line - only the hashed keys of the base file lines are kept.
+        known_keys = TextFileKeys(merged_file + '.keys', TextFileMerge.max_memory_keys)
+        temp_file = merged_file + '.tmp'
+        try:
+            with open(temp_file, 'w') as f:
+                for line in TextFileMerge.lines(base_file):
+                    known_keys.add(TextFileMerge.key(line.split(mount_point)[-1]))
+                    f.write(line + "\n")
+                for line in TextFileMerge.lines(new_file):
+                    path_key = TextFileMerge.key(line.split(mount_point)[-1])
+                    if path_key in known_keys or TextFileMerge.key(line) in known_keys:
+                        continue
+                    f.write(line + "\n")
+        finally:
+            known_keys.close()
+        os.replace(temp_file, merged_file)
@@ -0,0 +1,90 @@
+##################################################
+# PiHub journal of datasets transfers
+##################################################
+import datetime
+import logging
+import os
+import sqlite3
+import threading
+
+
+class TransferJournal:
+    # Progress of the transfer of each dataset folder (identified by its path relative to the "ToProcess" folder): the
+    # session created for it, the events posted and the files uploaded. Saved in a SQLite database (WAL mode, so each
+    # record is a cheap append), a transfer interrupted by an error or a restart resumes where it stopped. Each record
+    # is synced to disk when committed: a session record lost in a power cut would create a duplicate session.
+
+    def __init__(self, journal_file: str):
+        self.journal_file = journal_file
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(journal_file) or '.', exist_ok=True)
+        self._db = sqlite3.connect(journal_file, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=FULL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS sessions (dataset TEXT PRIMARY KEY, device TEXT NOT NULL, '
+                         'id_session INTEGER NOT NULL, events_done INTEGER NOT NULL DEFAULT 0, created TEXT)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS events (dataset TEXT NOT NULL, event_index INTEGER NOT NULL, '
+                         'PRIMARY KEY (dataset, event_index))')
+        self._db.execute('CREATE TABLE IF NOT EXISTS assets (dataset TEXT NOT NULL, asset_name TEXT NOT NULL, '
+                         'size INTEGER NOT NULL, hash TEXT, uploaded TEXT, PRIMARY KEY (dataset, asset_name))')
+
+    def session(self, dataset: str) -> dict | None:
+        # Returns {'id_session', 'events_done'} of a dataset, or None if no session was created for it
+        with self._lock:
+            row = self._db.execute('SELECT id_session, events_done FROM sessions WHERE dataset = ?',
+                                   (dataset,)).fetchone()
+        return {'id_session': row[0], 'events_done': bool(row[1])} if row else None
+
+    def session_created(self, dataset: str, device_name: str, id_session: int):
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO sessions (dataset, device, id_session, created) '
+                             'VALUES (?, ?, ?, ?)',
+                             (dataset, device_name, id_session,
+                              datetime.datetime.now().isoformat(timespec='seconds')))
+
+    def posted_events(self, dataset: str) -> set:
+        # Indexes of the session events already posted
+        with self._lock:
+            return {row[0] for row in self._db.execute('SELECT event_index FROM events WHERE dataset = ?',
+                                                       (dataset,))}
+
+    def event_posted(self, dataset: str, event_index: int):
+        with self._lock:
+            self._db.execute('INSERT OR IGNORE INTO events (dataset, event_index) VALUES (?, ?)',
+                             (dataset, event_index))
+
+    def events_done(self, dataset: str):
+        # All events of the dataset are posted - the posted events are not needed anymore
+        with self._lock:
+            self._db.execute('BEGIN')
+            self._db.execute('UPDATE sessions SET events_done = 1 WHERE dataset = ?', (dataset,))
+            self._db.execute('DELETE FROM events WHERE dataset = ?', (dataset,))
+            self._db.execute('COMMIT')
+
+    def uploaded_assets(self, dataset: str) -> dict:
+        # Asset name: (size, hash) of the files already uploaded
+        with self._lock:
+            return {row[0]: (row[1], row[2]) for row in
+                    self._db.execute('SELECT asset_name, size, hash FROM assets WHERE dataset = ?', (dataset,))}
+
+    def asset_uploaded(self, dataset: str, asset_name: str, size: int, file_hash: str | None):
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO assets (dataset, asset_name, size, hash, uploaded) '
+                             'VALUES (?, ?, ?, ?, ?)',
+                             (dataset, asset_name, size, file_hash,
+                              datetime.datetime.now().isoformat(timespec='seconds')))
+
+    def remove(self, dataset: str):
+        # Dataset completely transferred
+        with self._lock:
+            self._db.execute('BEGIN')
+            for table in ['sessions', 'events', 'assets']:
+                self._db.execute('DELETE FROM ' + table + ' WHERE dataset = ?', (dataset,))
+            self._db.execute('COMMIT')
+
+    def close(self):
+        with self._lock:
+            try:
+                self._db.close()
+            except sqlite3.Error as e:
+                logging.error('TransferJournal: unable to close ' + self.journal_file + ' - ' + str(e))
@@ -9,6 +9,8 @@ from libs.servers.WatchServerSFTP import WatchServerSFTP
 from libs.servers.WatchServerOpenTera import WatchServerOpenTera
 from libs.servers.folderWatcher import FolderWatcher
 from libs.hardware.PiHubHardware import PiHubHardware
+from libs.uploaders.SFTPConnectionPool import SFTPConnectionPool
+from libs.utils.Metrics import Metrics
 
 from Globals import version_string
 
@@ -55,6 +57,11 @@ if __name__ == '__main__':
     # Initializing...
     servers = []
 
+    # Metrics, for monitoring
+    if config_man.general_config.get("metrics_port"):
+        Metrics.start_server(port=config_man.general_config["metrics_port"],
+                             hostname=config_man.general_config.get("metrics_hostname", '127.0.0.1'))
+
     # Wait for Internet connection
     # PiHubHardware.wait_for_internet()
 
@@ -110,6 +117,8 @@ if __name__ == '__main__':
     except (KeyboardInterrupt, SystemExit):
         for server in servers:
             server.stop()
+        SFTPConnectionPool.close_all()
+        Metrics.stop_server()
         logging.info("PiHub stopped by user.")
         exit(0)
     logging.info("PiHub stopped.")
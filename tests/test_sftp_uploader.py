@@ -0,0 +1,79 @@
+##################################################
+# PiHub SFTP uploader tests
+##################################################
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from libs.uploaders.SFTPConnectionPool import SFTPConnectionPool
+from libs.uploaders.SFTPUploader import SFTPUploader
+
+import threading
+import unittest
+from unittest import mock
+
+
+class FakeSession:
+    # Pooled session, without connection
+
+    def __init__(self):
+        self.client = None
+        self.metadata_cache = None
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class SFTPSendTest(unittest.TestCase):
+    sftp_config = {'hostname': 'localhost', 'port': 22, 'username': 'test', 'password': '', 'parallel_transfers': 4}
+
+    def setUp(self):
+        self.sessions = []
+        self.sent_files = []
+        self._lock = threading.Lock()
+
+    def tearDown(self):
+        SFTPConnectionPool.close_all()
+
+    def acquire(self, sftp_config: dict) -> FakeSession:
+        session = FakeSession()
+        with self._lock:
+            self.sessions.append(session)
+        return session
+
+    def sftp_put(self, client, file_server_location: str, file_to_transfer: str,
+                 file_transferred_callback: callable = None, cache=None):
+        if file_to_transfer == 'file_3.data':
+            raise EOFError()    # Link dropped while sending
+        with self._lock:
+            self.sent_files.append(file_to_transfer)
+        if file_transferred_callback:
+            file_transferred_callback(file_to_transfer)
+
+    def send(self, files: list) -> tuple:
+        # Returns (result, transferred files)
+        transferred_files = []
+        with mock.patch.object(SFTPConnectionPool, 'acquire', side_effect=self.acquire), \
+                mock.patch.object(SFTPUploader, 'sftp_put', side_effect=self.sftp_put):
+            result = SFTPUploader.sftp_send(self.sftp_config, ['/data'] * len(files), files,
+                                            transferred_files.append, check_internet=False)
+        return result, transferred_files
+
+    def test_all_files_sent(self):
+        files = ['file_' + str(index) + '.data' for index in range(8) if index != 3]
+        result, transferred_files = self.send(files)
+        self.assertTrue(result)
+        self.assertCountEqual(transferred_files, files)
+
+    def test_failed_file_reported(self):
+        files = ['file_' + str(index) + '.data' for index in range(8)]
+        result, transferred_files = self.send(files)
+        self.assertFalse(result)
+        self.assertCountEqual(transferred_files, [file for file in files if file != 'file_3.data'])
+        # The session the error occurred on is not returned to the pool
+        self.assertEqual(sum(session.closed for session in self.sessions), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()